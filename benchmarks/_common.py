@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the benchmark scripts"""
+
+from __future__ import print_function, absolute_import, division
+
+import os
+import sys
+import timeit
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "main", "python")
+if SOURCE_DIR not in sys.path:
+    sys.path.insert(0, SOURCE_DIR)
+
+
+def best_of(function, repeat=3):
+    """Return the fastest of repeat runs of function(), in seconds"""
+    return min(timeit.repeat(function, number=1, repeat=repeat))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare memory and conversion time of Account objects and plain dicts
+
+Usage:
+    account_model_benchmark.py [--accounts=<N>] [--repeat=<R>]
+
+Options:
+  --accounts=<N>    Number of generated accounts [default: 100000]
+  --repeat=<R>      Take the best of R runs [default: 3]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import gc
+
+from docopt import docopt
+
+from _common import best_of
+from inventory import make_accounts
+
+from ultimate_source_of_accounts.account import Account
+from ultimate_source_of_accounts.account_converter import get_streaming_aws_accounts
+from ultimate_source_of_accounts.validation import validate_accounts
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def as_dicts(raw_accounts):
+    accounts = dict((name, dict(data)) for name, data in raw_accounts.items())
+    for account in accounts.values():
+        account['id'] = str(account['id'])
+    return accounts
+
+
+def as_accounts(raw_accounts):
+    return dict((name, Account.from_dict(data)) for name, data in raw_accounts.items())
+
+
+def allocated_size(build, raw_accounts):
+    """Return the bytes still allocated by the result of build()"""
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    result = build(raw_accounts)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def convert(accounts):
+    for chunks in get_streaming_aws_accounts(accounts).values():
+        for _ in chunks():
+            pass
+
+
+def main():
+    arguments = docopt(__doc__)
+    number_of_accounts = int(arguments["--accounts"])
+    repeat = int(arguments["--repeat"])
+
+    raw_accounts = make_accounts(number_of_accounts)
+    print("{0} accounts".format(number_of_accounts))
+    print("{0:<10} {1:>12} {2:>10} {3:>10} {4:>10}".format("model", "memory [MB]", "build", "validate", "convert"))
+    for label, build in (("dict", as_dicts), ("Account", as_accounts)):
+        size = allocated_size(build, raw_accounts)
+        accounts = build(raw_accounts)
+        print("{0:<10} {1:>12} {2:>9.3f}s {3:>9.3f}s {4:>9.3f}s".format(
+            label,
+            "n/a" if size is None else "{0:.1f}".format(size / 1024 / 1024),
+            best_of(lambda: build(raw_accounts), repeat),
+            best_of(lambda: validate_accounts(accounts), repeat),
+            best_of(lambda: convert(accounts), repeat)))
+
+
+if __name__ == "__main__":
+    main()
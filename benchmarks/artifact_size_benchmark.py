@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare size, compression time and transfer time of the published variants
+
+Usage:
+    artifact_size_benchmark.py [--accounts=<N>] [--bandwidth=<MBIT>]
+
+Options:
+  --accounts=<N>        Number of generated accounts [default: 10000]
+  --bandwidth=<MBIT>    Bandwidth for the estimated transfer time, in Mbit/s [default: 10]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import timeit
+
+from docopt import docopt
+
+import _common  # noqa: F401, sets up sys.path
+from inventory import make_accounts
+
+from ultimate_source_of_accounts.account_converter import get_converted_aws_accounts
+from ultimate_source_of_accounts.account_exporter import gzip_compress
+
+
+def main():
+    arguments = docopt(__doc__)
+    accounts = make_accounts(int(arguments["--accounts"]))
+    bytes_per_second = float(arguments["--bandwidth"]) * 1000 * 1000 / 8
+    for account in accounts.values():
+        account["id"] = str(account["id"])
+
+    print("{0:<28} {1:>12} {2:>12} {3:>12}".format("variant", "bytes", "compress", "transfer"))
+    for key_name, content in sorted(get_converted_aws_accounts(accounts).items()):
+        content = content.encode("utf-8")
+        compress_time = min(timeit.repeat(lambda: gzip_compress(content), number=1, repeat=3))
+        compressed = gzip_compress(content)
+        for variant, size, duration in ((key_name, len(content), 0),
+                                        (key_name + " (gzip)", len(compressed), compress_time)):
+            print("{0:<28} {1:>12d} {2:>11.3f}s {3:>11.3f}s".format(
+                variant, size, duration, size / bytes_per_second))
+
+
+if __name__ == "__main__":
+    main()
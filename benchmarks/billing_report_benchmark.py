@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parse a synthetic billing report and show that memory use stays flat
+
+The report is generated into a temporary file, then read in chunks the same
+way check_billing reads it from S3.
+
+Usage:
+    billing_report_benchmark.py [--size=<MB>] [--format=<FORMAT>] [--linked-accounts=<N>]
+
+Options:
+  --size=<MB>               Size of the generated report in MB [default: 2048]
+  --format=<FORMAT>         'csv', 'csv.gz', 'xml' or 'xml.gz' [default: csv]
+  --linked-accounts=<N>     Number of distinct linked accounts [default: 5000]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import gzip
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+import _common  # noqa: F401, sets up sys.path
+from ultimate_source_of_accounts.billing_data import read_report_and_return_account_ids, CHUNK_SIZE
+
+CSV_HEADER = "InvoiceID,PayerAccountId,LinkedAccountId,ProductName,UsageType,UsageQuantity,Cost\n"
+CSV_ROW = "{0},999999999999,{1},Amazon Elastic Compute Cloud,EU-BoxUsage:m5.large,{2},{3}\n"
+XML_ROW = ("<LineItem><InvoiceID>{0}</InvoiceID><LinkedAccountId>{1}</LinkedAccountId>"
+           "<UsageQuantity>{2}</UsageQuantity><Cost>{3}</Cost></LineItem>\n")
+
+
+def write_report(path, size, report_format, linked_accounts):
+    row_template = XML_ROW if report_format.startswith("xml") else CSV_ROW
+    opener = gzip.open if report_format.endswith(".gz") else open
+    with opener(path, "wb") as report:
+        report.write(b"<Report>\n" if report_format.startswith("xml") else CSV_HEADER.encode("ascii"))
+        written, row = 0, 0
+        while written < size:
+            lines = "".join(row_template.format(row + offset, 100000000000 + (row + offset) % linked_accounts,
+                                                offset, offset * 0.1)
+                            for offset in range(1000)).encode("ascii")
+            report.write(lines)
+            written += len(lines)
+            row += 1000
+        if report_format.startswith("xml"):
+            report.write(b"</Report>\n")
+
+
+def peak_rss_mb():
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+
+
+def main():
+    arguments = docopt(__doc__)
+    size = int(arguments["--size"]) * 1024 * 1024
+    report_format = arguments["--format"]
+
+    handle, path = tempfile.mkstemp(suffix="." + report_format)
+    os.close(handle)
+    try:
+        write_report(path, size, report_format, int(arguments["--linked-accounts"]))
+        baseline = peak_rss_mb()
+        started = time.time()
+        with open(path, "rb") as report:
+            account_ids = read_report_and_return_account_ids(path, iter(lambda: report.read(CHUNK_SIZE), b""))
+        duration = time.time() - started
+        print("{0} MB {1} report, {2} bytes on disk".format(arguments["--size"], report_format, os.path.getsize(path)))
+        print("{0} linked accounts in {1:.1f}s ({2:.1f} MB/s uncompressed)".format(
+            len(account_ids), duration, size / duration / 1024 / 1024))
+        print("peak RSS grew by {0:.1f} MB while parsing".format(peak_rss_mb() - baseline))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Generate synthetic account data directories for the benchmarks"""
+
+from __future__ import print_function, absolute_import, division
+
+import os
+import random
+
+import yaml
+
+OWNERS = ["team-{0:03d}".format(number) for number in range(50)]
+AUTOMATION_FLAGS = ["backup", "patching", "monitoring", "cost-report", "cleanup"]
+
+
+def make_accounts(number_of_accounts, seed=42):
+    """Return a dict with number_of_accounts realistic looking accounts"""
+    rng = random.Random(seed)
+    accounts = {}
+    for number in range(number_of_accounts):
+        name = "account-{0:06d}".format(number)
+        account = {
+            "id": 100000000000 + number,
+            "email": "aws-{0}@example.invalid".format(name),
+            "owner": rng.choice(OWNERS),
+        }
+        flags = rng.sample(AUTOMATION_FLAGS, rng.randint(0, len(AUTOMATION_FLAGS)))
+        if flags:
+            account["automated"] = dict((flag, rng.random() < 0.5) for flag in flags)
+        accounts[name] = account
+    return accounts
+
+
+def write_inventory(directory, number_of_accounts, number_of_files):
+    """Write number_of_accounts accounts, spread over number_of_files yaml files"""
+    accounts = make_accounts(number_of_accounts)
+    files = [{} for _ in range(number_of_files)]
+    for index, name in enumerate(sorted(accounts)):
+        files[index % number_of_files][name] = accounts[name]
+    for index, content in enumerate(files):
+        file_name = os.path.join(directory, "team-{0:04d}.yaml".format(index))
+        with open(file_name, "w") as yaml_file:
+            yaml.safe_dump(content, yaml_file, default_flow_style=False)
+    return accounts
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure how parsing the data directory scales with the number of workers
+
+Usage:
+    parallel_parse_benchmark.py [--accounts=<N>] [--files=<M>] [--repeat=<R>] [--jobs=<J>...]
+
+Options:
+  --accounts=<N>    Number of generated accounts [default: 10000]
+  --files=<M>       Number of yaml files to spread them over [default: 200]
+  --repeat=<R>      Take the best of R runs [default: 3]
+  --jobs=<J>        Number of worker processes, can be used multiple times [default: 1 2 4 8]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import shutil
+import tempfile
+
+from docopt import docopt
+
+from _common import best_of
+from inventory import write_inventory
+
+from ultimate_source_of_accounts import account_importer
+
+
+def main():
+    arguments = docopt(__doc__)
+    number_of_accounts = int(arguments["--accounts"])
+    number_of_files = int(arguments["--files"])
+    repeat = int(arguments["--repeat"])
+    jobs_to_test = [int(jobs) for value in arguments["--jobs"] for jobs in value.split()]
+
+    directory = tempfile.mkdtemp()
+    try:
+        write_inventory(directory, number_of_accounts, number_of_files)
+        print("{0} accounts in {1} files".format(number_of_accounts, number_of_files))
+        baseline = None
+        for jobs in jobs_to_test:
+            duration = best_of(lambda: account_importer.load_directory(directory, jobs=jobs), repeat)
+            baseline = baseline or duration
+            print("jobs={0:<3d} {1:8.3f}s  speedup {2:5.2f}x".format(jobs, duration, baseline / duration))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare reading the inventory with a cold and a warm parse cache
+
+Usage:
+    parse_cache_benchmark.py [--accounts=<N>] [--files=<M>] [--repeat=<R>]
+
+Options:
+  --accounts=<N>    Number of generated accounts [default: 10000]
+  --files=<M>       Number of yaml files to spread them over [default: 200]
+  --repeat=<R>      Take the best of R runs [default: 3]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import os
+import shutil
+import tempfile
+
+from docopt import docopt
+
+from _common import best_of
+from inventory import write_inventory
+
+from ultimate_source_of_accounts import account_importer
+from ultimate_source_of_accounts.parse_cache import ParseCache
+
+
+def main():
+    arguments = docopt(__doc__)
+    number_of_accounts = int(arguments["--accounts"])
+    number_of_files = int(arguments["--files"])
+    repeat = int(arguments["--repeat"])
+
+    directory = tempfile.mkdtemp()
+    cache_directory = tempfile.mkdtemp()
+    try:
+        inventory = os.path.join(directory, "inventory")
+        os.mkdir(inventory)
+        write_inventory(inventory, number_of_accounts, number_of_files)
+
+        def cold():
+            shutil.rmtree(cache_directory)
+            account_importer.load_directory(inventory, cache=ParseCache(cache_directory))
+
+        cold_time = best_of(cold, repeat)
+        uncached = best_of(lambda: account_importer.load_directory(inventory), repeat)
+        warm = best_of(lambda: account_importer.load_directory(inventory, cache=ParseCache(cache_directory)), repeat)
+
+        print("{0} accounts in {1} files".format(number_of_accounts, number_of_files))
+        print("without cache:        {0:8.3f}s".format(uncached))
+        print("cold cache:           {0:8.3f}s".format(cold_time))
+        print("warm cache:           {0:8.3f}s".format(warm))
+        print("speedup:              {0:8.2f}x".format(uncached / warm))
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(cache_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the single-pass loader with the former double yamlreader parse
+
+yamlreader parses with the pure-Python yaml loader. The single pass is
+timed with that loader too, so the first speedup is only the one of the
+single pass. The speedup of the libyaml loader (if installed) is
+reported separately.
+
+Usage:
+    read_directory_benchmark.py [--accounts=<N>] [--files=<M>] [--repeat=<R>]
+
+Options:
+  --accounts=<N>    Number of generated accounts [default: 10000]
+  --files=<M>       Number of yaml files to spread them over [default: 200]
+  --repeat=<R>      Take the best of R runs [default: 3]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import shutil
+import tempfile
+
+import yaml
+from docopt import docopt
+from mock import patch
+
+from _common import best_of
+from inventory import write_inventory
+
+from ultimate_source_of_accounts import account_importer
+
+
+def double_parse(directory):
+    """The former read_directory: yamlreader parse plus patched second pass"""
+    import yamlreader
+
+    accounts = yamlreader.yaml_load(directory)
+    with patch("yamlreader.yamlreader.data_merge") as mock_data_merge:
+        yamlreader.yaml_load(directory)
+    names = set()
+    for args, _ in mock_data_merge.call_args_list:
+        names.update(args[1].keys())
+    return accounts
+
+
+def main():
+    arguments = docopt(__doc__)
+    number_of_accounts = int(arguments["--accounts"])
+    number_of_files = int(arguments["--files"])
+    repeat = int(arguments["--repeat"])
+
+    directory = tempfile.mkdtemp()
+    try:
+        write_inventory(directory, number_of_accounts, number_of_files)
+        with patch.object(account_importer, "SafeLoader", yaml.SafeLoader):
+            single = best_of(lambda: account_importer.load_directory(directory), repeat)
+        print("{0} accounts in {1} files".format(number_of_accounts, number_of_files))
+        print("single pass, Python loader:   {0:8.3f}s".format(single))
+        try:
+            double = best_of(lambda: double_parse(directory), repeat)
+        except ImportError:
+            print("yamlreader not installed, skipping the double parse")
+        else:
+            print("yamlreader twice:             {0:8.3f}s".format(double))
+            print("speedup of the single pass:   {0:8.2f}x".format(double / single))
+
+        if getattr(yaml, "CSafeLoader", None) is None:
+            print("libyaml not available, skipping the libyaml loader")
+        else:
+            with patch.object(account_importer, "SafeLoader", yaml.CSafeLoader):
+                libyaml = best_of(lambda: account_importer.load_directory(directory), repeat)
+            print("single pass, libyaml loader:  {0:8.3f}s".format(libyaml))
+            print("speedup of libyaml:           {0:8.2f}x".format(single / libyaml))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
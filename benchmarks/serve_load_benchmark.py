@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of the serve subcommand: requests per second and latency percentiles
+
+Without --url, a server with generated accounts is started in this
+process, its request threads then compete with the clients for the GIL.
+Every client thread keeps one connection open and looks up random ids,
+names and owners, a share of the requests revalidates with If-None-Match.
+
+Usage:
+    serve_load_benchmark.py [--url=<URL>] [--accounts=<N>] [--clients=<C>] [--requests=<R>]
+    [--revalidate=<F>]
+
+Options:
+  --url=<URL>           Base URL of a running server, e.g. http://127.0.0.1:8080
+  --accounts=<N>        Number of generated accounts for the in-process server [default: 10000]
+  --clients=<C>         Number of concurrent client threads [default: 8]
+  --requests=<R>        Requests per client [default: 2000]
+  --revalidate=<F>      Fraction of requests sent with a matching If-None-Match [default: 0.5]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import json
+import random
+import threading
+import time
+
+from docopt import docopt
+from six.moves import http_client
+from six.moves.urllib.parse import quote, urlsplit
+
+import _common  # noqa: F401, sets up sys.path
+from inventory import make_accounts
+
+from ultimate_source_of_accounts.account import Account
+from ultimate_source_of_accounts.account_converter import index_key
+from ultimate_source_of_accounts.server import AccountServer
+
+
+def lookup_paths(host, port):
+    """Return the by-id, by-name and by-owner paths of all served accounts"""
+    connection = http_client.HTTPConnection(host, port)
+    connection.request("GET", "/accounts.json")
+    accounts = json.loads(connection.getresponse().read().decode('utf-8'))
+    connection.close()
+    paths = set()
+    for name, account in accounts.items():
+        paths.update("/" + quote(index_key(prefix, value))
+                     for prefix, value in (("by-id/", account['id']), ("by-name/", name),
+                                           ("by-owner/", account['owner'])))
+    return sorted(paths)
+
+
+def client(host, port, paths, number_of_requests, revalidate, latencies, seed):
+    rng = random.Random(seed)
+    etags = {}
+    connection = http_client.HTTPConnection(host, port)
+    for _ in range(number_of_requests):
+        path = rng.choice(paths)
+        headers = {"If-None-Match": etags[path]} if path in etags and rng.random() < revalidate else {}
+        started = time.time()
+        connection.request("GET", path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.time() - started)
+        etags[path] = response.getheader("ETag")
+    connection.close()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def main():
+    arguments = docopt(__doc__)
+    number_of_clients = int(arguments["--clients"])
+    number_of_requests = int(arguments["--requests"])
+    revalidate = float(arguments["--revalidate"])
+
+    server = None
+    if arguments["--url"]:
+        url = urlsplit(arguments["--url"])
+        host, port = url.hostname, url.port or 80
+    else:
+        accounts = dict((name, Account.from_dict(data))
+                        for name, data in make_accounts(int(arguments["--accounts"])).items())
+        server = AccountServer("127.0.0.1:0", accounts)
+        threading.Thread(target=server.serve_forever).start()
+        host, port = server.server_address[:2]
+
+    try:
+        paths = lookup_paths(host, port)
+        latencies = []
+        clients = [threading.Thread(target=client, args=(host, port, paths, number_of_requests, revalidate,
+                                                         latencies, seed))
+                   for seed in range(number_of_clients)]
+        started = time.time()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        seconds = time.time() - started
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    latencies.sort()
+    print("{0} clients, {1} requests in {2:.2f}s".format(number_of_clients, len(latencies), seconds))
+    print("requests per second: {0:10.0f}".format(len(latencies) / seconds))
+    for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        print("{0} latency:        {1:10.2f}ms".format(label, percentile(latencies, fraction) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the concurrent setup_infrastructure with running the steps one by one
+
+Runs against moto, every AWS request is delayed to simulate network latency.
+
+Usage:
+    setup_infrastructure_benchmark.py [--latency=<MS>] [--repeat=<R>]
+
+Options:
+  --latency=<MS>    Simulated latency per AWS request in milliseconds [default: 50]
+  --repeat=<R>      Take the best of R runs, after one warm-up run [default: 3]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import itertools
+import os
+import time
+
+from docopt import docopt
+from moto import mock_s3, mock_sns
+
+from _common import best_of
+from ultimate_source_of_accounts.account_exporter import S3Uploader
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+
+def add_latency(uploader, seconds):
+    def sleep(**kwargs):
+        time.sleep(seconds)
+    for client in (uploader.boto3_s3_client, uploader.boto3_sns_client):
+        client.meta.events.register("before-send", sleep)
+
+
+def run_sequentially(uploader):
+    topic_arn = uploader.create_sns_topic()
+    uploader.set_sns_topic_policy(topic_arn)
+    uploader.create_S3_bucket()
+    uploader.set_S3_permissions()
+    uploader.setup_S3_webserver()
+    uploader.enable_bucket_notifications(topic_arn)
+
+
+BUCKET_NUMBERS = itertools.count()
+
+
+def create_uploader(latency):
+    bucket_name = "benchmark-bucket-{0}".format(next(BUCKET_NUMBERS))
+    uploader = S3Uploader(bucket_name, allowed_ips=["10.0.0.1"], allowed_aws_account_ids=["123456789012"])
+    add_latency(uploader, latency)
+    return uploader
+
+
+def measure(function, latency, repeat):
+    """Return the best time of function(uploader) after one warm-up run
+
+    Every run sets up a new bucket, the uploaders are created beforehand so
+    that only the setup itself is timed.
+    """
+    uploaders = iter([create_uploader(latency) for _ in range(repeat + 1)])
+    function(next(uploaders))
+    return best_of(lambda: function(next(uploaders)), repeat)
+
+
+@mock_s3
+@mock_sns
+def main():
+    arguments = docopt(__doc__)
+    latency = int(arguments["--latency"]) / 1000
+    repeat = int(arguments["--repeat"])
+
+    sequential = measure(run_sequentially, latency, repeat)
+    concurrent = measure(lambda uploader: uploader.setup_infrastructure(), latency, repeat)
+    print("simulated latency per request: {0:.0f}ms".format(latency * 1000))
+    print("steps one by one:  {0:8.3f}s".format(sequential))
+    print("concurrent:        {0:8.3f}s".format(concurrent))
+    print("speedup:           {0:8.2f}x".format(sequential / concurrent))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the start of ultimate-source-of-accounts with python -X importtime
+
+Runs the CLI in fresh interpreters. For the arguments in startup_budget.json
+the result is checked against the budget there, which the unit tests
+enforce as well. Needs Python 3.7 or later.
+
+Usage:
+    startup_benchmark.py [--arguments=<ARGS>] [--repeat=<R>] [--top=<N>]
+
+Options:
+  --arguments=<ARGS>    Command line arguments of the CLI [default: --help]
+  --repeat=<R>          Take the best of R runs [default: 5]
+  --top=<N>             Show the N modules with the largest cumulative import time [default: 10]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import json
+import os
+import subprocess
+import sys
+
+from docopt import docopt
+
+import _common
+
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json")
+RUN_CLI = "import sys, ultimate_source_of_accounts.cli as cli; sys.argv[0] = 'ultimate-source-of-accounts'; cli.main()"
+
+
+def import_times(arguments):
+    """Return a dict module name -> cumulative import time in microseconds"""
+    env = dict(os.environ, PYTHONPATH=_common.SOURCE_DIR)
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", RUN_CLI] + arguments,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    _, stderr = process.communicate()
+    times = {}
+    for line in stderr.decode("utf-8").splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    arguments = docopt(__doc__)
+    cli_arguments = arguments["--arguments"].split()
+    repeat = int(arguments["--repeat"])
+    with open(BUDGET_FILE) as budget_file:
+        budget = json.load(budget_file)
+
+    runs = [import_times(cli_arguments) for _ in range(repeat)]
+    best = min(runs, key=lambda times: times.get(budget["module"], 0))
+    import_time_ms = best[budget["module"]] / 1000
+    forbidden = sorted(set(best) & set(budget["forbidden_modules"]))
+    enforce = cli_arguments == budget["arguments"]
+
+    print("ultimate-source-of-accounts {0}".format(" ".join(cli_arguments)))
+    for name, cumulative in sorted(best.items(), key=lambda item: -item[1])[:int(arguments["--top"])]:
+        print("  {0:>8.1f}ms  {1}".format(cumulative / 1000, name))
+    print("import of {0}: {1:.1f}ms, budget {2}ms".format(
+        budget["module"], import_time_ms, budget["max_import_time_ms"]))
+    if enforce:
+        print("forbidden modules imported: {0}".format(", ".join(forbidden) or "none"))
+        if import_time_ms > budget["max_import_time_ms"] or forbidden:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare peak memory of in-memory and streaming conversion plus upload
+
+Every mode runs in a fresh process, uploads go to an S3 stand-in that reads
+and discards the bodies. Reports how much the peak RSS grew beyond the
+memory needed for the account data itself.
+
+Usage:
+    streaming_memory_benchmark.py [--accounts=<N>]
+    streaming_memory_benchmark.py --mode=<MODE> --accounts=<N>
+
+Options:
+  --accounts=<N>    Number of generated accounts [default: 100000]
+  --mode=<MODE>     Run one mode, 'in-memory' or 'streaming'
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import resource
+import subprocess
+import sys
+import time
+
+from botocore.exceptions import ClientError
+from docopt import docopt
+
+import _common  # noqa: F401, sets up sys.path
+from inventory import make_accounts
+
+from ultimate_source_of_accounts import account_converter
+from ultimate_source_of_accounts.account_exporter import S3Uploader
+
+
+class DiscardingS3Client(object):
+    """Stands in for the S3 client, bodies are read and thrown away"""
+    def head_object(self, **kwargs):
+        raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+    def put_object(self, Body, **kwargs):
+        len(Body)
+
+    def upload_fileobj(self, body, bucket_name, key_name, **kwargs):
+        while body.read(8 * 1024 * 1024):
+            pass
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS.
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+
+
+def run_mode(mode, number_of_accounts):
+    accounts = make_accounts(number_of_accounts)
+    for account in accounts.values():
+        account["id"] = str(account["id"])
+    baseline = peak_rss_mb()
+
+    uploader = S3Uploader("benchmark-bucket")
+    uploader.boto3_s3_client = DiscardingS3Client()
+    started = time.time()
+    if mode == "in-memory":
+        uploader.upload_to_S3(account_converter.get_converted_aws_accounts(accounts))
+    else:
+        uploader.upload_to_S3(account_converter.get_streaming_aws_accounts(accounts))
+    print("{0:<10} {1:8.3f}s  peak RSS +{2:7.1f} MB".format(mode, time.time() - started, peak_rss_mb() - baseline))
+
+
+def main():
+    arguments = docopt(__doc__)
+    number_of_accounts = int(arguments["--accounts"])
+    if arguments["--mode"]:
+        run_mode(arguments["--mode"], number_of_accounts)
+        return
+
+    print("{0} accounts".format(number_of_accounts))
+    for mode in ("in-memory", "streaming"):
+        subprocess.check_call([sys.executable, __file__, "--mode=" + mode, "--accounts=%d" % number_of_accounts])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time the whole pipeline on a synthetic inventory and compare the results of two commits
+
+"run" times reading, checking, converting and the full upload (against
+moto) and writes the results with the current commit to a JSON file. Run
+it on both commits with the same options, then "compare" the two files.
+
+Usage:
+    suite.py run [--accounts=<N>] [--files=<M>] [--repeat=<R>] [--output=<results-file>]
+    suite.py compare <baseline-file> <results-file> [--threshold=<T>]
+
+Options:
+  --accounts=<N>            Number of generated accounts [default: 10000]
+  --files=<M>               Number of yaml files to spread them over [default: 200]
+  --repeat=<R>              Take the best of R runs [default: 3]
+  --output=<results-file>   Write the results as JSON to this file
+  --threshold=<T>           Flag benchmarks that got slower by more than this fraction [default: 0.1]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import collections
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+from moto import mock_s3, mock_sns
+
+from _common import best_of, SOURCE_DIR
+from inventory import write_inventory
+
+from ultimate_source_of_accounts import account_importer, cli
+from ultimate_source_of_accounts.account_converter import get_converted_aws_accounts
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+RESULTS_VERSION = 1
+
+
+def benchmarks(directory):
+    """Return name -> function of all benchmarks, in the order they run"""
+    accounts = account_importer.read_directory(directory)
+
+    @mock_s3
+    @mock_sns
+    def upload():
+        cli.upload(directory, ["benchmark-bucket"], allowed_ips=["10.0.0.1"])
+
+    return collections.OrderedDict([
+        ("read_directory", lambda: account_importer.read_directory(directory)),
+        ("check_account_data", lambda: account_importer._check_account_data(accounts)),
+        ("get_converted_aws_accounts", lambda: get_converted_aws_accounts(accounts)),
+        ("cli.upload", upload),
+    ])
+
+
+def run(number_of_accounts, number_of_files, repeat):
+    directory = tempfile.mkdtemp()
+    try:
+        write_inventory(directory, number_of_accounts, number_of_files)
+        results = collections.OrderedDict()
+        for name, function in benchmarks(directory).items():
+            results[name] = best_of(function, repeat)
+            print("{0:<30} {1:>10.3f}s".format(name, results[name]))
+    finally:
+        shutil.rmtree(directory)
+    return {
+        'version': RESULTS_VERSION,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'parameters': {'accounts': number_of_accounts, 'files': number_of_files, 'repeat': repeat},
+        'results': results,
+    }
+
+
+def git_commit():
+    """Return the checked out commit, with '-dirty' if there are local changes, or None"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=SOURCE_DIR).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=SOURCE_DIR) != 0
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def compare(baseline, current, threshold):
+    """Print both results side by side, return the names of the regressions"""
+    if baseline['parameters'] != current['parameters']:
+        print("warning: the results were taken with different parameters: {0} vs {1}".format(
+            baseline['parameters'], current['parameters']))
+    print("baseline: {0}, current: {1}".format(baseline['commit'], current['commit']))
+    print("{0:<30} {1:>10} {2:>10} {3:>9}".format("benchmark", "baseline", "current", "change"))
+    regressions = []
+    for name, seconds in current['results'].items():
+        if name not in baseline['results']:
+            print("{0:<30} {1:>10} {2:>9.3f}s".format(name, "-", seconds))
+            continue
+        change = seconds / baseline['results'][name] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{0:<30} {1:>9.3f}s {2:>9.3f}s {3:>+8.1%}{4}".format(
+            name, baseline['results'][name], seconds, change, flag))
+    return regressions
+
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments["run"]:
+        results = run(int(arguments["--accounts"]), int(arguments["--files"]), int(arguments["--repeat"]))
+        if arguments["--output"]:
+            with open(arguments["--output"], "w") as target:
+                json.dump(results, target, indent=2)
+                target.write("\n")
+    else:
+        with open(arguments["<baseline-file>"]) as source:
+            baseline = json.load(source, object_pairs_hook=collections.OrderedDict)
+        with open(arguments["<results-file>"]) as source:
+            current = json.load(source, object_pairs_hook=collections.OrderedDict)
+        regressions = compare(baseline, current, float(arguments["--threshold"]))
+        if regressions:
+            print("{0} of {1} benchmarks regressed: {2}".format(
+                len(regressions), len(current['results']), ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Show that validating all accounts scales linearly with the number of accounts
+
+Usage:
+    validation_benchmark.py [--sizes=<SIZES>] [--error-rate=<R>] [--repeat=<R>]
+
+Options:
+  --sizes=<SIZES>       Comma separated numbers of generated accounts [default: 1000,10000,100000]
+  --error-rate=<R>      Fraction of accounts with a problem [default: 0.01]
+  --repeat=<R>          Take the best of R runs [default: 3]
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import random
+
+from docopt import docopt
+
+from _common import best_of
+from inventory import make_accounts
+
+from ultimate_source_of_accounts.validation import validate_accounts
+
+
+def make_invalid_accounts(number_of_accounts, error_rate, seed=42):
+    """Return make_accounts() with some ids, emails and owners broken"""
+    rng = random.Random(seed)
+    accounts = make_accounts(number_of_accounts, seed)
+    names = sorted(accounts)
+    for account in accounts.values():
+        account["id"] = str(account["id"])
+    for name in rng.sample(names, int(number_of_accounts * error_rate)):
+        problem = rng.choice(("id", "email", "owner"))
+        if problem == "id":
+            accounts[name]["id"] = accounts[rng.choice(names)]["id"]
+        elif problem == "email":
+            accounts[name]["email"] = "no-at-sign"
+        else:
+            del accounts[name]["owner"]
+    return accounts
+
+
+def main():
+    arguments = docopt(__doc__)
+    sizes = [int(size) for size in arguments["--sizes"].split(",")]
+    error_rate = float(arguments["--error-rate"])
+    repeat = int(arguments["--repeat"])
+
+    print("{0:>10} {1:>10} {2:>10} {3:>14}".format("accounts", "errors", "seconds", "us/account"))
+    for size in sizes:
+        accounts = make_invalid_accounts(size, error_rate)
+        errors = len(validate_accounts(accounts).errors)
+        seconds = best_of(lambda: validate_accounts(accounts), repeat)
+        print("{0:>10} {1:>10} {2:>10.3f} {3:>14.2f}".format(size, errors, seconds, seconds / size * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -24,17 +24,14 @@ def set_properties(project):
     project.set_property('cram_run_test_from_target', False)
     # Ensure we have assertLogs
     project.build_depends_on("unittest2>=0.7")
-    project.depends_on("mock")
-    project.depends_on("yamlreader")
+    project.build_depends_on("mock")
     project.depends_on("pyyaml")
-    # pin moto and boto dependencies due to https://github.com/spulec/moto/issues/1793#issue-354038417
-    project.depends_on("moto==1.3.6")
-    project.depends_on("boto3==1.7.84")
-    project.depends_on("botocore==1.10.84")
+    project.build_depends_on("moto>=1.3.14,<5")
+    # Retry modes in botocore.config.Config need botocore 1.15.
+    project.depends_on("boto3>=1.12")
+    project.depends_on("botocore>=1.15")
     project.depends_on("docopt")
     project.depends_on("six")
-    project.depends_on("python-dateutil<2.7.0")
-    project.depends_on("docutils==0.14")
 
     project.set_property('distutils_console_scripts', ['ultimate-source-of-accounts=ultimate_source_of_accounts.cli:main'])
     project.set_property('flake8_break_build', True)
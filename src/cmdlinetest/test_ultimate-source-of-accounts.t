@@ -7,18 +7,40 @@
   Tool to upload/check a list of your AWS accounts to an S3 bucket
   
   Usage:
+      ultimate-source-of-accounts serve (--import=<data-directory> | <destination-bucket-name>) [--listen=<address>]
+      [--jobs=<N>] [--no-cache] [--verbose] [--metrics=<target>]
       ultimate-source-of-accounts --import=<data-directory> [--organization-id=<ORG_ID>...] [--allowed-ip=<IP>...]
-      <destination-bucket-name> [--verbose]
+      [--jobs=<N>] [--no-cache] [--gzip] [--indexes]
+      [[--snapshots] [--change-events] [--watch] | --plan=<plan-file> | --apply=<plan-file>]
+      <destination-bucket-name>... [--verbose] [--metrics=<target>]
+      ultimate-source-of-accounts --import=<data-directory> --validate-only [--json] [--jobs=<N>] [--no-cache]
+      [--verbose] [--metrics=<target>]
       ultimate-source-of-accounts --check-billing=<billing-bucket-name> <destination-bucket-name> [--verbose]
+      [--metrics=<target>]
   
   Options:
     -h --help                             Show this.
     --allowed-ip=IP                       IP with access to the destination bucket, can be used multiple times
     --organization-id=ORG_ID              AWS Org ID instead of individual account IDs, can be used multiple times
-    --check-billing=<billing-bucket-name> Check Billing account
+    --check-billing=<billing-bucket-name> Compare the latest billing report with the published accounts
     -v --verbose                          Log more stuff
     --import=<data-directory>             Import account list from directory
-    <destination-bucket-name>             Target bucket
+    --jobs=<N>                            Parse the data directory with N worker processes [default: 1]
+    --no-cache                            Parse all files, do not use ~/.cache/ultimate-source-of-accounts
+    --gzip                                Store the objects gzip compressed, with 'Content-Encoding: gzip'
+    --indexes                             Also publish by-id/, by-name/ and by-owner/ lookup objects
+    --snapshots                           Also publish snapshots/<version>.json, deltas/ from the previous version
+                                          and the pointer latest.json
+    --change-events                       Publish an SNS message per added, removed or modified account
+    --watch                               Keep running and publish again whenever the data directory changes
+    --plan=<plan-file>                    Only read the current state, write the changes to make as JSON ('-': stdout)
+    --apply=<plan-file>                   Make the changes of a --plan for the same data, options and destinations
+    --validate-only                       Report every problem in the data directory, do not publish anything
+    --json                                Print the --validate-only report as JSON
+    --metrics=<target>                    Report timings and counters as JSON lines to a file ('-': stderr),
+                                          or to statsd://<host>:<port>
+    --listen=<address>                    Serve the accounts over HTTP on [<host>:]<port> [default: 127.0.0.1:8080]
+    <destination-bucket-name>             Target bucket, as <bucket>[@<region>], the default region is eu-west-1
   
   [1]
 
@@ -29,3 +51,9 @@
  Return code must not be 0 when invalid options are used
   $ ultimate-source-of-accounts --invalid --options --must --be-errors >/dev/null 2>/dev/null
   [1]
+
+ --jobs must be a positive integer
+  $ ultimate-source-of-accounts --import=/tmp --validate-only --jobs=0 | head -1
+  --jobs must be a positive integer, not '0'
+  $ ultimate-source-of-accounts --import=/tmp --validate-only --jobs=abc >/dev/null
+  [1]
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""Compact in-memory representation of a single AWS account"""
+
+from __future__ import print_function, absolute_import, division
+
+FIELDS = ('id', 'email', 'owner', 'automated')
+
+
+class _Missing(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+class Account(object):
+    """One AWS account, as defined in the yaml files
+
+    The known fields are stored in slots, all other fields in the dict
+    extra (None if there are none). That needs a fraction of the memory of
+    one dict per account. Fields that are not defined are MISSING. The id
+    is converted to a string once, when the account is created. Accounts
+    can be read like the plain dicts they replace and compare equal to
+    them, but are not meant to be modified.
+    """
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, account_id=MISSING, email=MISSING, owner=MISSING, automated=MISSING, extra=None):
+        if account_id is not MISSING and account_id is not None:
+            account_id = str(account_id)
+        self.id = account_id
+        self.email = email
+        self.owner = owner
+        self.automated = automated
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, data):
+        extra_keys = set(data).difference(FIELDS)
+        extra = dict((key, data[key]) for key in extra_keys) if extra_keys else None
+        return cls(account_id=data.get('id', MISSING),
+                   email=data.get('email', MISSING),
+                   owner=data.get('owner', MISSING),
+                   automated=data.get('automated', MISSING),
+                   extra=extra)
+
+    def to_json_obj(self):
+        """Return the account as a new dict, as it is written to accounts.json"""
+        obj = dict(self.extra) if self.extra else {}
+        for field in FIELDS:
+            value = getattr(self, field)
+            if value is not MISSING:
+                obj[field] = value
+        return obj
+
+    def to_yaml_obj(self):
+        """Return the account as a new dict, as it is written to accounts.yaml
+
+        Nested values are not copied, so objects shared between accounts
+        are still written with yaml anchors and aliases.
+        """
+        return self.to_json_obj()
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            value = getattr(self, key)
+            if value is not MISSING:
+                return value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in FIELDS:
+            value = getattr(self, key)
+            return default if value is MISSING else value
+        return self.extra.get(key, default) if self.extra else default
+
+    def __contains__(self, key):
+        if key in FIELDS:
+            return getattr(self, key) is not MISSING
+        return bool(self.extra) and key in self.extra
+
+    def keys(self):
+        return list(self.to_json_obj().keys())
+
+    def values(self):
+        return list(self.to_json_obj().values())
+
+    def items(self):
+        return list(self.to_json_obj().items())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, Account):
+            return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+        if isinstance(other, dict):
+            return self.to_json_obj() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Account({0!r})".format(self.to_json_obj())
+
+
+def json_default(value):
+    """Use as json default= hook, returns the dict of an Account"""
+    if isinstance(value, Account):
+        return value.to_json_obj()
+    raise TypeError("{0!r} is not JSON serializable".format(value))
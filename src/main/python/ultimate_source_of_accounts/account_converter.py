@@ -2,12 +2,33 @@
 """Convert AWS account information from internal to external format"""
 
 from __future__ import print_function, absolute_import, division
+import functools
 import yaml
 import json
 import logging
 
+import six
+from six.moves.urllib.parse import quote
+
+from ultimate_source_of_accounts.account import Account, json_default
+from ultimate_source_of_accounts.metrics import METRICS, _clock
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
 
 FILENAME = "accounts"
+# libyaml and the pure-Python emitter fold long lines differently. Never
+# folding keeps the output byte-identical with either of them.
+YAML_WIDTH = 2 ** 31 - 1
+INDEX_PREFIXES = ("by-id/", "by-name/", "by-owner/")
+# Approximate size of the chunks produced by the streaming conversion.
+CHUNK_SIZE = 64 * 1024
+# Accounts per yaml.dump() call of the streaming conversion, each call has a
+# considerable fixed cost.
+YAML_BATCH_SIZE = 200
 
 
 def get_converted_aws_accounts(accounts):
@@ -17,11 +38,148 @@ def get_converted_aws_accounts(accounts):
     uploading to S3, these become "S3 key" -> "S3 value" pairs.
     """
     try:
-        yaml_data = yaml.dump(accounts, indent=2, default_flow_style=False)
-        json_data = json.dumps(accounts, sort_keys=True, indent=2)
+        with METRICS.span('convert', key=FILENAME + ".yaml") as tags:
+            yaml_data = yaml.dump(_yaml_objs(accounts), Dumper=SafeDumper, indent=2, default_flow_style=False,
+                                  width=YAML_WIDTH)
+            tags['bytes'] = len(yaml_data)
+        with METRICS.span('convert', key=FILENAME + ".json") as tags:
+            json_data = json.dumps(accounts, sort_keys=True, indent=2, default=json_default)
+            tags['bytes'] = len(json_data)
+        with METRICS.span('convert', key=FILENAME + ".min.json") as tags:
+            minified_json_data = json.dumps(accounts, sort_keys=True, separators=(',', ':'), default=json_default)
+            tags['bytes'] = len(minified_json_data)
     except Exception as exc:
         raise Exception("Failed to convert to yaml and json: {0}".format(exc))
     logging.debug("Data successfully converted to yaml and json")
 
     return {FILENAME + ".yaml": yaml_data,
-            FILENAME + ".json": json_data}
+            FILENAME + ".json": json_data,
+            FILENAME + ".min.json": minified_json_data}
+
+
+def get_streaming_aws_accounts(accounts):
+    """Return converted AWS account data without building it in memory.
+
+    Produces a dictionary of "file name" -> function pairs. Each call of a
+    function returns a new iterator over chunks of the file content. The
+    joined chunks are byte-identical to get_converted_aws_accounts().
+    """
+    return {FILENAME + ".yaml": functools.partial(_stream, FILENAME + ".yaml", _yaml_chunks, accounts),
+            FILENAME + ".json": functools.partial(_stream, FILENAME + ".json", _json_chunks, accounts, indent=2),
+            FILENAME + ".min.json": functools.partial(_stream, FILENAME + ".min.json", _json_chunks, accounts,
+                                                      separators=(',', ':'))}
+
+
+def _stream(key, chunk_generator, accounts, **kwargs):
+    """Yield the chunks, timing only their generation and not the consumer"""
+    seconds, size, chunks = 0, 0, 0
+    try:
+        pieces = _batch(chunk_generator(accounts, **kwargs))
+        while True:
+            started = _clock()
+            chunk = next(pieces, None)
+            seconds += _clock() - started
+            if chunk is None:
+                break
+            size += len(chunk)
+            chunks += 1
+            yield chunk
+    except Exception as exc:
+        raise Exception("Failed to convert to yaml and json: {0}".format(exc))
+    METRICS.timing('convert', seconds, key=key, bytes=size, chunks=chunks)
+
+
+def _batch(pieces):
+    """Join small pieces into chunks of about CHUNK_SIZE characters"""
+    buffered, size = [], 0
+    for piece in pieces:
+        buffered.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield "".join(buffered)
+            buffered, size = [], 0
+    if buffered:
+        yield "".join(buffered)
+
+
+def _json_chunks(accounts, **kwargs):
+    return json.JSONEncoder(sort_keys=True, default=json_default, **kwargs).iterencode(accounts)
+
+
+def _yaml_chunks(accounts):
+    """Dump the accounts in batches, in the order yaml.dump sorts them
+
+    A document that contains the same object twice gets anchors and
+    aliases, which only works when dumping it as a whole.
+    """
+    dump = functools.partial(yaml.dump, Dumper=SafeDumper, indent=2, default_flow_style=False, width=YAML_WIDTH)
+    if not accounts or _has_shared_objects(accounts):
+        yield dump(_yaml_objs(accounts))
+        return
+    names = sorted(accounts)
+    for start in range(0, len(names), YAML_BATCH_SIZE):
+        yield dump(dict((name, _yaml_obj(accounts[name])) for name in names[start:start + YAML_BATCH_SIZE]))
+
+
+def _yaml_objs(accounts):
+    return dict((name, _yaml_obj(account)) for name, account in accounts.items())
+
+
+def _yaml_obj(account):
+    return account.to_yaml_obj() if isinstance(account, Account) else account
+
+
+def _has_shared_objects(data):
+    seen = set()
+    pending = [data]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, Account):
+            children = [getattr(value, slot) for slot in Account.__slots__]
+        elif isinstance(value, dict):
+            children = list(value.values())
+        elif isinstance(value, list):
+            children = value
+        else:
+            continue
+        if id(value) in seen:
+            return True
+        seen.add(id(value))
+        pending.extend(children)
+    return False
+
+
+def index_key(prefix, value):
+    """Return the key of the index object of value below prefix, e.g. by-owner/team%2Fx.json
+
+    value is percent-encoded as UTF-8, so a '/' does not nest the key,
+    characters like spaces, '?' or '#' can be fetched from the website
+    endpoint, and different values never share a key.
+    """
+    return "{0}{1}.json".format(prefix, quote(six.text_type(value).encode('utf-8'), safe=''))
+
+
+def get_index_objects(accounts):
+    """Return small lookup objects for single accounts and owners.
+
+    Produces a dictionary of "S3 key" -> "S3 value" pairs: by-id/<id>.json
+    and by-name/<name>.json contain one account, by-owner/<owner>.json all
+    accounts of that owner, with the id, name or owner encoded by
+    index_key(). Each object has the same structure as accounts.json, so
+    consumers can resolve an id, name or owner without downloading the
+    whole list.
+    """
+    index = {}
+    accounts_by_owner = {}
+    for name, account in accounts.items():
+        index[index_key("by-id/", account['id'])] = {name: account}
+        index[index_key("by-name/", name)] = {name: account}
+        accounts_by_owner.setdefault(account['owner'], {})[name] = account
+    for owner, owner_accounts in accounts_by_owner.items():
+        index[index_key("by-owner/", owner)] = owner_accounts
+
+    try:
+        return dict((key, json.dumps(value, sort_keys=True, indent=2, default=json_default))
+                    for key, value in index.items())
+    except Exception as exc:
+        raise Exception("Failed to convert index objects to json: {0}".format(exc))
@@ -1,42 +1,290 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function, absolute_import, division
+import contextlib
+import gzip
+import hashlib
 import json
 import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import boto3
+import six
+from boto3.s3.transfer import TransferConfig
+from six import BytesIO
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from ultimate_source_of_accounts.account_converter import FILENAME, INDEX_PREFIXES
+from ultimate_source_of_accounts.change_events import account_changes, batch_entries
+from ultimate_source_of_accounts.metrics import METRICS, instrument_client
+from ultimate_source_of_accounts.snapshots import (
+    LATEST_KEY, SNAPSHOT_PREFIX, delta_key, make_patch, snapshot_body, snapshot_key, snapshot_pointer, version_of)
 
 BUCKET_REGION = "eu-west-1"
+# User metadata on every uploaded object, used to skip unchanged uploads.
+CONTENT_HASH_METADATA = "content-sha256"
+# Uploads are serialized into memory up to this size, larger ones are
+# spooled to a temporary file.
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=SPOOL_MAX_SIZE, multipart_chunksize=SPOOL_MAX_SIZE)
+# Number of concurrent uploads of index objects, below the default
+# connection pool size of boto3 clients.
+INDEX_UPLOAD_THREADS = 8
+# Used for every client of an S3Uploader, a config passed to it is merged
+# into this one. The connection pool is large enough for the index upload
+# threads plus the threads of a multipart transfer.
+CLIENT_CONFIG = Config(max_pool_connections=INDEX_UPLOAD_THREADS + TRANSFER_CONFIG.max_request_concurrency,
+                       retries={'mode': 'standard', 'max_attempts': 5},
+                       connect_timeout=10,
+                       read_timeout=60)
+# Creating clients from one boto3 session is not thread safe.
+_CLIENT_LOCK = threading.Lock()
+# S3 allows to delete at most this many keys with one request.
+DELETE_BATCH_SIZE = 1000
+# Steps of setup_infrastructure that may change something, in order.
+INFRASTRUCTURE_STEPS = ['set_sns_topic_policy', 'create_S3_bucket', 'set_S3_permissions',
+                        'setup_S3_webserver', 'enable_bucket_notifications']
+ACCOUNT_ID_PATTERN = re.compile(r"^\d{12}$")
+
+
+def policies_are_equal(first, second):
+    """Return True if both IAM policy documents grant the same permissions"""
+    return _normalize_policy(first) == _normalize_policy(second)
+
+
+def _normalize_policy(value):
+    """Bring an IAM policy document into a canonical form
+
+    AWS rewrites policies when storing them: account ids in principals
+    become root ARNs, and lists with one element become plain strings.
+    The order of list elements has no meaning in a policy.
+    """
+    if isinstance(value, dict):
+        return dict((key, _normalize_policy(item)) for key, item in value.items())
+    if isinstance(value, list):
+        items = sorted((_normalize_policy(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+        return items[0] if len(items) == 1 else items
+    if isinstance(value, six.string_types) and ACCOUNT_ID_PATTERN.match(value):
+        return "arn:aws:iam::{0}:root".format(value)
+    return value
+
+
+class SpooledContent(object):
+    """Content serialized once, to be uploaded to several buckets
+
+    content is text, bytes, or a function returning an iterable of text or
+    bytes chunks, like the values of S3Uploader.upload_to_S3(). It is gzip
+    compressed if compress is True, content_hash is the SHA-256 of the
+    uncompressed content. Up to SPOOL_MAX_SIZE bytes are kept in memory,
+    larger content is written to a temporary file. Each open() returns a
+    new file object at the start, so several threads can upload the same
+    content at once. close() removes the temporary file.
+    """
+    def __init__(self, content, compress=False):
+        self.compress = compress
+        self.size = 0
+        self._buffer = BytesIO()
+        self._file = None
+        self._file_name = None
+        digest = hashlib.sha256()
+        try:
+            target = gzip.GzipFile(filename='', mode='wb', fileobj=self, mtime=0) if compress else self
+            for chunk in content() if callable(content) else [content]:
+                if isinstance(chunk, six.text_type):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+                target.write(chunk)
+            if target is not self:
+                target.close()
+            if self._file is not None:
+                self._file.close()
+        except Exception:
+            self.close()
+            raise
+        self.content_hash = digest.hexdigest()
+
+    def write(self, data):
+        """Append data while spooling, moving to a temporary file above SPOOL_MAX_SIZE"""
+        self.size += len(data)
+        if self._file is None and self.size > SPOOL_MAX_SIZE:
+            self._file = tempfile.NamedTemporaryFile(prefix='usofa-', delete=False)
+            self._file_name = self._file.name
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+        (self._file if self._file is not None else self._buffer).write(data)
+
+    def open(self):
+        if self._file_name is None:
+            return BytesIO(self._buffer.getvalue())
+        return open(self._file_name, 'rb')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._file_name is not None and os.path.exists(self._file_name):
+            os.remove(self._file_name)
+
+
+@contextlib.contextmanager
+def spooled_upload_data(upload_data, compress=False):
+    """Spool every value of upload_data once, see SpooledContent
+
+    The spooled data can be passed to upload_to_S3(), plan() and apply() of
+    all S3Uploaders with the same compress setting, the content is then
+    serialized and hashed only once for all of them.
+    """
+    spooled = {}
+    try:
+        for key_name, content in upload_data.items():
+            spooled[key_name] = SpooledContent(content, compress)
+        yield spooled
+    finally:
+        for content in spooled.values():
+            content.close()
 
 
 class S3Uploader(object):
-    def __init__(self, bucket_name, allowed_ips=None, allowed_aws_account_ids=None, allowed_organization_ids=None):
+    """Set up the destination bucket and its SNS topic, upload the account data
+
+    All requests go through one S3 and one SNS client, created from session
+    (default: the default boto3 session) when they are first needed. config
+    is merged into CLIENT_CONFIG, e.g. to change timeouts or retries.
+    """
+    def __init__(self, bucket_name, allowed_ips=None, allowed_aws_account_ids=None, allowed_organization_ids=None,
+                 region_name=None, compress=False, session=None, config=None):
         self.bucket_name = bucket_name
         self.allowed_ips = allowed_ips or []
         self.allowed_aws_account_ids = allowed_aws_account_ids or []
         self.allowed_organization_ids = allowed_organization_ids
-        self.boto3_s3_client = boto3.client('s3', region_name=BUCKET_REGION)
-        self.boto3_sns_client = boto3.client('sns', region_name=BUCKET_REGION)
+        self.region_name = region_name or BUCKET_REGION
+        self.compress = compress
+        self.session = session
+        self.config = CLIENT_CONFIG.merge(config) if config is not None else CLIENT_CONFIG
+        self.topic_arn = None
+        self._s3_client = None
+        self._sns_client = None
+
+    @property
+    def boto3_s3_client(self):
+        if self._s3_client is None:
+            self._s3_client = self._create_client('s3')
+        return self._s3_client
+
+    @boto3_s3_client.setter
+    def boto3_s3_client(self, client):
+        self._s3_client = client
+
+    @property
+    def boto3_sns_client(self):
+        if self._sns_client is None:
+            self._sns_client = self._create_client('sns')
+        return self._sns_client
+
+    @boto3_sns_client.setter
+    def boto3_sns_client(self, client):
+        self._sns_client = client
+
+    def _create_client(self, service_name):
+        with _CLIENT_LOCK:
+            client = {'s3': self._s3_client, 'sns': self._sns_client}[service_name]
+            if client is None:
+                factory = self.session if self.session is not None else boto3
+                client = instrument_client(
+                    factory.client(service_name, region_name=self.region_name, config=self.config))
+                logging.debug("Created %s client for region %s", service_name, self.region_name)
+            return client
 
     def setup_infrastructure(self):
-        topic_arn = self.create_sns_topic()
-        self.set_sns_topic_policy(topic_arn)
-        self.create_S3_bucket()
-        self.set_S3_permissions()
-        self.setup_S3_webserver()
-        self.enable_bucket_notifications(topic_arn)
+        """Bring SNS topic and S3 bucket into the desired state
+
+        Every step compares the live configuration with the desired one and
+        only writes if they differ. The SNS topic and the S3 bucket are set
+        up concurrently, the bucket notifications need both. Returns the
+        names of the steps that changed something, the duration of each
+        step is available in self.step_timings afterwards.
+        """
+        self.step_results = {}
+        self.step_timings = {}
+        started = time.time()
+
+        pool = ThreadPool(2)
+        try:
+            branches = [pool.apply_async(self._setup_sns_topic), pool.apply_async(self._setup_S3_bucket)]
+            errors = []
+            for branch in branches:
+                try:
+                    branch.get()
+                except Exception as e:
+                    errors.append(str(e))
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise Exception("Failed to set up infrastructure for '{0}': {1}".format(
+                self.bucket_name, "; ".join(errors)))
+        topic_arn = self.topic_arn = branches[0].get()
+        self._run_step('enable_bucket_notifications', self.enable_bucket_notifications, topic_arn)
+
+        logging.info("Infrastructure of '%s' set up in %.3fs, the steps took %.3fs in total",
+                     self.bucket_name, time.time() - started, sum(self.step_timings.values()))
+        changed_steps = [name for name in INFRASTRUCTURE_STEPS if self.step_results.get(name)]
+        logging.info("Infrastructure of '%s': changed %s", self.bucket_name, changed_steps or "nothing")
+        return changed_steps
+
+    def _setup_sns_topic(self):
+        topic_arn = self._run_step('create_sns_topic', self.create_sns_topic)
+        self._run_step('set_sns_topic_policy', self.set_sns_topic_policy, topic_arn)
+        return topic_arn
+
+    def _setup_S3_bucket(self):
+        self._run_step('create_S3_bucket', self.create_S3_bucket)
+        self._run_step('set_S3_permissions', self.set_S3_permissions)
+        self._run_step('setup_S3_webserver', self.setup_S3_webserver)
+
+    def _run_step(self, name, function, *args):
+        """Run one infrastructure step, record its result and duration"""
+        started = time.time()
+        try:
+            result = function(*args)
+        except Exception as e:
+            raise Exception("step {0} failed: {1}".format(name, e))
+        finally:
+            self.step_timings[name] = time.time() - started
+            logging.debug("Infrastructure step %s took %.3fs", name, self.step_timings[name])
+            METRICS.timing('infrastructure.step', self.step_timings[name], step=name, bucket=self.bucket_name)
+        self.step_results[name] = result
+        return result
 
     def create_S3_bucket(self):
         """ Create a new S3 bucket if bucket not exists else nothing """
         try:
-            self.boto3_s3_client.create_bucket(
-                Bucket=self.bucket_name,
-                CreateBucketConfiguration={'LocationConstraint': BUCKET_REGION})
+            self.boto3_s3_client.head_bucket(Bucket=self.bucket_name)
+            logging.debug("AWS S3 bucket '%s' already exists", self.bucket_name)
+            return False
+        except ClientError:
+            pass
+        try:
+            self._create_bucket()
             logging.debug("Created new AWS S3 bucket with name '%s'", self.bucket_name)
+            return True
         except Exception as e:
             logging.debug("Could not create S3 bucket '%s': %s", self.bucket_name, e)
+            return False
 
-    def set_S3_permissions(self):
+    def _create_bucket(self):
+        kwargs = {}
+        # us-east-1 is the default location and must not be given explicitly.
+        if self.region_name != 'us-east-1':
+            kwargs['CreateBucketConfiguration'] = {'LocationConstraint': self.region_name}
+        self.boto3_s3_client.create_bucket(Bucket=self.bucket_name, **kwargs)
+
+    def get_S3_policy(self):
         policy = {
             "Version": "2012-10-17",
             "Statement": [{
@@ -81,10 +329,26 @@ class S3Uploader(object):
                     "aws:PrincipalOrgID": self.allowed_organization_ids
                 }
             }
+        return policy
+
+    def get_current_S3_policy(self):
+        try:
+            response = self.boto3_s3_client.get_bucket_policy(Bucket=self.bucket_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchBucketPolicy':
+                return None
+            raise
+        return json.loads(response['Policy'])
+
+    def set_S3_permissions(self):
+        policy = self.get_S3_policy()
+        if policies_are_equal(self.get_current_S3_policy(), policy):
+            logging.debug("AWS S3 bucket '%s' already has the desired policy", self.bucket_name)
+            return False
 
-        bucket_policy = boto3.resource('s3').BucketPolicy(self.bucket_name)
-        bucket_policy.put(Policy=json.dumps(policy))
+        self.boto3_s3_client.put_bucket_policy(Bucket=self.bucket_name, Policy=json.dumps(policy))
         logging.debug("AWS S3 bucket '%s' now has policy: '%s'", self.bucket_name, policy)
+        return True
 
     def create_sns_topic(self):
         response = self.boto3_sns_client.create_topic(Name=self.bucket_name)
@@ -93,7 +357,7 @@ class S3Uploader(object):
 
         return topic_arn
 
-    def set_sns_topic_policy(self, topic_arn):
+    def get_sns_topic_policy(self, topic_arn):
         allow_s3_events = {
             "Sid": "allow_s3_events",
             "Effect": "Allow",
@@ -127,7 +391,7 @@ class S3Uploader(object):
                     "aws:PrincipalOrgID": self.allowed_organization_ids
                 }
             }
-        policy = {
+        return {
             "Version": "2012-10-17",
             "Statement": [
                 allow_s3_events,
@@ -135,21 +399,59 @@ class S3Uploader(object):
             ]
         }
 
+    def get_current_sns_topic_policy(self, topic_arn):
+        response = self.boto3_sns_client.get_topic_attributes(TopicArn=topic_arn)
+        policy = response['Attributes'].get('Policy')
+        return json.loads(policy) if policy else None
+
+    def set_sns_topic_policy(self, topic_arn):
+        policy = self.get_sns_topic_policy(topic_arn)
+        if policies_are_equal(self.get_current_sns_topic_policy(topic_arn), policy):
+            logging.debug("SNS topic '%s' already has the desired policy", topic_arn)
+            return False
+
         self.boto3_sns_client.set_topic_attributes(
             TopicArn=topic_arn, AttributeName='Policy', AttributeValue=json.dumps(policy))
+        return True
 
-    def enable_bucket_notifications(self, topic_arn):
-        notification_configuration = {
+    def get_notification_configuration(self, topic_arn):
+        # Only the account lists, not every single index object, notify subscribers.
+        # With --snapshots, each new version also notifies, its key names the
+        # version. The rule is always there, so runs with and without
+        # --snapshots do not change the configuration back and forth.
+        prefixes = [FILENAME, SNAPSHOT_PREFIX]
+        return {
             'TopicConfigurations': [
                 {
                     'TopicArn': topic_arn,
-                    'Events': ['s3:ObjectCreated:*']
+                    'Events': ['s3:ObjectCreated:*'],
+                    'Filter': {'Key': {'FilterRules': [{'Name': 'prefix', 'Value': prefix}]}}
                 }
+                for prefix in prefixes
             ]
         }
+
+    def get_current_notification_configuration(self):
+        response = self.boto3_s3_client.get_bucket_notification_configuration(Bucket=self.bucket_name)
+        configuration = {}
+        for kind, items in response.items():
+            if kind == 'ResponseMetadata' or not items:
+                continue
+            if isinstance(items, list):
+                items = [_normalize_notification(item) for item in items]
+            configuration[kind] = items
+        return configuration
+
+    def enable_bucket_notifications(self, topic_arn):
+        notification_configuration = self.get_notification_configuration(topic_arn)
+        if self.get_current_notification_configuration() == notification_configuration:
+            logging.debug("AWS S3 bucket '%s' already sends the desired notifications", self.bucket_name)
+            return False
+
         self.boto3_s3_client.put_bucket_notification_configuration(
                 Bucket=self.bucket_name,
                 NotificationConfiguration=notification_configuration)
+        return True
 
     def get_routing_rules(self):
         return [
@@ -160,26 +462,507 @@ class S3Uploader(object):
             {
              'Condition': {'KeyPrefixEquals': 'json'},
              'Redirect': {'ReplaceKeyPrefixWith': 'accounts.json'}
+            },
+            {
+             'Condition': {'KeyPrefixEquals': 'min.json'},
+             'Redirect': {'ReplaceKeyPrefixWith': 'accounts.min.json'}
             }]
 
+    def get_website_configuration(self):
+        return {
+            'IndexDocument': {'Suffix': 'accounts.json'},
+            'RoutingRules': self.get_routing_rules()
+        }
+
+    def get_current_website_configuration(self):
+        try:
+            response = self.boto3_s3_client.get_bucket_website(Bucket=self.bucket_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchWebsiteConfiguration':
+                return None
+            raise
+        return dict((key, value) for key, value in response.items() if key != 'ResponseMetadata')
+
     def setup_S3_webserver(self):
+        website_configuration = self.get_website_configuration()
+        if self.get_current_website_configuration() == website_configuration:
+            logging.debug("AWS S3 bucket '%s' already has the desired website configuration", self.bucket_name)
+            return False
+
         self.boto3_s3_client.put_bucket_website(
                 Bucket=self.bucket_name,
-                WebsiteConfiguration={
-                    'IndexDocument': {'Suffix': 'accounts.json'},
-                    'RoutingRules': self.get_routing_rules()
-                })
+                WebsiteConfiguration=website_configuration)
+        return True
 
-    def upload_to_S3(self, upload_data):
-        for key_name, content in upload_data.items():
-            if key_name.endswith('json'):
-                content_type = 'application/json'
-            elif key_name.endswith('yaml'):
-                content_type = 'application/yaml'
+    def plan(self, upload_data, index_data=None):
+        """Return the changes setup_infrastructure and the uploads would make
+
+        Only read-only requests are made, concurrently. The SNS topic is
+        looked up instead of created, its ARN is derived from the caller
+        identity if it does not exist yet. The result is a JSON serializable
+        dict with the 'changes' in the order apply() makes them. Each change
+        names its 'resource' and 'action', the documents to write also have
+        their 'current' and 'desired' state. Index objects are only compared
+        if index_data is given.
+        """
+        pool = ThreadPool(INDEX_UPLOAD_THREADS)
+        try:
+            bucket_exists = pool.apply_async(self._bucket_exists)
+            topic = pool.apply_async(self._find_sns_topic)
+            current = dict((name, pool.apply_async(self._unless_no_bucket, (function,))) for name, function in (
+                ('S3_policy', self.get_current_S3_policy),
+                ('website_configuration', self.get_current_website_configuration),
+                ('notification_configuration', self.get_current_notification_configuration)))
+            objects = [(key_name, pool.apply_async(self._plan_object, (key_name, content)))
+                       for key_name, content in sorted(upload_data.items())]
+            index_listing = None
+            if index_data is not None:
+                index_listing = pool.apply_async(self._unless_no_bucket, (self._list_index_etags,))
+            topic_arn, topic_exists, current_topic_policy = topic.get()
+            bucket_exists = bucket_exists.get()
+            current = dict((name, result.get()) for name, result in current.items())
+            objects = [(key_name, result.get()) for key_name, result in objects]
+            index_etags = (index_listing.get() or {}) if index_listing is not None else {}
+        finally:
+            pool.close()
+            pool.join()
+
+        changes = []
+        if not topic_exists:
+            changes.append({'resource': 'sns_topic', 'action': 'create'})
+        _plan_document(changes, 'sns_topic_policy', current_topic_policy, self.get_sns_topic_policy(topic_arn),
+                       policies_are_equal)
+        if not bucket_exists:
+            changes.append({'resource': 'S3_bucket', 'action': 'create'})
+        _plan_document(changes, 'S3_policy', current['S3_policy'], self.get_S3_policy(), policies_are_equal)
+        _plan_document(changes, 'website_configuration', current['website_configuration'],
+                       self.get_website_configuration())
+        _plan_document(changes, 'notification_configuration', current['notification_configuration'] or None,
+                       self.get_notification_configuration(topic_arn))
+        for key_name, (content_hash, unchanged) in objects:
+            if not unchanged:
+                changes.append({'resource': 'object', 'action': 'upload', 'key': key_name, 'sha256': content_hash})
+        for key_name, content in sorted((index_data or {}).items()):
+            etag = _etag(self._index_body(content))
+            if index_etags.get(key_name) != etag:
+                changes.append({'resource': 'object', 'action': 'upload', 'key': key_name, 'etag': etag})
+        for key_name in sorted(set(index_etags) - set(index_data or {})):
+            changes.append({'resource': 'object', 'action': 'delete', 'key': key_name})
+
+        logging.info("Plan for AWS S3 bucket '%s': %d changes", self.bucket_name, len(changes))
+        return {'bucket': self.bucket_name, 'region': self.region_name, 'compress': self.compress,
+                'topic_arn': topic_arn, 'changes': changes}
+
+    def apply(self, plan, upload_data, index_data=None):
+        """Make the changes of a plan(), without reading the current state again
+
+        upload_data and index_data must have the content the plan was made
+        for, an object whose content differs from the plan raises an
+        exception before anything is uploaded. Returns the applied changes.
+        """
+        if (plan['bucket'], plan['region'], plan['compress']) != (self.bucket_name, self.region_name, self.compress):
+            raise Exception("Plan for bucket '{0}' in {1} (compress={2}) does not fit bucket '{3}' in {4} "
+                            "(compress={5})".format(plan['bucket'], plan['region'], plan['compress'],
+                                                    self.bucket_name, self.region_name, self.compress))
+        topic_arn = plan['topic_arn']
+        uploads, index_uploads, deletions, spooled_here = [], [], [], []
+        try:
+            for change in plan['changes']:
+                if change['resource'] != 'object':
+                    continue
+                key_name = change['key']
+                if change['action'] == 'delete':
+                    deletions.append(key_name)
+                elif 'sha256' in change:
+                    content = _planned_content(upload_data, key_name)
+                    spooled = self._spooled(content)
+                    if spooled is not content:
+                        spooled_here.append(spooled)
+                    uploads.append((key_name, spooled))
+                    if spooled.content_hash != change['sha256']:
+                        raise Exception("Content of '{0}' changed since the plan was made".format(key_name))
+                else:
+                    body = self._index_body(_planned_content(index_data or {}, key_name))
+                    if _etag(body) != change['etag']:
+                        raise Exception("Content of '{0}' changed since the plan was made".format(key_name))
+                    index_uploads.append((key_name, body))
+
+            for change in plan['changes']:
+                if change['resource'] == 'sns_topic':
+                    created_arn = self.create_sns_topic()
+                    if created_arn != topic_arn:
+                        raise Exception("Created SNS topic '{0}', but planned '{1}'".format(created_arn, topic_arn))
+                elif change['resource'] == 'sns_topic_policy':
+                    self.boto3_sns_client.set_topic_attributes(
+                        TopicArn=topic_arn, AttributeName='Policy', AttributeValue=json.dumps(change['desired']))
+                elif change['resource'] == 'S3_bucket':
+                    self._create_bucket()
+                elif change['resource'] == 'S3_policy':
+                    self.boto3_s3_client.put_bucket_policy(
+                        Bucket=self.bucket_name, Policy=json.dumps(change['desired']))
+                elif change['resource'] == 'website_configuration':
+                    self.boto3_s3_client.put_bucket_website(
+                        Bucket=self.bucket_name, WebsiteConfiguration=change['desired'])
+                elif change['resource'] == 'notification_configuration':
+                    self.boto3_s3_client.put_bucket_notification_configuration(
+                        Bucket=self.bucket_name, NotificationConfiguration=change['desired'])
+            for key_name, spooled in uploads:
+                self._upload_spool(key_name, spooled)
+        finally:
+            for spooled in spooled_here:
+                spooled.close()
+        self._put_objects(index_uploads)
+        self._delete_objects(deletions)
+
+        logging.info("AWS S3 bucket '%s': applied %d planned changes", self.bucket_name, len(plan['changes']))
+        return plan['changes']
+
+    def _bucket_exists(self):
+        try:
+            self.boto3_s3_client.head_bucket(Bucket=self.bucket_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchBucket', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def _unless_no_bucket(self, function):
+        """Return function(), or None if the bucket does not exist"""
+        try:
+            return function()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchBucket':
+                return None
+            raise
+
+    def _find_sns_topic(self):
+        """Return ARN, existence and policy of the SNS topic, without creating it"""
+        paginator = self.boto3_sns_client.get_paginator('list_topics')
+        for page in paginator.paginate():
+            for topic in page.get('Topics', []):
+                if topic['TopicArn'].split(':')[-1] == self.bucket_name:
+                    return topic['TopicArn'], True, self.get_current_sns_topic_policy(topic['TopicArn'])
+        factory = self.session if self.session is not None else boto3
+        with _CLIENT_LOCK:
+            sts_client = instrument_client(factory.client('sts', region_name=self.region_name, config=self.config))
+        caller_arn = sts_client.get_caller_identity()['Arn']
+        partition, account_id = caller_arn.split(':')[1], caller_arn.split(':')[4]
+        return "arn:{0}:sns:{1}:{2}:{3}".format(partition, self.region_name, account_id, self.bucket_name), False, None
+
+    def publish_change_events(self, old_accounts, new_accounts, version=None):
+        """Publish an SNS message per added, removed or modified account
+
+        The events (see change_events) go directly to the topic of the
+        bucket, in batches of up to ten messages, concurrently. Nothing is
+        sent without old_accounts, a first upload is no change. Returns the
+        number of messages sent, raises an exception if any failed.
+        """
+        if old_accounts is None:
+            logging.info("No accounts were published in '%s' before, not sending change events", self.bucket_name)
+            return 0
+        events = account_changes(old_accounts, new_accounts, version)
+        if not events:
+            return 0
+        topic_arn = self.topic_arn or self.create_sns_topic()
+        batches = batch_entries(events)
+
+        def send(entries):
+            if len(entries) == 1:
+                self.boto3_sns_client.publish(TopicArn=topic_arn, Message=entries[0]['Message'],
+                                              MessageAttributes=entries[0]['MessageAttributes'])
+                return []
+            response = self.boto3_sns_client.publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+            return ["{0} ({1})".format(json.loads(entries[int(failure['Id'])]['Message']).get('account'),
+                                       failure.get('Message', failure['Code']))
+                    for failure in response.get('Failed', [])]
+
+        pool = ThreadPool(min(INDEX_UPLOAD_THREADS, len(batches)))
+        try:
+            failures = sum(pool.map(send, batches), [])
+        finally:
+            pool.close()
+            pool.join()
+        METRICS.count('sns.change_events', len(events) - len(failures), bucket=self.bucket_name)
+        if failures:
+            raise Exception("Failed to publish {0} of {1} change events to '{2}': {3}".format(
+                len(failures), len(events), topic_arn, ", ".join(failures)))
+        logging.info("SNS topic '%s': published %d change events in %d requests", topic_arn, len(events), len(batches))
+        return len(events)
+
+    def _plan_object(self, key_name, content):
+        spooled = self._spooled(content)
+        try:
+            content_encoding = 'gzip' if self.compress else None
+            return spooled.content_hash, self._is_unchanged(key_name, spooled, content_encoding)
+        finally:
+            if spooled is not content:
+                spooled.close()
+
+    def get_published_accounts(self):
+        """Return the account data of the published accounts.json, or None"""
+        return self.fetch_published_accounts()[0]
+
+    def fetch_published_accounts(self, etag=None):
+        """Return the account data of the published accounts.json and its ETag
+
+        The account data is None if there is no accounts.json, and also if
+        it still has the given etag: S3 then does not send it again.
+        """
+        return self._get_json(FILENAME + ".json", etag)
+
+    def _get_json(self, key_name, etag=None):
+        """Return the parsed JSON object at key_name and its ETag, see fetch_published_accounts()"""
+        arguments = {'IfNoneMatch': etag} if etag else {}
+        try:
+            response = self.boto3_s3_client.get_object(Bucket=self.bucket_name, Key=key_name, **arguments)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return None, etag
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NoSuchBucket'):
+                return None, None
+            raise
+        body = response['Body'].read()
+        if response.get('ContentEncoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+        return json.loads(body.decode('utf-8')), response.get('ETag')
+
+    def publish_snapshot(self, accounts):
+        """Publish accounts as a new version, with the delta from the previous one
+
+        The immutable snapshots/<version>.json is written first, then the
+        JSON patch deltas/<previous version>.json, then the pointer
+        latest.json, so a consumer that sees a new pointer finds everything
+        it names. Nothing is written if the accounts are the latest version
+        already. Returns the pointer, with 'changed' telling whether it was
+        written.
+        """
+        body = snapshot_body(accounts)
+        version = version_of(body)
+        latest, _ = self._get_json(LATEST_KEY)
+        if latest is not None and latest['version'] == version:
+            logging.debug("AWS S3 bucket '%s': version %s is already the latest", self.bucket_name, version)
+            return dict(latest, changed=False)
+
+        objects = [(snapshot_key(version), body)]
+        previous = latest['version'] if latest is not None else None
+        if previous is not None:
+            previous_accounts, _ = self._get_json(snapshot_key(previous))
+            if previous_accounts is None:
+                logging.warning("AWS S3 bucket '%s': snapshot of version %s is missing, not writing a delta",
+                                self.bucket_name, previous)
+                previous = None
             else:
-                content_type = 'application/text'
+                delta = {'from': previous, 'to': version,
+                         'patch': make_patch(previous_accounts, json.loads(body))}
+                objects.append((delta_key(previous), json.dumps(delta, sort_keys=True)))
+        new_pointer = snapshot_pointer(version, previous)
+        objects.append((LATEST_KEY, json.dumps(new_pointer, sort_keys=True)))
+        for key_name, content in objects:
+            self._put_object(key_name, self._index_body(content))
+
+        logging.info("AWS S3 bucket '%s': published version %s, previous %s", self.bucket_name, version, previous)
+        return dict(new_pointer, changed=True)
+
+    def upload_to_S3(self, upload_data, force=False):
+        """Upload all changed keys of upload_data
+
+        The values of upload_data are text, bytes, or functions returning an
+        iterable of text or bytes chunks. Chunks are spooled to a temporary
+        file, which is uploaded in parts if it is large, so big documents
+        never have to be held in memory completely. Values can also be
+        SpooledContent, see spooled_upload_data(), to serialize them only
+        once for several buckets.
+
+        A key is skipped if the stored object already has the same content,
+        which saves the upload and the s3:ObjectCreated notification that
+        goes out to every subscriber. With compress=True the objects are
+        stored gzip compressed, with 'Content-Encoding: gzip'. Returns a
+        dict with the sorted key names that were 'uploaded' and 'skipped'.
+        """
+        content_encoding = 'gzip' if self.compress else None
+        result = {'uploaded': [], 'skipped': []}
+        for key_name, content in sorted(upload_data.items()):
+            spooled = self._spooled(content)
+            try:
+                if not force and self._is_unchanged(key_name, spooled, content_encoding):
+                    result['skipped'].append(key_name)
+                    logging.debug("Content of key '%s' is unchanged, not uploading it", key_name)
+                    continue
+
+                self._upload_spool(key_name, spooled)
+                result['uploaded'].append(key_name)
+                logging.debug("Uploaded to AWS S3 bucket '%s': key '%s'", self.bucket_name, key_name)
+            finally:
+                if spooled is not content:
+                    spooled.close()
+
+        logging.info("AWS S3 bucket '%s': uploaded %s, skipped unchanged %s",
+                     self.bucket_name, result['uploaded'], result['skipped'])
+        return result
+
+    def _spooled(self, content):
+        """Return content as SpooledContent, compressed if configured
+
+        SpooledContent is used as it is, a new one has to be closed by the
+        caller.
+        """
+        if not isinstance(content, SpooledContent):
+            return SpooledContent(content, self.compress)
+        if content.compress != self.compress:
+            raise Exception("Content spooled with compress={0} cannot be uploaded to bucket '{1}' with "
+                            "compress={2}".format(content.compress, self.bucket_name, self.compress))
+        return content
+
+    def _is_unchanged(self, key_name, spooled, content_encoding):
+        """Return True if the stored object at key_name has the given content
+
+        Objects uploaded by older releases carry no hash metadata, for
+        them the ETag (the MD5 of single part uploads) is compared instead.
+        """
+        try:
+            response = self.boto3_s3_client.head_object(Bucket=self.bucket_name, Key=key_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound', 'NoSuchBucket'):
+                return False
+            raise
+        if response.get('ContentEncoding') != content_encoding:
+            return False
+        stored_hash = response.get('Metadata', {}).get(CONTENT_HASH_METADATA)
+        if stored_hash is not None:
+            return stored_hash == spooled.content_hash
+        md5 = hashlib.md5()
+        with contextlib.closing(spooled.open()) as body:
+            for chunk in iter(lambda: body.read(TRANSFER_CONFIG.multipart_chunksize), b''):
+                md5.update(chunk)
+        return response.get('ETag') == '"{0}"'.format(md5.hexdigest())
+
+    def upload_index_objects(self, index_data, force=False):
+        """Synchronize the index objects below INDEX_PREFIXES with index_data
+
+        The stored ETags are fetched with a few list requests instead of one
+        HEAD request per object, only changed objects are uploaded, in
+        parallel. Index objects that are not in index_data any more, e.g.
+        of a removed account, are deleted. Returns a dict with the sorted
+        key names that were 'uploaded', 'skipped' and 'deleted'.
+        """
+        stored_etags = self._list_index_etags()
+        result = {'uploaded': [], 'skipped': [], 'deleted': []}
+        changed = []
+        for key_name, content in sorted(index_data.items()):
+            body = self._index_body(content)
+            if not force and stored_etags.get(key_name) == _etag(body):
+                result['skipped'].append(key_name)
+            else:
+                changed.append((key_name, body))
+
+        self._put_objects(changed)
+        result['uploaded'] = [key_name for key_name, _ in changed]
+
+        result['deleted'] = sorted(set(stored_etags) - set(index_data))
+        self._delete_objects(result['deleted'])
+
+        logging.info("AWS S3 bucket '%s': uploaded %d, skipped %d unchanged and deleted %d index objects",
+                     self.bucket_name, len(result['uploaded']), len(result['skipped']), len(result['deleted']))
+        return result
+
+    def _list_index_etags(self):
+        etags = {}
+        paginator = self.boto3_s3_client.get_paginator('list_objects_v2')
+        for prefix in INDEX_PREFIXES:
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                for item in page.get('Contents', []):
+                    etags[item['Key']] = item['ETag']
+        return etags
+
+    def _upload_spool(self, key_name, spooled):
+        extra_args = self._object_arguments(key_name)
+        extra_args['Metadata'] = {CONTENT_HASH_METADATA: spooled.content_hash}
+        with METRICS.span('upload.put', bucket=self.bucket_name, key=key_name, bytes=spooled.size):
+            with contextlib.closing(spooled.open()) as body:
+                self.boto3_s3_client.upload_fileobj(
+                    body, self.bucket_name, key_name, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+
+    def _index_body(self, content):
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+        return gzip_compress(content) if self.compress else content
+
+    def _put_objects(self, items):
+        """Upload the (key name, body) pairs of items in parallel"""
+        if not items:
+            return
+        pool = ThreadPool(min(INDEX_UPLOAD_THREADS, len(items)))
+        try:
+            pool.map(lambda item: self._put_object(*item), items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _delete_objects(self, key_names):
+        for start in range(0, len(key_names), DELETE_BATCH_SIZE):
+            batch = key_names[start:start + DELETE_BATCH_SIZE]
+            self.boto3_s3_client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key_name} for key_name in batch], 'Quiet': True})
+            METRICS.count('upload.deleted', len(batch), bucket=self.bucket_name)
+
+    def _put_object(self, key_name, body):
+        with METRICS.span('upload.put', bucket=self.bucket_name, key=key_name, bytes=len(body)):
             self.boto3_s3_client.put_object(
-                Bucket=self.bucket_name, Key=key_name,
-                Body=content, ContentType=content_type)
-            logging.debug("Uploaded to AWS S3 bucket '%s': "
-                          "key '%s' and content '%s'", self.bucket_name, key_name, content)
+                Bucket=self.bucket_name, Key=key_name, Body=body, **self._object_arguments(key_name))
+
+    def _object_arguments(self, key_name):
+        if key_name.endswith('json'):
+            content_type = 'application/json'
+        elif key_name.endswith('yaml'):
+            content_type = 'application/yaml'
+        else:
+            content_type = 'application/text'
+        arguments = {'ContentType': content_type}
+        if self.compress:
+            arguments['ContentEncoding'] = 'gzip'
+        return arguments
+
+
+def _plan_document(changes, resource, current, desired, are_equal=lambda first, second: first == second):
+    if current is not None and are_equal(current, desired):
+        return
+    changes.append({'resource': resource, 'action': 'create' if current is None else 'update',
+                    'current': current, 'desired': desired})
+
+
+def _planned_content(data, key_name):
+    if key_name not in data:
+        raise Exception("The plan uploads '{0}', which is not in the data any more".format(key_name))
+    return data[key_name]
+
+
+def _etag(body):
+    """Return the ETag S3 assigns to body when uploaded in a single part"""
+    return '"{0}"'.format(hashlib.md5(body).hexdigest())
+
+
+def _normalize_notification(item):
+    """Bring a notification configuration, as returned by AWS, into the form we write
+
+    AWS generates an Id for each configuration we did not set, and spells
+    the names of key filter rules with a capital letter.
+    """
+    item = dict((key, value) for key, value in item.items() if key != 'Id')
+    filter_rules = item.get('Filter', {}).get('Key', {}).get('FilterRules')
+    if filter_rules:
+        item['Filter'] = {'Key': {'FilterRules': [
+            {'Name': rule['Name'].lower(), 'Value': rule['Value']} for rule in filter_rules]}}
+    return item
+
+
+def gzip_compress(content):
+    """Return content gzip compressed, without a timestamp in the header
+
+    Without the timestamp, the same content always compresses to the same
+    bytes, which keeps the ETag of unchanged objects stable.
+    """
+    buffer = BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buffer, mtime=0) as compressed:
+        compressed.write(content)
+    return buffer.getvalue()
@@ -3,80 +3,302 @@
 
 from __future__ import print_function, absolute_import, division
 
-import yamlreader
+import glob
 import logging
-import six
-from mock import patch
+import multiprocessing
+import os
 
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from ultimate_source_of_accounts.account import Account
+from ultimate_source_of_accounts.metrics import METRICS, _clock
+from ultimate_source_of_accounts.validation import validate_accounts, Violation, ERROR
 
-def read_directory(yaml_path):
-    """Read yaml files and return merged yaml data"""
-    accounts = yamlreader.yaml_load(yaml_path)
 
-    for account in accounts.values():
-        account['id'] = str(account['id'])
+def read_directory(yaml_path, jobs=1, cache=None):
+    """Read yaml files and return merged yaml data"""
+    accounts = _load_accounts(yaml_path, jobs, cache)
     _check_account_data(accounts)
-    _check_duplicate_account_names(yaml_path)
 
     logging.debug("Read yaml files from directory '%s'", yaml_path)
 
     return accounts
 
 
-# data_merge is patched to get access to the data from each individual
-# file, before data is merged. This allows detecting if the same account
-# name (not id!) is defined twice, e.g. due to a copy & paste mistake.
-@patch("yamlreader.yamlreader.data_merge")
-def _check_duplicate_account_names(yaml_path, mock_data_merge):
-    yamlreader.yaml_load(yaml_path)
-    account_names_found = set()
-    for args, kwargs in mock_data_merge.call_args_list:
-        _, new_data = args
-        names = new_data.keys()
-        for name in names:
-            if name in account_names_found:
-                raise Exception("Duplicate definition of account %r" % name)
-            account_names_found.add(name)
+def validate_directory(yaml_path, jobs=1, cache=None):
+    """Read yaml files and return the merged data plus a ValidationReport
+
+    Unlike read_directory, invalid account data does not raise an exception,
+    all violations are collected in the report. So are files that cannot be
+    parsed or merged, they are skipped. Every violation names the file it
+    was found in.
+    """
+    file_violations = []
+    data, origins = load_directory(yaml_path, jobs=jobs, cache=cache, violations=file_violations)
+    accounts = {}
+    for name, account_data in data.items():
+        if isinstance(account_data, dict):
+            accounts[name] = Account.from_dict(account_data)
+        else:
+            file_violations.append(Violation(
+                name, 'account-invalid', "Account data {0} is not a mapping.".format(name), ERROR, origins[name]))
+    report = validate_accounts(accounts)
+    report.violations = file_violations + [violation._replace(file=origins.get(violation.account))
+                                           for violation in report.violations]
+    return accounts, report
+
+
+def _load_accounts(yaml_path, jobs, cache):
+    accounts, _ = load_directory(yaml_path, jobs=jobs, cache=cache)
+    return _make_accounts(accounts)
+
+
+def _make_accounts(data):
+    """Return a dict account name -> Account for the dicts in data"""
+    accounts = {}
+    for name, account_data in data.items():
+        if not isinstance(account_data, dict):
+            raise Exception("Account data {0} is not a mapping.".format(name))
+        accounts[name] = Account.from_dict(account_data)
+    return accounts
+
+
+def load_directory(yaml_path, jobs=1, cache=None, violations=None):
+    """Read every yaml file in yaml_path exactly once and merge the data
+
+    Returns a tuple (accounts, origins), where origins maps each account
+    name to the file it was defined in. Defining the same account name (not
+    id!) in two files, e.g. due to a copy & paste mistake, raises an
+    exception.
+
+    With jobs > 1 the files are parsed by a pool of worker processes. The
+    results are still merged in file order, so data and errors are the same
+    as when parsing serially.
+
+    With a ParseCache as cache, the data of unchanged files is taken from
+    the cache instead of parsing them again.
+
+    If violations is a list, errors of single files are appended to it
+    instead of raised: files that cannot be parsed or do not contain a
+    mapping are skipped, as are the duplicate definitions of an account.
+    """
+    yaml_files = _list_yaml_files(yaml_path)
+    if not yaml_files:
+        raise Exception("No YAML data found in {0}".format(yaml_path))
+
+    accounts = {}
+    origins = {}
+    merge_seconds = 0
+    with METRICS.span('read.parse', files=len(yaml_files), jobs=jobs, cached=cache is not None) as tags:
+        if METRICS.enabled:
+            tags['bytes'] = sum(os.path.getsize(yaml_file) for yaml_file in yaml_files)
+        parsed_files = _parse_files(yaml_files, jobs) if cache is None else _parse_cached_files(yaml_files, jobs, cache)
+        try:
+            for yaml_file, (new_data, error) in zip(yaml_files, parsed_files):
+                if error is not None:
+                    if violations is None:
+                        raise error
+                    violations.append(Violation(None, 'file-invalid', str(error), ERROR, yaml_file))
+                    continue
+                started = _clock()
+                _merge_file_data(accounts, origins, yaml_file, new_data, violations)
+                merge_seconds += _clock() - started
+        finally:
+            # Also when the first error stops parsing, entries may have been written.
+            if cache is not None:
+                cache.evict()
+    # Merging is where duplicate account names are found.
+    METRICS.timing('read.duplicate_check', merge_seconds, accounts=len(accounts))
+
+    return accounts, origins
+
+
+class IncrementalReader(object):
+    """Keep the parsed files of yaml_path in memory and re-read only changed ones
+
+    read() parses every file, update() only the given changed files plus
+    files that are new. Both return the merged accounts like read_directory.
+    Accounts from files that were already checked successfully are not
+    checked again, only the ids of the new accounts are compared with all
+    other ids.
+    """
+    def __init__(self, yaml_path, jobs=1, cache=None):
+        self.yaml_path = yaml_path
+        self.jobs = jobs
+        self.cache = cache
+        self.parsed_files = {}
+        self.unchecked_files = set()
+
+    def read(self):
+        self.parsed_files = {}
+        return self.update(())
+
+    def update(self, changed_files):
+        yaml_files = _list_yaml_files(self.yaml_path)
+        if not yaml_files:
+            raise Exception("No YAML data found in {0}".format(self.yaml_path))
+
+        changed_files = set(changed_files)
+        for yaml_file in set(self.parsed_files) - set(yaml_files):
+            del self.parsed_files[yaml_file]
+        files_to_parse = [yaml_file for yaml_file in yaml_files
+                          if yaml_file in changed_files or yaml_file not in self.parsed_files]
+        if files_to_parse:
+            if self.cache is None:
+                parsed_files = _parse_files(files_to_parse, self.jobs)
+            else:
+                try:
+                    parsed_files = list(_parse_cached_files(files_to_parse, self.jobs, self.cache))
+                finally:
+                    self.cache.evict()
+            for yaml_file, (new_data, error) in zip(files_to_parse, list(parsed_files)):
+                if error is None and isinstance(new_data, dict):
+                    try:
+                        new_data = _make_accounts(new_data)
+                    except Exception as e:
+                        new_data, error = None, e
+                self.parsed_files[yaml_file] = new_data, error
+        self.unchecked_files.update(files_to_parse)
+        logging.debug("Parsed %d of %d files in '%s'", len(files_to_parse), len(yaml_files), self.yaml_path)
+
+        accounts = {}
+        origins = {}
+        for yaml_file in yaml_files:
+            new_data, error = self.parsed_files[yaml_file]
+            if error is not None:
+                raise error
+            _merge_file_data(accounts, origins, yaml_file, new_data)
+        if not accounts:
+            raise Exception("Account data is empty.")
+
+        unchecked_accounts = dict((name, accounts[name]) for name, origin in origins.items()
+                                  if origin in self.unchecked_files)
+        if unchecked_accounts:
+            _check_account_data(unchecked_accounts)
+            _check_new_account_ids(accounts, unchecked_accounts)
+        self.unchecked_files.clear()
+        return accounts
+
+
+def _check_new_account_ids(accounts, new_accounts):
+    """Raise exception if an id of new_accounts is also used by another account"""
+    known_ids = set(account['id'] for name, account in accounts.items() if name not in new_accounts)
+    for account in new_accounts.values():
+        if account['id'] in known_ids:
+            raise Exception("duplicated id {0} found".format(account['id']))
+
+
+def _parse_files(yaml_files, jobs):
+    """Return an iterable of (data, error) tuples, in the order of yaml_files"""
+    jobs = min(jobs, len(yaml_files))
+    if jobs <= 1:
+        # Lazy, so that the first error stops parsing the remaining files.
+        return (_parse_yaml_file(yaml_file) for yaml_file in yaml_files)
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunksize = max(1, len(yaml_files) // (jobs * 4))
+        return pool.map(_parse_yaml_file, yaml_files, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _parse_cached_files(yaml_files, jobs, cache):
+    """Like _parse_files, but take the data of unchanged files from cache
+
+    Newly parsed files are stored in cache, the caller calls cache.evict()
+    when it is done, also if it stops early.
+    """
+    if min(jobs, len(yaml_files)) <= 1:
+        for yaml_file in yaml_files:
+            found, data_or_key = _look_up(cache, yaml_file)
+            if found:
+                yield data_or_key, None
+            else:
+                yield _store(cache, data_or_key, _parse_yaml_file(yaml_file))
+    else:
+        lookups = [_look_up(cache, yaml_file) for yaml_file in yaml_files]
+        missing_files = [yaml_file for yaml_file, (found, _) in zip(yaml_files, lookups) if not found]
+        parsed_files = iter(_parse_files(missing_files, jobs))
+        for found, data_or_key in lookups:
+            yield (data_or_key, None) if found else _store(cache, data_or_key, next(parsed_files))
+
+
+def _look_up(cache, yaml_file):
+    try:
+        return cache.get(yaml_file)
+    except EnvironmentError:
+        # Parsing the file will raise the same error as without cache.
+        return False, None
+
+
+def _store(cache, key, result):
+    data, error = result
+    if error is None and key is not None:
+        cache.put(key, data)
+    return result
+
+
+def _parse_yaml_file(yaml_file):
+    """Return (data, None) on success, (None, exception) on failure
+
+    Errors are returned instead of raised so that the caller can raise
+    them in file order, no matter which worker process finished first.
+    """
+    try:
+        return _load_yaml_file(yaml_file), None
+    except Exception as e:
+        return None, e
+
+
+def _list_yaml_files(yaml_path):
+    """Return the files to read, in the same order yamlreader uses"""
+    if os.path.isdir(yaml_path):
+        return sorted(glob.glob(os.path.join(yaml_path, "*.yaml")))
+    if os.path.isfile(yaml_path):
+        return [yaml_path]
+    return sorted(glob.glob(yaml_path))
+
+
+def _load_yaml_file(yaml_file):
+    try:
+        with open(yaml_file) as source:
+            return yaml.load(source, Loader=SafeLoader)
+    except yaml.MarkedYAMLError as e:
+        raise Exception("YAML Error in {0}: {1}".format(yaml_file, e))
+
+
+def _merge_file_data(accounts, origins, yaml_file, new_data, violations=None):
+    """Add new_data to accounts, raise or append to violations on errors"""
+    if new_data is None:
+        return
+    if not isinstance(new_data, dict):
+        message = "File {0} does not contain a mapping of account names".format(yaml_file)
+        if violations is None:
+            raise Exception(message)
+        violations.append(Violation(None, 'file-invalid', message, ERROR, yaml_file))
+        return
+    for name, account_data in new_data.items():
+        if name in origins:
+            message = "Duplicate definition of account {0!r} in {1} (already defined in {2})".format(
+                name, yaml_file, origins[name])
+            if violations is None:
+                raise Exception(message)
+            violations.append(Violation(name, 'duplicate-name', message, ERROR, yaml_file))
+            continue
+        accounts[name] = account_data
+        origins[name] = yaml_file
 
 
 def _check_account_data(accounts):
     """Raise exception if account data looks wrong, otherwise return True"""
-    if not accounts:
-        raise Exception("Account data is empty.")
-
-    all_account_ids = set()
-    for account_name, account_data in accounts.items():
-        account_id = account_data.get("id")
-        if account_id in all_account_ids:
-            raise Exception("duplicated id {0} found".format(account_id))
-        all_account_ids.add(account_id)
-        if not account_data.get("email"):
-            raise Exception("Account data {0} has no email.".format(account_name))
-        if "@" not in account_data.get("email"):
-            raise Exception("Account data {0} without @ in email.".format(account_name))
-        if not account_id:
-            raise Exception("Account data {0} has no account id.".format(account_name))
-        if 'owner' not in account_data:
-            raise Exception("Account {0} has no 'owner' field".format(account_name))
-        owner = account_data['owner']
-        if not isinstance(owner, six.string_types):
-            raise Exception("'owner' field of account {0} is not a string.".format(account_name))
-        if owner == "":
-            raise Exception("'owner' field of account {0} is empty.".format(account_name))
-
-        if "automated" in account_data:
-            automated = account_data['automated']
-            if not isinstance(automated, dict):
-                raise Exception("'automated' field of account {0} is not a dict.".format(account_name))
-            for key, value in automated.items():
-                if not isinstance(key, six.string_types):
-                    raise Exception(
-                        "{account_name}.automated may only contain strings, "
-                        "but the key '{key}' is of type {key_type}".format(
-                            account_name=account_name, key=key, key_type=type(key)))
-                if value not in (True, False):
-                    raise Exception(
-                        "{account_name}.automated.{key} must be boolean, "
-                        "but '{value}' is a {value_type}.".format(
-                            account_name=account_name, key=key, value=value,
-                            value_type=type(value)))
+    errors = validate_accounts(accounts).errors
+    if errors:
+        raise Exception(errors[0].message)
+    return True
@@ -2,8 +2,239 @@
 
 from __future__ import print_function, absolute_import, division
 
-""" This module read a xml file with AWS billing information and extracted the AWS account ids """
+""" This module reads AWS billing reports and extracts the linked AWS account ids """
 
+import csv
+import io
+import json
+import logging
+import tempfile
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
-def read_xml_and_return_account_ids(xml_file_path):
-    pass
+import six
+
+# Column (CSV) or element (XML) names that hold the linked account id, in
+# detailed billing reports and Cost and Usage Reports.
+LINKED_ACCOUNT_FIELDS = ("LinkedAccountId", "lineItem/UsageAccountId")
+REPORT_SUFFIXES = (".csv", ".csv.gz", ".csv.zip", ".xml", ".xml.gz")
+MANIFEST_SUFFIX = "-Manifest.json"
+CHUNK_SIZE = 1024 * 1024
+# Report parts are fetched with ranged GETs of this size, several parts at
+# a time. The S3 client must allow at least DOWNLOAD_THREADS connections.
+RANGE_SIZE = 8 * 1024 * 1024
+DOWNLOAD_THREADS = 8
+# ZIP archives are read from their end, so they are spooled first, to a
+# temporary file if they are larger than this.
+ZIP_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+def read_xml_and_return_account_ids(xml_file):
+    """Return the set of linked account ids in an XML billing report
+
+    xml_file is a file name or a binary file object. The report is parsed
+    incrementally and parsed elements are discarded, so memory use does not
+    grow with the size of the report.
+    """
+    account_ids = set()
+    root = None
+    for event, element in ElementTree.iterparse(xml_file, events=("start", "end")):
+        if root is None:
+            root = element
+        if event == "end":
+            if element.tag.rpartition("}")[2] in LINKED_ACCOUNT_FIELDS and element.text:
+                account_ids.add(element.text.strip())
+            root.clear()
+    return account_ids
+
+
+def read_csv_and_return_account_ids(csv_lines):
+    """Return the set of linked account ids in a CSV billing report
+
+    csv_lines is an iterable of lines, e.g. a file object opened in text
+    mode. Rows are processed one at a time.
+    """
+    reader = csv.reader(csv_lines)
+    header = next(reader, [])
+    columns = [index for index, name in enumerate(header) if name in LINKED_ACCOUNT_FIELDS]
+    if not columns:
+        raise Exception("Billing report has none of the columns {0}".format(", ".join(LINKED_ACCOUNT_FIELDS)))
+    column = columns[0]
+
+    account_ids = set()
+    for row in reader:
+        if len(row) > column and row[column]:
+            account_ids.add(row[column])
+    return account_ids
+
+
+def read_report_and_return_account_ids(name, chunks):
+    """Return the linked account ids of a billing report given as byte chunks
+
+    The format is derived from name, e.g. 'report.csv.gz' is a gzip
+    compressed CSV report. The chunks are decompressed and parsed as they
+    arrive. A '.zip' archive, as detailed billing reports are delivered,
+    must contain a single report file, it is spooled before it is read.
+    """
+    if name.endswith(".gz"):
+        chunks = _decompress(chunks)
+        name = name[:-len(".gz")]
+    elif name.endswith(".zip"):
+        chunks = _unzip(name, chunks)
+        name = name[:-len(".zip")]
+    report = io.BufferedReader(_ChunkReader(chunks), CHUNK_SIZE)
+    if name.endswith(".xml"):
+        return read_xml_and_return_account_ids(report)
+    if name.endswith(".csv"):
+        if six.PY2:
+            return read_csv_and_return_account_ids(report)
+        return read_csv_and_return_account_ids(io.TextIOWrapper(report, encoding="utf-8", newline=""))
+    raise Exception("Unknown format of billing report {0!r}".format(name))
+
+
+def read_billing_account_ids(s3_client, billing_bucket_name):
+    """Return the linked account ids of the latest report in the billing bucket
+
+    If the bucket contains Cost and Usage Reports, the report parts listed
+    in the latest manifest are downloaded and parsed concurrently.
+    Otherwise the latest single report file is read.
+    """
+    manifest_key = get_latest_report_key(s3_client, billing_bucket_name, suffixes=(MANIFEST_SUFFIX,), required=False)
+    if manifest_key is not None:
+        return read_manifest_account_ids(s3_client, billing_bucket_name, manifest_key)
+
+    key_name = get_latest_report_key(s3_client, billing_bucket_name)
+    logging.info("Reading billing report '%s' from bucket '%s'", key_name, billing_bucket_name)
+    return _read_object_account_ids(s3_client, billing_bucket_name, key_name)
+
+
+def read_manifest_account_ids(s3_client, billing_bucket_name, manifest_key):
+    """Return the linked account ids of all report parts listed in a manifest"""
+    body = s3_client.get_object(Bucket=billing_bucket_name, Key=manifest_key)['Body'].read()
+    manifest = json.loads(body.decode('utf-8'))
+    bucket_name = manifest.get('bucket') or billing_bucket_name
+    report_keys = manifest.get('reportKeys', [])
+    if not report_keys:
+        raise Exception("Billing report manifest '{0}' lists no report files".format(manifest_key))
+    logging.info("Reading %d billing report files of manifest '%s' from bucket '%s'",
+                 len(report_keys), manifest_key, bucket_name)
+
+    pool = ThreadPool(min(DOWNLOAD_THREADS, len(report_keys)))
+    try:
+        results = pool.map(lambda key_name: _read_object_account_ids(s3_client, bucket_name, key_name),
+                           report_keys, 1)
+    finally:
+        pool.close()
+        pool.join()
+    return set().union(*results)
+
+
+def _read_object_account_ids(s3_client, bucket_name, key_name):
+    """Download one report file with ranged GETs, parsing it while it arrives"""
+    size = s3_client.head_object(Bucket=bucket_name, Key=key_name)['ContentLength']
+    return read_report_and_return_account_ids(key_name, _iter_object_ranges(s3_client, bucket_name, key_name, size))
+
+
+def _iter_object_ranges(s3_client, bucket_name, key_name, size):
+    for start in range(0, size, RANGE_SIZE):
+        end = min(start + RANGE_SIZE, size) - 1
+        body = s3_client.get_object(Bucket=bucket_name, Key=key_name, Range="bytes={0}-{1}".format(start, end))['Body']
+        for chunk in iter(lambda: body.read(CHUNK_SIZE), b""):
+            yield chunk
+
+
+def get_latest_report_key(s3_client, billing_bucket_name, suffixes=REPORT_SUFFIXES, required=True):
+    """Return the key of the most recently modified object ending with one of suffixes"""
+    latest = None
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=billing_bucket_name):
+        for item in page.get('Contents', []):
+            candidate = (item['LastModified'], item['Key'])
+            if item['Key'].endswith(suffixes) and (latest is None or candidate > latest):
+                latest = candidate
+    if latest is None:
+        if not required:
+            return None
+        raise Exception("No billing report found in bucket '{0}'".format(billing_bucket_name))
+    return latest[1]
+
+
+def compare_account_ids(billing_account_ids, accounts):
+    """Compare the billed account ids with the published accounts
+
+    Returns a dict with the sorted 'unknown' account ids that are billed but
+    not published, and the sorted names of 'missing' accounts that are
+    published but not billed.
+    """
+    published_ids = set(str(account['id']) for account in accounts.values())
+    return {
+        'unknown': sorted(set(billing_account_ids) - published_ids),
+        'missing': sorted(name for name, account in accounts.items()
+                          if str(account['id']) not in billing_account_ids),
+    }
+
+
+def _decompress(chunks):
+    """Decompress gzip data, yielding at most CHUNK_SIZE bytes at a time
+
+    Like gunzip, this reads all members of a gzip file: input after the end
+    of a member is the start of the next one.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            chunk = decompressor.unconsumed_tail
+            if data:
+                yield data
+            if not chunk and decompressor.unused_data:
+                chunk = decompressor.unused_data
+                data = decompressor.flush()
+                if data:
+                    yield data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _unzip(name, chunks):
+    """Yield the content of the single file in a ZIP archive, at most CHUNK_SIZE bytes at a time"""
+    with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE) as spool:
+        for chunk in chunks:
+            spool.write(chunk)
+        spool.seek(0)
+        try:
+            archive = zipfile.ZipFile(spool)
+        except zipfile.BadZipfile as e:
+            raise Exception("Billing report {0!r} is not a ZIP archive: {1}".format(name, e))
+        with archive:
+            members = [member for member in archive.infolist() if not member.filename.endswith("/")]
+            if len(members) != 1:
+                raise Exception("Billing report {0!r} contains {1} files, expected one".format(name, len(members)))
+            with archive.open(members[0]) as member:
+                for chunk in iter(lambda: member.read(CHUNK_SIZE), b""):
+                    yield chunk
+
+
+class _ChunkReader(io.RawIOBase):
+    """Binary file object that reads from an iterator of byte chunks"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not len(self._buffer):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buffer = memoryview(chunk)
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Compact per-account change events, for publishing to the SNS topic of the bucket
+
+An event is a small JSON object: 'event' is added, removed or modified,
+'account' the account name, 'id' and 'owner' identify the account.
+Added accounts carry their 'data', modified accounts the JSON 'patch'
+from the old to the new account data (see snapshots.make_patch). The
+same fields are message attributes, so subscribers can use SNS filter
+policies, e.g. {"owner": ["my-team"]}. If there are more than
+MAX_CHANGE_EVENTS changes, a single 'bulk' event with the counts is sent
+instead, subscribers then read the whole list again.
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import json
+
+import six
+
+from ultimate_source_of_accounts.account import Account
+from ultimate_source_of_accounts.snapshots import make_patch
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+BULK = "bulk"
+MAX_CHANGE_EVENTS = 1000
+# Limits of SNS PublishBatch.
+BATCH_SIZE = 10
+BATCH_MAX_BYTES = 256 * 1024
+ATTRIBUTES = ('event', 'account', 'id', 'owner', 'previous_owner', 'version')
+
+
+def account_changes(old_accounts, new_accounts, version=None):
+    """Return the change events from old_accounts to new_accounts, sorted by account name"""
+    events = []
+    for name in sorted(set(old_accounts) | set(new_accounts)):
+        old = _plain(old_accounts.get(name))
+        new = _plain(new_accounts.get(name))
+        if old == new:
+            continue
+        if old is None:
+            event = {'event': ADDED, 'account': name, 'id': new.get('id'), 'owner': new.get('owner'), 'data': new}
+        elif new is None:
+            event = {'event': REMOVED, 'account': name, 'id': old.get('id'), 'owner': old.get('owner')}
+        else:
+            event = {'event': MODIFIED, 'account': name, 'id': new.get('id'), 'owner': new.get('owner'),
+                     'patch': make_patch(old, new)}
+            if old.get('owner') != new.get('owner'):
+                event['previous_owner'] = old.get('owner')
+        if version is not None:
+            event['version'] = version
+        events.append(event)
+
+    if len(events) > MAX_CHANGE_EVENTS:
+        counts = dict((kind, 0) for kind in (ADDED, REMOVED, MODIFIED))
+        for event in events:
+            counts[event['event']] += 1
+        bulk_event = dict(counts, event=BULK)
+        if version is not None:
+            bulk_event['version'] = version
+        return [bulk_event]
+    return events
+
+
+def _plain(account):
+    return account.to_json_obj() if isinstance(account, Account) else account
+
+
+def message_attributes(event):
+    """Return the SNS message attributes of an event, for filter policies"""
+    return dict((name, {'DataType': 'String', 'StringValue': six.text_type(event[name])})
+                for name in ATTRIBUTES if event.get(name) not in (None, ''))
+
+
+def batch_entries(events):
+    """Split the events into lists of PublishBatch entries, within the limits of SNS"""
+    batches, batch, size = [], [], 0
+    for event in events:
+        message = json.dumps(event, sort_keys=True, separators=(',', ':'))
+        attributes = message_attributes(event)
+        entry_size = len(message.encode('utf-8')) + sum(
+            len(name) + len(value['DataType']) + len(value['StringValue'].encode('utf-8'))
+            for name, value in attributes.items())
+        if batch and (len(batch) == BATCH_SIZE or size + entry_size > BATCH_MAX_BYTES):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append({'Id': str(len(batch)), 'Message': message, 'MessageAttributes': attributes})
+        size += entry_size
+    if batch:
+        batches.append(batch)
+    return batches
@@ -5,78 +5,563 @@
 Tool to upload/check a list of your AWS accounts to an S3 bucket
 
 Usage:
+    ultimate-source-of-accounts serve (--import=<data-directory> | <destination-bucket-name>) [--listen=<address>]
+    [--jobs=<N>] [--no-cache] [--verbose] [--metrics=<target>]
     ultimate-source-of-accounts --import=<data-directory> [--organization-id=<ORG_ID>...] [--allowed-ip=<IP>...]
-    <destination-bucket-name> [--verbose]
+    [--jobs=<N>] [--no-cache] [--gzip] [--indexes]
+    [[--snapshots] [--change-events] [--watch] | --plan=<plan-file> | --apply=<plan-file>]
+    <destination-bucket-name>... [--verbose] [--metrics=<target>]
+    ultimate-source-of-accounts --import=<data-directory> --validate-only [--json] [--jobs=<N>] [--no-cache]
+    [--verbose] [--metrics=<target>]
     ultimate-source-of-accounts --check-billing=<billing-bucket-name> <destination-bucket-name> [--verbose]
+    [--metrics=<target>]
 
 Options:
   -h --help                             Show this.
   --allowed-ip=IP                       IP with access to the destination bucket, can be used multiple times
   --organization-id=ORG_ID              AWS Org ID instead of individual account IDs, can be used multiple times
-  --check-billing=<billing-bucket-name> Check Billing account
+  --check-billing=<billing-bucket-name> Compare the latest billing report with the published accounts
   -v --verbose                          Log more stuff
   --import=<data-directory>             Import account list from directory
-  <destination-bucket-name>             Target bucket
+  --jobs=<N>                            Parse the data directory with N worker processes [default: 1]
+  --no-cache                            Parse all files, do not use ~/.cache/ultimate-source-of-accounts
+  --gzip                                Store the objects gzip compressed, with 'Content-Encoding: gzip'
+  --indexes                             Also publish by-id/, by-name/ and by-owner/ lookup objects
+  --snapshots                           Also publish snapshots/<version>.json, deltas/ from the previous version
+                                        and the pointer latest.json
+  --change-events                       Publish an SNS message per added, removed or modified account
+  --watch                               Keep running and publish again whenever the data directory changes
+  --plan=<plan-file>                    Only read the current state, write the changes to make as JSON ('-': stdout)
+  --apply=<plan-file>                   Make the changes of a --plan for the same data, options and destinations
+  --validate-only                       Report every problem in the data directory, do not publish anything
+  --json                                Print the --validate-only report as JSON
+  --metrics=<target>                    Report timings and counters as JSON lines to a file ('-': stderr),
+                                        or to statsd://<host>:<port>
+  --listen=<address>                    Serve the accounts over HTTP on [<host>:]<port> [default: 127.0.0.1:8080]
+  <destination-bucket-name>             Target bucket, as <bucket>[@<region>], the default region is eu-west-1
 """
 
 from __future__ import print_function, absolute_import, division
 
-import sys
+import functools
+import json
 import logging
-from docopt import docopt
+import sys
+
+import six
+from docopt import docopt, DocoptExit
 
-from ultimate_source_of_accounts.account_importer import read_directory
-from ultimate_source_of_accounts.account_converter import get_converted_aws_accounts
-from ultimate_source_of_accounts.account_exporter import S3Uploader
+from ultimate_source_of_accounts.metrics import METRICS
+
+# boto3, yaml and the modules using them are imported by the functions that
+# need them: --help, usage errors and --validate-only start much faster.
+
+# Format of the files written by --plan.
+PLAN_VERSION = 1
+DEFAULT_ADDRESS = "127.0.0.1:8080"
 
 
 def check_billing(billing_bucket_name, destination_bucket_name):
-    print("This feature is not yet implemented.")
-    sys.exit(1)
+    """Compare the accounts in the latest billing report with the published ones
+
+    Prints billed accounts that are not published and published accounts
+    that are not billed. Exits with 1 if there are billed accounts that
+    are not published.
+    """
+    import boto3
+    from botocore.config import Config
+    from ultimate_source_of_accounts.account_exporter import S3Uploader, CLIENT_CONFIG
+    from ultimate_source_of_accounts.metrics import instrument_client
+    from ultimate_source_of_accounts.billing_data import (
+        read_billing_account_ids, compare_account_ids, DOWNLOAD_THREADS)
+
+    session = boto3.Session()
+    bucket_name, region_name = parse_destination(destination_bucket_name)
+    uploader = S3Uploader(bucket_name, region_name=region_name, session=session)
+    accounts = uploader.get_published_accounts()
+    if accounts is None:
+        raise Exception("No account list published in bucket '{0}'".format(bucket_name))
+
+    billing_s3_client = instrument_client(
+        session.client('s3', config=CLIENT_CONFIG.merge(Config(max_pool_connections=DOWNLOAD_THREADS))))
+    billing_account_ids = read_billing_account_ids(billing_s3_client, billing_bucket_name)
+    report = compare_account_ids(billing_account_ids, accounts)
+    for account_id in report['unknown']:
+        print("Account {0} is billed, but not in the account list.".format(account_id))
+    for name in report['missing']:
+        print("Account {0} ({1}) is in the account list, but not billed.".format(name, accounts[name]['id']))
+    print("{0} billed accounts, {1} unknown, {2} published accounts not billed.".format(
+        len(billing_account_ids), len(report['unknown']), len(report['missing'])))
+    if report['unknown']:
+        sys.exit(1)
+    return report
+
+
+def validate(data_directory, jobs=1, use_cache=False, as_json=False):
+    """Print all violations of the accounts in data_directory
+
+    With as_json, the report is printed as one JSON document instead of one
+    line per violation. Exits with 1 if there are errors, warnings alone are
+    fine. Otherwise returns the ValidationReport.
+    """
+    from ultimate_source_of_accounts.account_importer import validate_directory
+    from ultimate_source_of_accounts.parse_cache import ParseCache
+
+    cache = ParseCache() if use_cache else None
+    _, report = validate_directory(data_directory, jobs=jobs, cache=cache)
+    if as_json:
+        print(json.dumps(report.to_dict(), indent=2, sort_keys=True))
+    else:
+        for violation in report.violations:
+            location = "{0}: ".format(violation.file) if violation.file else ""
+            print("{0}{1}: {2} [{3}]".format(location, violation.severity, violation.message, violation.rule))
+        print("{0} accounts, {1} errors, {2} warnings.".format(
+            report.account_count, len(report.errors), len(report.warnings)))
+    if report.errors:
+        sys.exit(1)
+    return report
+
+
+def parse_destination(destination):
+    """Split '<bucket>[@<region>]' into bucket name and region (or None)"""
+    bucket_name, _, region_name = destination.partition('@')
+    if not bucket_name:
+        raise Exception("Invalid destination {0!r}, expected <bucket>[@<region>]".format(destination))
+    return bucket_name, region_name or None
 
 
 def upload(
         data_directory,
-        destination_bucket_name,
+        destinations,
+        allowed_ips=None,
+        allowed_organization_ids=None,
+        jobs=1,
+        compress=False,
+        indexes=False,
+        use_cache=False,
+        snapshots=False,
+        change_events=False):
+    """Publish the accounts in data_directory to all destinations
+
+    The data is read and converted once, the destinations are then set up
+    and uploaded to concurrently. Returns a dict destination -> result of
+    upload_to_S3, raises an exception naming every failed destination.
+    With snapshots, the accounts are also published as a new version, see
+    S3Uploader.publish_snapshot(). With change_events, the changes to the
+    accounts published before are sent to the SNS topic, see
+    S3Uploader.publish_change_events().
+    """
+    destinations = _as_list(destinations)
+    account_data = _read_accounts(data_directory, jobs, use_cache)
+    uploaders = _create_uploaders(destinations, account_data, allowed_ips, allowed_organization_ids, compress)
+    return _publish(destinations, uploaders, account_data, indexes, compress=compress, snapshots=snapshots,
+                    change_events=change_events)
+
+
+def plan(
+        data_directory,
+        destinations,
+        plan_file='-',
+        allowed_ips=None,
+        allowed_organization_ids=None,
+        jobs=1,
+        compress=False,
+        indexes=False,
+        use_cache=False):
+    """Write the changes upload() would make to plan_file as JSON, '-' is stdout
+
+    Only read-only requests are made, see S3Uploader.plan(). The plan has
+    one entry per destination, it is also returned.
+    """
+    from ultimate_source_of_accounts.account_converter import get_streaming_aws_accounts, get_index_objects
+    from ultimate_source_of_accounts.account_exporter import spooled_upload_data
+
+    destinations = _as_list(destinations)
+    account_data = _read_accounts(data_directory, jobs, use_cache)
+    uploaders = _create_uploaders(destinations, account_data, allowed_ips, allowed_organization_ids, compress)
+    index_data = get_index_objects(account_data) if indexes else None
+
+    with spooled_upload_data(get_streaming_aws_accounts(account_data), compress) as data_to_upload:
+        plans = _run_for_all(destinations, uploaders, "plan for",
+                             lambda uploader, _: uploader.plan(data_to_upload, index_data))
+    for destination in destinations:
+        logging.info("Plan for '%s': %d changes", destination, len(plans[destination]['changes']))
+    document = {'version': PLAN_VERSION, 'indexes': indexes, 'destinations': plans}
+    content = json.dumps(document, sort_keys=True, indent=2)
+    if plan_file == '-':
+        print(content)
+    else:
+        with open(plan_file, 'w') as target:
+            target.write(content + "\n")
+    return document
+
+
+def apply(
+        data_directory,
+        destinations,
+        plan_file,
+        allowed_ips=None,
+        allowed_organization_ids=None,
+        jobs=1,
+        compress=False,
+        indexes=False,
+        use_cache=False):
+    """Make exactly the changes of a plan() for the same destinations and options
+
+    The current state is not read again. Objects whose content differs
+    from the plan, e.g. because the data directory changed since, are not
+    uploaded and fail the destination. Returns a dict destination -> applied
+    changes.
+    """
+    from ultimate_source_of_accounts.account_converter import get_streaming_aws_accounts, get_index_objects
+    from ultimate_source_of_accounts.account_exporter import spooled_upload_data
+
+    destinations = _as_list(destinations)
+    with open(plan_file) as source:
+        document = json.load(source)
+    if document.get('version') != PLAN_VERSION:
+        raise Exception("Plan file '{0}' has version {1}, expected {2}".format(
+            plan_file, document.get('version'), PLAN_VERSION))
+    if sorted(document['destinations']) != sorted(destinations) or document['indexes'] != indexes:
+        raise Exception("Plan file '{0}' was made for {1}{2}, not for {3}{4}".format(
+            plan_file, ", ".join(sorted(document['destinations'])), " with --indexes" if document['indexes'] else "",
+            ", ".join(sorted(destinations)), " with --indexes" if indexes else ""))
+
+    account_data = _read_accounts(data_directory, jobs, use_cache)
+    uploaders = _create_uploaders(destinations, account_data, allowed_ips, allowed_organization_ids, compress)
+    index_data = get_index_objects(account_data) if indexes else None
+    with spooled_upload_data(get_streaming_aws_accounts(account_data), compress) as data_to_upload:
+        return _run_for_all(destinations, uploaders, "apply plan to",
+                            lambda uploader, destination: uploader.apply(
+                                document['destinations'][destination], data_to_upload, index_data))
+
+
+def watch(
+        data_directory,
+        destinations,
         allowed_ips=None,
-        allowed_organization_ids=None):
-    allowed_ips = allowed_ips or []
+        allowed_organization_ids=None,
+        jobs=1,
+        compress=False,
+        indexes=False,
+        use_cache=False,
+        changes=None,
+        metrics=None,
+        snapshots=False,
+        change_events=False):
+    """Publish the accounts in data_directory, then again whenever it changes
+
+    The uploaders and their boto3 clients are kept for the whole session.
+    Only changed files are parsed and checked again, and the accounts are
+    only published if they differ from the last published ones. Invalid
+    data is logged and not published. changes is an iterable of sets of
+    changed files, by default a DirectoryWatcher for data_directory. If a
+    metrics target is given, the metrics are reported after every cycle.
+    """
+    from ultimate_source_of_accounts.account_importer import IncrementalReader
+    from ultimate_source_of_accounts.parse_cache import ParseCache
+    from ultimate_source_of_accounts.watcher import DirectoryWatcher
+
+    destinations = _as_list(destinations)
+    cache = ParseCache() if use_cache else None
+    reader = IncrementalReader(data_directory, jobs=jobs, cache=cache)
+    try:
+        account_data = reader.read()
+    except Exception as e:
+        raise Exception(
+            "Failed to read data directory '{0}': {1} ".format(
+                data_directory, e))
+
+    uploaders = _create_uploaders(destinations, account_data, allowed_ips, allowed_organization_ids, compress)
+    _publish(destinations, uploaders, account_data, indexes, compress=compress, snapshots=snapshots,
+             change_events=change_events)
+    published_data = account_data
+    if metrics:
+        METRICS.report(metrics)
+
+    if changes is None:
+        changes = DirectoryWatcher(data_directory)
+    logging.info("Watching '%s' for changes", data_directory)
+    for changed_files in changes:
+        logging.info("Changed files: %s", ", ".join(sorted(changed_files)))
+        try:
+            try:
+                account_data = reader.update(changed_files)
+            except Exception as e:
+                logging.error("Not publishing, failed to read data directory '%s': %s", data_directory, e)
+                continue
+            if account_data == published_data:
+                logging.info("Accounts did not change, nothing to publish")
+                continue
+
+            our_account_ids = _account_ids(account_data)
+            setup = sorted(our_account_ids) != sorted(_account_ids(published_data))
+            for uploader in uploaders:
+                uploader.allowed_aws_account_ids = our_account_ids
+            try:
+                _publish(destinations, uploaders, account_data, indexes, setup=setup, compress=compress,
+                         snapshots=snapshots, change_events=change_events)
+            except Exception as e:
+                logging.error("%s", e)
+                continue
+            published_data = account_data
+        finally:
+            if metrics:
+                METRICS.report(metrics)
+
+
+def serve(data_directory=None, destination=None, address=DEFAULT_ADDRESS, jobs=1, use_cache=False, changes=None):
+    """Answer lookups over HTTP from memory until interrupted
+
+    The accounts are read from data_directory, or downloaded from the
+    accounts.json published in destination. They are reloaded whenever the
+    files in data_directory change (changes is an iterable of sets of
+    changed files, by default a DirectoryWatcher), or whenever the published
+    accounts.json gets a new ETag. See server.AccountIndex for the paths.
+    """
+    import threading
+    from ultimate_source_of_accounts.server import AccountServer, watch_directory, poll_published
+
+    if data_directory:
+        from ultimate_source_of_accounts.account_importer import IncrementalReader
+        from ultimate_source_of_accounts.parse_cache import ParseCache
+        from ultimate_source_of_accounts.watcher import DirectoryWatcher
+
+        reader = IncrementalReader(data_directory, jobs=jobs, cache=ParseCache() if use_cache else None)
+        try:
+            accounts = reader.read()
+        except Exception as e:
+            raise Exception(
+                "Failed to read data directory '{0}': {1} ".format(
+                    data_directory, e))
+        if changes is None:
+            changes = DirectoryWatcher(data_directory)
+        reload_accounts = functools.partial(watch_directory, reader=reader, changes=changes)
+    else:
+        from ultimate_source_of_accounts.account_exporter import S3Uploader
+
+        bucket_name, region_name = parse_destination(destination)
+        uploader = S3Uploader(bucket_name, region_name=region_name)
+        accounts, etag = uploader.fetch_published_accounts()
+        if accounts is None:
+            raise Exception("No account list published in bucket '{0}'".format(bucket_name))
+        reload_accounts = functools.partial(poll_published, uploader=uploader, etag=etag)
+
+    server = AccountServer(address, accounts)
+    reloader = threading.Thread(target=reload_accounts, args=(server,))
+    reloader.daemon = True
+    reloader.start()
+    logging.info("Serving %d accounts on http://%s:%d/", len(accounts), *server.server_address[:2])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def _read_accounts(data_directory, jobs, use_cache):
+    from ultimate_source_of_accounts.account_importer import read_directory
+    from ultimate_source_of_accounts.parse_cache import ParseCache
 
     try:
-        account_data = read_directory(data_directory)
+        cache = ParseCache() if use_cache else None
+        return read_directory(data_directory, jobs=jobs, cache=cache)
     except Exception as e:
         raise Exception(
             "Failed to read data directory '{0}': {1} ".format(
                 data_directory, e))
 
-    data_to_upload = get_converted_aws_accounts(account_data)
 
-    our_account_ids = [account['id'] for account in account_data.values()]
-    uploader = S3Uploader(destination_bucket_name,
-                          allowed_ips=allowed_ips,
-                          allowed_aws_account_ids=our_account_ids,
-                          allowed_organization_ids=allowed_organization_ids)
+def _as_list(destinations):
+    if isinstance(destinations, six.string_types):
+        return [destinations]
+    return destinations
+
+
+def _account_ids(account_data):
+    return [account['id'] for account in account_data.values()]
+
+
+def _create_uploaders(destinations, account_data, allowed_ips, allowed_organization_ids, compress):
+    import boto3
+    from ultimate_source_of_accounts.account_exporter import S3Uploader
+
+    # One session for all uploaders, so credentials are only resolved once.
+    session = boto3.Session()
+    uploaders = []
+    for destination in destinations:
+        bucket_name, region_name = parse_destination(destination)
+        uploaders.append(S3Uploader(bucket_name,
+                                    allowed_ips=allowed_ips or [],
+                                    allowed_aws_account_ids=_account_ids(account_data),
+                                    allowed_organization_ids=allowed_organization_ids,
+                                    region_name=region_name,
+                                    compress=compress,
+                                    session=session))
+    return uploaders
+
+
+def _publish(destinations, uploaders, account_data, indexes, setup=True, compress=False, snapshots=False,
+             change_events=False):
+    """Set up and upload to all destinations concurrently, see upload()
+
+    The objects are converted, spooled and hashed once, before the
+    destination threads start, and are shared by all of them.
+    """
+    from ultimate_source_of_accounts.account_converter import get_streaming_aws_accounts, get_index_objects
+    from ultimate_source_of_accounts.account_exporter import spooled_upload_data
+
+    index_data = get_index_objects(account_data) if indexes else None
+
+    def publish(uploader, _):
+        if setup:
+            uploader.setup_infrastructure()
+        old_account_data = uploader.get_published_accounts() if change_events else None
+        result = uploader.upload_to_S3(data_to_upload)
+        if index_data is not None:
+            result['indexes'] = uploader.upload_index_objects(index_data)
+        if snapshots:
+            result['snapshot'] = uploader.publish_snapshot(account_data)
+        if change_events:
+            version = result['snapshot']['version'] if snapshots else None
+            result['change_events'] = uploader.publish_change_events(old_account_data, account_data, version)
+        return result
+
+    with spooled_upload_data(get_streaming_aws_accounts(account_data), compress) as data_to_upload:
+        return _run_for_all(destinations, uploaders, "publish to", publish)
+
 
-    uploader.setup_infrastructure()
-    uploader.upload_to_S3(data_to_upload)
+def _run_for_all(destinations, uploaders, action, function):
+    """Call function(uploader, destination) for all destinations concurrently
+
+    Returns a dict destination -> result, raises an exception naming every
+    failed destination.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def run(item):
+        try:
+            return function(*item), None
+        except Exception as e:
+            return None, e
+
+    pool = ThreadPool(len(uploaders))
+    try:
+        outcomes = pool.map(run, list(zip(uploaders, destinations)))
+    finally:
+        pool.close()
+        pool.join()
+
+    results, failures = {}, []
+    for destination, (result, error) in zip(destinations, outcomes):
+        if error is None:
+            logging.info("Done: %s '%s'", action, destination)
+            results[destination] = result
+        else:
+            logging.error("Failed to %s '%s': %s", action, destination, error)
+            failures.append("{0} ({1})".format(destination, error))
+    if failures:
+        raise Exception("Failed to {0} {1} of {2} destinations: {3}".format(
+            action, len(failures), len(destinations), ", ".join(failures)))
+    return results
+
+
+def _watch_until_interrupted(data_directory, destinations, **kwargs):
+    """Watch like watch() does, but treat Ctrl-C as the normal way to stop"""
+    try:
+        watch(data_directory, destinations, **kwargs)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching '%s'", data_directory)
+
+
+def _jobs(arguments):
+    """Return the value of --jobs, exit with a usage error unless it is a positive integer"""
+    value = arguments.get('--jobs') or '1'
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise DocoptExit("--jobs must be a positive integer, not {0!r}".format(value))
+    return jobs
 
 
 def _main(arguments):
-    if arguments['--check-billing']:
+    metrics = arguments.get('--metrics')
+    METRICS.enabled = bool(metrics)
+    try:
+        _run(arguments, metrics)
+    finally:
+        if metrics:
+            METRICS.report(metrics)
+
+
+def _run(arguments, metrics):
+    if arguments.get('serve'):
+        destination = arguments['<destination-bucket-name>']
+        if isinstance(destination, list):
+            destination = destination[0] if destination else None
+        try:
+            serve(
+                data_directory=arguments['--import'],
+                destination=destination,
+                address=arguments.get('--listen') or DEFAULT_ADDRESS,
+                jobs=_jobs(arguments),
+                use_cache=not arguments.get('--no-cache', False))
+        except KeyboardInterrupt:
+            logging.info("Stopped serving")
+        except Exception:
+            logging.exception("Failed to serve data: ")
+            raise
+    elif arguments['--check-billing']:
         billing_bucket_name = arguments['--check-billing']
         destination_bucket_name = arguments['<destination-bucket-name>']
-        check_billing(billing_bucket_name, destination_bucket_name)
+        if isinstance(destination_bucket_name, list):
+            destination_bucket_name = destination_bucket_name[0]
+        try:
+            check_billing(billing_bucket_name, destination_bucket_name)
+        except Exception:
+            logging.exception("Failed to check billing data: ")
+            raise
+    elif arguments.get('--validate-only'):
+        try:
+            validate(
+                arguments['--import'],
+                jobs=_jobs(arguments),
+                use_cache=not arguments.get('--no-cache', False),
+                as_json=arguments.get('--json', False))
+        except Exception:
+            logging.exception("Failed to validate data: ")
+            raise
     else:
         try:
             allowed_ips = arguments['--allowed-ip']
             organization_ids = arguments.get('--organization-id')
             data_directory = arguments['--import']
-            destination_bucket_name = arguments['<destination-bucket-name>']
-            upload(
+            destinations = arguments['<destination-bucket-name>']
+            jobs = _jobs(arguments)
+            compress = arguments.get('--gzip', False)
+            indexes = arguments.get('--indexes', False)
+            use_cache = not arguments.get('--no-cache', False)
+            if arguments.get('--plan'):
+                publish = functools.partial(plan, plan_file=arguments['--plan'])
+            elif arguments.get('--apply'):
+                publish = functools.partial(apply, plan_file=arguments['--apply'])
+            elif arguments.get('--watch'):
+                publish = functools.partial(_watch_until_interrupted, metrics=metrics,
+                                            snapshots=arguments.get('--snapshots', False),
+                                            change_events=arguments.get('--change-events', False))
+            else:
+                publish = functools.partial(upload, snapshots=arguments.get('--snapshots', False),
+                                            change_events=arguments.get('--change-events', False))
+            publish(
                 data_directory,
-                destination_bucket_name,
+                destinations,
                 allowed_ips=allowed_ips,
-                allowed_organization_ids=organization_ids)
+                allowed_organization_ids=organization_ids,
+                jobs=jobs,
+                compress=compress,
+                indexes=indexes,
+                use_cache=use_cache)
         except Exception:
             logging.exception("Failed to upload data: ")
             raise
@@ -85,6 +570,7 @@ def _main(arguments):
 def main():
     try:
         arguments = docopt(__doc__)
+        _jobs(arguments)
     except SystemExit as exc:
         print(exc)
         sys.exit(1)
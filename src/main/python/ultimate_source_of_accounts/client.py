@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Read the published accounts, cached in memory and on disk"""
+
+from __future__ import print_function, absolute_import, division
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from six import BytesIO
+from six.moves.urllib.error import HTTPError, URLError
+from six.moves.urllib.request import Request, urlopen
+
+from ultimate_source_of_accounts.parse_cache import DEFAULT_DIRECTORY as CACHE_HOME
+
+DEFAULT_DIRECTORY = os.path.join(CACHE_HOME, 'client')
+# Seconds the accounts are used without asking the server whether they changed.
+DEFAULT_TTL = 300
+DEFAULT_TIMEOUT = 10
+# Seconds until the next attempt if the server could not be reached.
+RETRY_INTERVAL = 30
+# The prefixes the website routing of the bucket redirects to the published keys.
+FORMATS = {'json': 'accounts.json', 'min.json': 'accounts.min.json', 'yaml': 'accounts.yaml'}
+
+
+class AccountsClient(object):
+    """Fetch the published accounts from the website endpoint of the bucket
+
+    base_url is the website endpoint, e.g.
+    http://<bucket>.s3-website-eu-west-1.amazonaws.com, or the address of
+    the serve subcommand. The accounts are fetched through the json, yaml
+    or min.json prefix of the website routing and are used for ttl seconds.
+    After that, they are revalidated with If-None-Match, so unchanged
+    accounts are not downloaded again. The accounts and their ETag are also
+    stored in cache_directory (None: memory only), a new process starts
+    with them and does not need a request within the ttl. If the server
+    cannot be reached, stale accounts are used and a warning is logged.
+
+    The lookups get_by_id, get_by_name, get_by_owner and get_by_automated
+    use indexes that are built once per version of the accounts.
+    """
+    def __init__(self, base_url, ttl=DEFAULT_TTL, cache_directory=DEFAULT_DIRECTORY, format='json',
+                 timeout=DEFAULT_TIMEOUT):
+        if format not in FORMATS:
+            raise Exception("Unknown format {0!r}, expected one of {1}".format(format, ", ".join(sorted(FORMATS))))
+        self.url = base_url.rstrip('/') + '/' + format
+        self.key_name = FORMATS[format]
+        self.format = format
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache_file = None
+        if cache_directory is not None:
+            self.cache_file = os.path.join(
+                cache_directory, hashlib.sha256(self.url.encode('utf-8')).hexdigest() + '.json')
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked = None
+        self._expires = None
+        self._invalidated = False
+
+    def accounts(self):
+        """Return the dict account name -> account data"""
+        return self._current_version().accounts
+
+    def get_by_id(self, account_id):
+        """Return (name, account data) of the account with that id, or None"""
+        return self._current_version().by_id.get(str(account_id))
+
+    def get_by_name(self, name):
+        """Return the account data of the account with that name, or None"""
+        return self._current_version().accounts.get(name)
+
+    def get_by_owner(self, owner):
+        """Return the dict account name -> account data of all accounts of owner"""
+        return dict(self._current_version().by_owner.get(owner, {}))
+
+    def get_by_automated(self, flag):
+        """Return the dict account name -> account data of all accounts with that automated flag set"""
+        return dict(self._current_version().by_automated.get(flag, {}))
+
+    def invalidate(self):
+        """Revalidate the accounts on the next access, even within the ttl"""
+        self._invalidated = True
+
+    def handle_notification(self, message):
+        """Invalidate if message announces a new version of the read object
+
+        message is the SNS notification the bucket sends for
+        s3:ObjectCreated events, as JSON text or parsed, either as posted
+        to an HTTP(S) subscription or as the bare S3 event. Returns True if
+        the accounts were invalidated.
+        """
+        if not isinstance(message, dict):
+            message = json.loads(message)
+        if 'Message' in message:
+            message = json.loads(message['Message'])
+        for record in message.get('Records', []):
+            if (record.get('eventName', '').startswith('ObjectCreated') and
+                    record.get('s3', {}).get('object', {}).get('key') == self.key_name):
+                self.invalidate()
+                return True
+        return False
+
+    def _current_version(self):
+        with self._lock:
+            if self._version is None:
+                self._load_cache_file()
+            if self._version is None or self._invalidated or time.time() >= self._expires:
+                self._refresh()
+            return self._version
+
+    def _refresh(self):
+        etag = self._version.etag if self._version is not None else None
+        try:
+            body, etag = self._fetch(etag)
+        except (EnvironmentError, HTTPError, URLError) as e:
+            if self._version is None:
+                raise Exception("Failed to fetch accounts from '{0}': {1}".format(self.url, e))
+            logging.warning("Using accounts checked %.0fs ago, failed to fetch '%s': %s",
+                            time.time() - self._checked, self.url, e)
+            self._expires = time.time() + min(self.ttl, RETRY_INTERVAL)
+            return
+        if body is not None:
+            self._version = _Version(self._parse(body), etag)
+            logging.debug("Fetched %d accounts from '%s'", len(self._version.accounts), self.url)
+        self._checked = time.time()
+        self._expires = self._checked + self.ttl
+        self._invalidated = False
+        self._save_cache_file()
+
+    def _fetch(self, etag):
+        """Return the body and the ETag of the object, the body is None if it still has etag"""
+        request = Request(self.url, headers={'Accept-Encoding': 'gzip'})
+        if etag:
+            request.add_header('If-None-Match', etag)
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                return None, etag
+            raise
+        try:
+            body = response.read()
+            if response.info().get('Content-Encoding') == 'gzip':
+                body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+            return body, response.info().get('ETag')
+        finally:
+            response.close()
+
+    def _parse(self, body):
+        text = body.decode('utf-8')
+        if self.format == 'yaml':
+            import yaml
+            try:
+                from yaml import CSafeLoader as SafeLoader
+            except ImportError:
+                from yaml import SafeLoader
+            return yaml.load(text, Loader=SafeLoader)
+        return json.loads(text)
+
+    def _load_cache_file(self):
+        if self.cache_file is None:
+            return
+        try:
+            with open(self.cache_file) as source:
+                entry = json.load(source)
+        except (EnvironmentError, ValueError):
+            return
+        try:
+            version = _Version(entry['accounts'], entry['etag'])
+            expires = entry['checked'] + self.ttl
+        except (KeyError, TypeError, AttributeError) as e:
+            # Truncated or written by something else, the accounts are simply fetched again.
+            logging.debug("Ignoring invalid cache file '%s': %r", self.cache_file, e)
+            return
+        self._version, self._checked, self._expires = version, entry['checked'], expires
+
+    def _save_cache_file(self):
+        """Store the accounts and the time they were checked, problems are only logged"""
+        if self.cache_file is None:
+            return
+        entry = {'url': self.url, 'etag': self._version.etag, 'checked': self._checked,
+                 'accounts': self._version.accounts}
+        try:
+            directory = os.path.dirname(self.cache_file)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            handle, temp_name = tempfile.mkstemp(dir=directory)
+            with os.fdopen(handle, 'w') as target:
+                json.dump(entry, target)
+            getattr(os, 'replace', os.rename)(temp_name, self.cache_file)
+        except EnvironmentError as e:
+            logging.debug("Could not store accounts in '%s': %s", self.cache_file, e)
+
+
+class _Version(object):
+    """One version of the accounts, with the lookup indexes"""
+    def __init__(self, accounts, etag):
+        self.accounts = accounts
+        self.etag = etag
+        self.by_id = {}
+        self.by_owner = {}
+        self.by_automated = {}
+        for name, account in accounts.items():
+            self.by_id[str(account.get('id'))] = (name, account)
+            self.by_owner.setdefault(account.get('owner'), {})[name] = account
+            automated = account.get('automated')
+            if isinstance(automated, dict):
+                for flag, enabled in automated.items():
+                    if enabled is True:
+                        self.by_automated.setdefault(flag, {})[name] = account
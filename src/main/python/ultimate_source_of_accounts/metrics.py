@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Timings and counters of the pipeline stages, reported as JSON lines or StatsD
+
+Collecting is off until METRICS.enabled is set, the spans then only cost a
+clock read. Timings are kept one by one, counters are summed up per name
+and tags until the next report().
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import contextlib
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+
+PREFIX = "ultimate_source_of_accounts"
+STATSD_SCHEME = "statsd://"
+# Keep StatsD datagrams below the usual MTU.
+STATSD_MAX_PACKET_SIZE = 1400
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._timings = []
+        self._counters = {}
+
+    @contextlib.contextmanager
+    def span(self, name, **tags):
+        """Time the body of the with statement, which may add to the yielded tags"""
+        started = _clock()
+        try:
+            yield tags
+        finally:
+            if self.enabled:
+                self.timing(name, _clock() - started, **tags)
+
+    def timing(self, name, seconds, **tags):
+        if not self.enabled:
+            return
+        record = {'type': 'timing', 'name': name, 'value': round(seconds * 1000, 3), 'unit': 'ms',
+                  'timestamp': time.time(), 'tags': tags}
+        with self._lock:
+            self._timings.append(record)
+
+    def count(self, name, value=1, **tags):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def records(self):
+        """Return and forget everything collected since the last call"""
+        with self._lock:
+            timings, counters = self._timings, self._counters
+            self._timings, self._counters = [], {}
+        now = time.time()
+        return timings + [{'type': 'count', 'name': name, 'value': value, 'timestamp': now, 'tags': dict(tags)}
+                          for (name, tags), value in sorted(counters.items(), key=repr)]
+
+    def report(self, target):
+        """Send the collected records to target
+
+        target is a file name for JSON lines ('-' is stderr), or
+        statsd://<host>:<port> for StatsD datagrams with DogStatsD tags.
+        Problems are logged, metrics must never break a run.
+        """
+        records = self.records()
+        if not records:
+            return
+        try:
+            if target.startswith(STATSD_SCHEME):
+                host, _, port = target[len(STATSD_SCHEME):].rpartition(':')
+                send_statsd(records, host, int(port))
+            elif target == '-':
+                write_json_lines(records, sys.stderr)
+            else:
+                with open(target, 'a') as stream:
+                    write_json_lines(records, stream)
+        except (EnvironmentError, ValueError) as e:
+            logging.warning("Could not report metrics to '%s': %s", target, e)
+
+
+METRICS = Metrics()
+
+
+def instrument_client(client):
+    """Count the requests made by a boto3 client as aws.requests"""
+    service_name = client.meta.service_model.service_name
+
+    def count_request(model, http_response=None, **_):
+        status = getattr(http_response, 'status_code', None)
+        METRICS.count('aws.requests', service=service_name, operation=model.name, status=status)
+
+    client.meta.events.register('after-call', count_request)
+    return client
+
+
+def write_json_lines(records, stream):
+    for record in records:
+        stream.write(json.dumps(record, sort_keys=True) + "\n")
+    stream.flush()
+
+
+def statsd_lines(records):
+    for record in records:
+        line = "{0}.{1}:{2}|{3}".format(PREFIX, record['name'], record['value'],
+                                        'ms' if record['type'] == 'timing' else 'c')
+        if record['tags']:
+            line += "|#" + ",".join("{0}:{1}".format(key, value) for key, value in sorted(record['tags'].items()))
+        yield line
+
+
+def send_statsd(records, host, port):
+    """Send the records to a StatsD server, several lines per datagram"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packet = []
+        for line in statsd_lines(records):
+            if packet and len("\n".join(packet + [line])) > STATSD_MAX_PACKET_SIZE:
+                sock.sendto("\n".join(packet).encode('utf-8'), (host, port))
+                packet = []
+            packet.append(line)
+        if packet:
+            sock.sendto("\n".join(packet).encode('utf-8'), (host, port))
+    finally:
+        sock.close()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Cache the parsed content of yaml files on disk"""
+
+from __future__ import print_function, absolute_import, division
+
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import tempfile
+import time
+
+DEFAULT_DIRECTORY = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'ultimate-source-of-accounts')
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+# Part of the directory name, the marshal format may change between Python versions.
+CACHE_FORMAT = "parse-cache-1-py{0}{1}".format(*sys.version_info[:2])
+# Coarsest mtime granularity of the filesystems we expect (FAT: 2 seconds).
+RACY_NANOSECONDS = 2 * 10 ** 9
+
+
+class CacheKey(object):
+    """Identifies the content of a file at the time it was looked up"""
+    __slots__ = ('path', 'size', 'mtime', 'digest')
+
+    def __init__(self, path, size, mtime, digest):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+
+
+class ParseCache(object):
+    """Store the parsed content of each file, keyed by path, size, mtime and content hash
+
+    An entry is used without reading the file if size and mtime are
+    unchanged, and after comparing the SHA-256 of the content otherwise.
+    Like git does for its index, entries written within the mtime
+    granularity of the file's mtime are "racy": the file may have changed
+    again in the same clock tick, so their content hash is always compared.
+    Entries are stored with marshal, which loads much faster than yaml is
+    parsed. When the cache grows beyond max_size bytes, the least recently
+    used entries are removed. Problems with the cache are logged and
+    otherwise ignored, the caller then simply parses the file.
+    """
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_size=DEFAULT_MAX_SIZE):
+        self.directory = os.path.join(directory, CACHE_FORMAT)
+        self.max_size = max_size
+
+    def get(self, file_name):
+        """Return (True, data) for a cached file, (False, key) otherwise
+
+        The key must be passed to put() together with the parsed data.
+        """
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        mtime = getattr(stat, 'st_mtime_ns', None) or int(stat.st_mtime * 1e9)
+        entry = self._load_entry(path)
+        if entry is not None and (entry['size'], entry['mtime']) == (stat.st_size, mtime) \
+                and mtime < entry.get('written', 0) - RACY_NANOSECONDS:
+            self._touch(path)
+            return True, entry['data']
+
+        with open(path, 'rb') as source:
+            digest = hashlib.sha256(source.read()).hexdigest()
+        key = CacheKey(path, stat.st_size, mtime, digest)
+        if entry is not None and entry['digest'] == digest:
+            self.put(key, entry['data'])
+            return True, entry['data']
+        return False, key
+
+    def put(self, key, data):
+        entry = {'path': key.path, 'size': key.size, 'mtime': key.mtime, 'digest': key.digest, 'data': data,
+                 'written': int(time.time() * 1e9)}
+        try:
+            content = marshal.dumps(entry)
+        except ValueError as e:
+            logging.debug("Not caching '%s', its data cannot be marshalled: %s", key.path, e)
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, temp_name = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(handle, 'wb') as target:
+                target.write(content)
+            getattr(os, 'replace', os.rename)(temp_name, self._entry_name(key.path))
+        except EnvironmentError as e:
+            logging.debug("Could not write cache entry for '%s': %s", key.path, e)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into max_size"""
+        try:
+            entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+            entries = sorted((os.stat(name).st_mtime, os.stat(name).st_size, name) for name in entries)
+        except EnvironmentError:
+            return
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(name)
+            except EnvironmentError as e:
+                logging.debug("Could not remove cache entry '%s': %s", name, e)
+            total_size -= size
+
+    def _entry_name(self, path):
+        return os.path.join(self.directory, hashlib.sha256(path.encode('utf-8')).hexdigest())
+
+    def _load_entry(self, path):
+        try:
+            with open(self._entry_name(path), 'rb') as source:
+                entry = marshal.load(source)
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, dict) or entry.get('path') != path:
+            return None
+        return entry
+
+    def _touch(self, path):
+        try:
+            os.utime(self._entry_name(path), None)
+        except EnvironmentError:
+            pass
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Serve the account data from memory over HTTP, under the keys of the published objects"""
+
+from __future__ import print_function, absolute_import, division
+
+import hashlib
+import json
+import logging
+import time
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import unquote, urlsplit
+
+from ultimate_source_of_accounts.account import json_default
+from ultimate_source_of_accounts.account_converter import get_converted_aws_accounts, get_index_objects, index_key
+from ultimate_source_of_accounts.metrics import METRICS
+
+DEFAULT_HOST = "127.0.0.1"
+# Seconds between two checks of the published accounts.json for changes.
+POLL_INTERVAL = 30
+CONTENT_TYPES = {'json': 'application/json', 'yaml': 'application/yaml'}
+# The website routing of the bucket, see S3Uploader.get_routing_rules().
+ALIASES = {'/': '/accounts.json', '/json': '/accounts.json', '/yaml': '/accounts.yaml',
+           '/min.json': '/accounts.min.json'}
+NOT_FOUND = json.dumps({'error': 'not found'}).encode('utf-8')
+
+
+class AccountIndex(object):
+    """The responses for one version of the account data, by path
+
+    The bodies are those of the published objects: accounts.yaml,
+    accounts.json, accounts.min.json and the by-id/, by-name/ and by-owner/
+    index objects. by-automated/<flag>.json has all accounts that have
+    that automated flag set. The json, yaml and min.json prefixes and / work
+    as on the website endpoint of the bucket. Everything is rendered once, when the data
+    is loaded, so a lookup is a single dict access. The ETag of a response
+    is the MD5 of its body, as S3 computes it: a client only downloads a
+    lookup again if its result changed. The request handler percent-decodes
+    the path once, like S3 does with keys: by-owner/team%2Fx.json is
+    requested as /by-owner/team%252Fx.json.
+    """
+    def __init__(self, accounts):
+        objects = get_converted_aws_accounts(accounts)
+        objects.update(get_index_objects(accounts))
+        objects.update(get_automated_objects(accounts))
+        self.account_count = len(accounts)
+        self.responses = dict(("/" + key, _response(key, body)) for key, body in objects.items())
+        for alias, path in ALIASES.items():
+            self.responses[alias] = self.responses[path]
+
+    def get(self, path):
+        """Return (body, ETag, content type) of path, or None"""
+        return self.responses.get(path)
+
+
+def get_automated_objects(accounts):
+    """Return "by-automated/<flag>.json" -> the accounts with that flag set to true, keys as by index_key()"""
+    accounts_by_flag = {}
+    for name, account in accounts.items():
+        automated = account.get('automated')
+        if not isinstance(automated, dict):
+            continue
+        for flag, enabled in automated.items():
+            if enabled is True:
+                accounts_by_flag.setdefault(flag, {})[name] = account
+    return dict((index_key("by-automated/", flag),
+                 json.dumps(flag_accounts, sort_keys=True, indent=2, default=json_default))
+                for flag, flag_accounts in accounts_by_flag.items())
+
+
+def _response(key, body):
+    body = body.encode('utf-8')
+    content_type = CONTENT_TYPES.get(key.rpartition('.')[2], 'application/text')
+    return body, '"{0}"'.format(hashlib.md5(body).hexdigest()), content_type
+
+
+def parse_address(address):
+    """Split '[<host>:]<port>' into host and port"""
+    host, _, port = address.rpartition(':')
+    try:
+        return host or DEFAULT_HOST, int(port)
+    except ValueError:
+        raise Exception("Invalid address {0!r}, expected [<host>:]<port>".format(address))
+
+
+class AccountServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering GET and HEAD requests from an AccountIndex
+
+    Every request is handled in its own thread. update() replaces the
+    index as a whole, requests in flight still answer from the old one.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, accounts):
+        HTTPServer.__init__(self, parse_address(address), _RequestHandler)
+        self.index = AccountIndex(accounts)
+
+    def update(self, accounts):
+        with METRICS.span('serve.reload', accounts=len(accounts)):
+            self.index = AccountIndex(accounts)
+        logging.info("Serving %d accounts now", len(accounts))
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open, clients usually make many small lookups. Headers
+    # and body are separate writes, with Nagle's algorithm the body would wait
+    # for the delayed ACK of the headers.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server_version = "ultimate-source-of-accounts"
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body):
+        response = self.server.index.get(unquote(urlsplit(self.path).path))
+        if response is None:
+            status, body, etag, content_type = 404, NOT_FOUND, None, CONTENT_TYPES['json']
+        else:
+            body, etag, content_type = response
+            status = 304 if _matches(self.headers.get('If-None-Match'), etag) else 200
+        METRICS.count('serve.requests', status=status)
+
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if status == 304:
+            self.end_headers()
+            return
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s", self.client_address[0], format % args)
+
+
+def _matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or any(candidate.replace('W/', '', 1) == etag for candidate in candidates)
+
+
+def watch_directory(server, reader, changes):
+    """Update server with the accounts of reader whenever changes yields changed files
+
+    Invalid data is logged, the server then keeps serving the last valid
+    accounts.
+    """
+    for changed_files in changes:
+        try:
+            accounts = reader.update(changed_files)
+        except Exception as e:
+            logging.error("Keeping the served accounts, failed to read data directory '%s': %s", reader.yaml_path, e)
+            continue
+        server.update(accounts)
+
+
+def poll_published(server, uploader, etag, ticks=None):
+    """Update server whenever the accounts.json published by uploader changes
+
+    The object is only downloaded again if its ETag changed. ticks is an
+    iterable, checked once per item, by default every POLL_INTERVAL seconds.
+    """
+    for _ in ticks if ticks is not None else _every(POLL_INTERVAL):
+        try:
+            accounts, etag = uploader.fetch_published_accounts(etag)
+        except Exception as e:
+            logging.error("Keeping the served accounts, failed to check bucket '%s': %s", uploader.bucket_name, e)
+            continue
+        if accounts is not None:
+            server.update(accounts)
+
+
+def _every(seconds):
+    while True:
+        time.sleep(seconds)
+        yield
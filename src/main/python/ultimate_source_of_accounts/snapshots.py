@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Versioned snapshots of the accounts and JSON patches between them
+
+Every version of the accounts is stored once as snapshots/<version>.json,
+where the version is the SHA-256 of that minified JSON. The small pointer
+latest.json names the current version. deltas/<version>.json is the
+JSON patch (RFC 6902) from that version to the version that replaced it,
+so a consumer at an old version follows deltas/ until it reaches the
+latest version, or falls back to the snapshot if a delta is missing.
+"""
+
+from __future__ import print_function, absolute_import, division
+
+import copy
+import hashlib
+import json
+
+from ultimate_source_of_accounts.account import json_default
+
+SNAPSHOT_PREFIX = "snapshots/"
+DELTA_PREFIX = "deltas/"
+LATEST_KEY = "latest.json"
+
+
+def snapshot_body(accounts):
+    """Return the canonical minified JSON of the accounts, as text"""
+    return json.dumps(accounts, sort_keys=True, separators=(',', ':'), default=json_default)
+
+
+def version_of(body):
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def snapshot_key(version):
+    return "{0}{1}.json".format(SNAPSHOT_PREFIX, version)
+
+
+def delta_key(version):
+    return "{0}{1}.json".format(DELTA_PREFIX, version)
+
+
+def snapshot_pointer(version, previous=None):
+    """Return the content of latest.json"""
+    return {'version': version, 'snapshot': snapshot_key(version), 'previous': previous,
+            'delta': delta_key(previous) if previous else None}
+
+
+def make_patch(old, new, path=""):
+    """Return the JSON patch operations that turn old into new
+
+    Dicts are compared key by key, an account that only changed its owner
+    becomes a single replace of /<name>/owner. All other values, lists
+    included, are replaced as a whole.
+    """
+    operations = []
+    for key in sorted(set(old) | set(new)):
+        key_path = path + "/" + _escape(key)
+        if key not in new:
+            operations.append({'op': 'remove', 'path': key_path})
+        elif key not in old:
+            operations.append({'op': 'add', 'path': key_path, 'value': new[key]})
+        elif isinstance(old[key], dict) and isinstance(new[key], dict):
+            operations.extend(make_patch(old[key], new[key], key_path))
+        elif old[key] != new[key] or type(old[key]) is not type(new[key]):
+            operations.append({'op': 'replace', 'path': key_path, 'value': new[key]})
+    return operations
+
+
+def apply_patch(document, operations):
+    """Return a copy of document with the add, remove and replace operations of a patch applied"""
+    document = copy.deepcopy(document)
+    for operation in operations:
+        keys = [_unescape(key) for key in operation['path'].split('/')[1:]]
+        target = document
+        for key in keys[:-1]:
+            target = target[key]
+        if operation['op'] == 'remove':
+            del target[keys[-1]]
+        elif operation['op'] in ('add', 'replace'):
+            target[keys[-1]] = copy.deepcopy(operation['value'])
+        else:
+            raise Exception("Unsupported patch operation {0!r}".format(operation['op']))
+    return document
+
+
+def _escape(key):
+    return key.replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(key):
+    return key.replace('~1', '/').replace('~0', '~')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Check account data against all rules and report every violation"""
+
+from __future__ import print_function, absolute_import, division
+
+import collections
+
+import six
+
+from ultimate_source_of_accounts.metrics import METRICS
+
+ERROR = "error"
+WARNING = "warning"
+
+# file is the yaml file the problem was found in, None where it is not known.
+Violation = collections.namedtuple('Violation', ['account', 'rule', 'message', 'severity', 'file'])
+Violation.__new__.__defaults__ = (None,)
+
+
+class ValidationReport(object):
+    """The violations found in a set of accounts, in the order they were found"""
+    def __init__(self, violations, account_count, owners):
+        self.violations = violations
+        self.account_count = account_count
+        self.owners = owners
+
+    @property
+    def errors(self):
+        return [violation for violation in self.violations if violation.severity == ERROR]
+
+    @property
+    def warnings(self):
+        return [violation for violation in self.violations if violation.severity == WARNING]
+
+    def to_dict(self):
+        return {
+            'accounts': self.account_count,
+            'owners': len(self.owners),
+            'errors': len(self.errors),
+            'warnings': len(self.warnings),
+            'violations': [violation._asdict() for violation in self.violations]}
+
+
+def validate_accounts(accounts):
+    """Check every account against every rule and return a ValidationReport
+
+    The indexes id -> names and email -> names are built in one pass over
+    the accounts, the rules are then checked in a second pass. Violations
+    are reported in the order in which _check_account_data used to raise
+    them: accounts in iteration order, the rules of each account in a fixed
+    order. Of several accounts with the same id, all but the first one get
+    a violation. Duplicate emails are only a warning, several accounts may
+    share one mailbox.
+    """
+    with METRICS.span('validate', accounts=len(accounts)) as tags:
+        report = _validate_accounts(accounts)
+        tags['errors'] = len(report.errors)
+    return report
+
+
+def _validate_accounts(accounts):
+    violations = []
+    if not accounts:
+        violations.append(Violation(None, 'empty', "Account data is empty.", ERROR))
+        return ValidationReport(violations, 0, set())
+
+    names_by_id = collections.defaultdict(list)
+    names_by_email = collections.defaultdict(list)
+    owners = set()
+    for account_name, account_data in accounts.items():
+        names_by_id[account_data.get("id")].append(account_name)
+        email = account_data.get("email")
+        if email:
+            names_by_email[email].append(account_name)
+        owner = account_data.get("owner")
+        if isinstance(owner, six.string_types) and owner:
+            owners.add(owner)
+
+    for account_name, account_data in accounts.items():
+        account_id = account_data.get("id")
+        if names_by_id[account_id][0] != account_name:
+            violations.append(Violation(
+                account_name, 'duplicate-id', "duplicated id {0} found".format(account_id), ERROR))
+        violations.extend(_check_account(account_name, account_data, names_by_email))
+
+    return ValidationReport(violations, len(accounts), owners)
+
+
+def _check_account(account_name, account_data, names_by_email):
+    """Yield the violations of a single account"""
+    account_id = account_data.get("id")
+    email = account_data.get("email")
+    if not email:
+        yield Violation(account_name, 'email-missing', "Account data {0} has no email.".format(account_name), ERROR)
+    elif not isinstance(email, six.string_types) or "@" not in email:
+        yield Violation(
+            account_name, 'email-invalid', "Account data {0} without @ in email.".format(account_name), ERROR)
+    elif names_by_email[email][0] != account_name:
+        yield Violation(account_name, 'duplicate-email', "Account {0} has the same email as {1}.".format(
+            account_name, names_by_email[email][0]), WARNING)
+    if not account_id:
+        yield Violation(account_name, 'id-missing', "Account data {0} has no account id.".format(account_name), ERROR)
+
+    if 'owner' not in account_data:
+        yield Violation(account_name, 'owner-missing', "Account {0} has no 'owner' field".format(account_name), ERROR)
+    elif not isinstance(account_data['owner'], six.string_types):
+        yield Violation(account_name, 'owner-invalid',
+                        "'owner' field of account {0} is not a string.".format(account_name), ERROR)
+    elif account_data['owner'] == "":
+        yield Violation(account_name, 'owner-invalid',
+                        "'owner' field of account {0} is empty.".format(account_name), ERROR)
+
+    if "automated" in account_data:
+        for violation in _check_automated(account_name, account_data['automated']):
+            yield violation
+
+
+def _check_automated(account_name, automated):
+    if not isinstance(automated, dict):
+        yield Violation(account_name, 'automated-invalid',
+                        "'automated' field of account {0} is not a dict.".format(account_name), ERROR)
+        return
+    for key, value in automated.items():
+        if not isinstance(key, six.string_types):
+            yield Violation(
+                account_name, 'automated-invalid',
+                "{account_name}.automated may only contain strings, "
+                "but the key '{key}' is of type {key_type}".format(
+                    account_name=account_name, key=key, key_type=type(key)),
+                ERROR)
+        elif value not in (True, False):
+            yield Violation(
+                account_name, 'automated-invalid',
+                "{account_name}.automated.{key} must be boolean, "
+                "but '{value}' is a {value_type}.".format(
+                    account_name=account_name, key=key, value=value, value_type=type(value)),
+                ERROR)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Detect changed yaml files in the data directory"""
+
+from __future__ import print_function, absolute_import, division
+
+import logging
+import os
+import time
+
+from ultimate_source_of_accounts.account_importer import _list_yaml_files
+
+POLL_INTERVAL = 1.0
+DEBOUNCE_DELAY = 2.0
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class DirectoryWatcher(object):
+    """Iterate over the sets of yaml files in yaml_path that changed
+
+    The directory is polled every interval seconds, a file counts as changed
+    when it was added, removed or its size, mtime or inode changed. After a
+    change, polling goes on until nothing changed for debounce seconds, so a
+    burst of saves is reported as one set of files.
+    """
+    def __init__(self, yaml_path, interval=POLL_INTERVAL, debounce=DEBOUNCE_DELAY):
+        self.yaml_path = yaml_path
+        self.interval = interval
+        self.debounce = debounce
+        self.state = snapshot(yaml_path)
+
+    def __iter__(self):
+        while True:
+            yield self.wait_for_changes()
+
+    def wait_for_changes(self):
+        """Block until files changed and the directory was quiet for debounce seconds"""
+        changed_files = set()
+        last_change = None
+        while True:
+            time.sleep(self.interval)
+            state = snapshot(self.yaml_path)
+            changes = changed_files_between(self.state, state)
+            self.state = state
+            now = _clock()
+            if changes:
+                logging.debug("Detected changes in %s", ", ".join(sorted(changes)))
+                changed_files.update(changes)
+                last_change = now
+            elif changed_files and now - last_change >= self.debounce:
+                return changed_files
+
+
+def snapshot(yaml_path):
+    """Return a dict file name -> (size, mtime, inode) of the yaml files in yaml_path"""
+    state = {}
+    for yaml_file in _list_yaml_files(yaml_path):
+        try:
+            stat = os.stat(yaml_file)
+        except EnvironmentError:
+            # Removed after listing the directory, the next poll will tell.
+            continue
+        mtime = getattr(stat, 'st_mtime_ns', None) or stat.st_mtime
+        state[yaml_file] = (stat.st_size, mtime, stat.st_ino)
+    return state
+
+
+def changed_files_between(old_state, new_state):
+    """Return the set of files that were added, removed or modified"""
+    return set(name for name in set(old_state) | set(new_state) if old_state.get(name) != new_state.get(name))
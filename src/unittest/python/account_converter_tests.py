@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function, absolute_import, division
-from unittest2 import TestCase
+from unittest2 import TestCase, skipUnless
 from mock import patch
+from six.moves import reload_module
 import yaml
 import json
 
 import ultimate_source_of_accounts.account_converter as ac
+from ultimate_source_of_accounts.account import Account
 
 
 class AccountConverterTest(TestCase):
@@ -29,6 +31,41 @@ class AccountConverterTest(TestCase):
 
         self.assertEqual(decoded_result, account_data)
 
+    def test_return_accounts_as_minified_json_when_account_data_is_valid(self):
+        account_data = {"account_name1": {"id": 42, "email": "test.test@test.test"}}
+
+        result = ac.get_converted_aws_accounts(account_data)
+        json_result = result["accounts.min.json"]
+
+        self.assertEqual(json.loads(json_result), account_data)
+        self.assertNotIn(" ", json_result)
+        self.assertNotIn("\n", json_result)
+
+    def test_return_index_objects_by_id_name_and_owner(self):
+        account_data = {"account_name1": {"id": "42", "email": "test.test@test.test", "owner": "me"},
+                        "account_name2": {"id": "43", "email": "test.test@test.test", "owner": "me"}}
+
+        result = ac.get_index_objects(account_data)
+        decoded_result = dict((key, json.loads(value)) for key, value in result.items())
+
+        self.assertEqual(decoded_result, {
+            "by-id/42.json": {"account_name1": account_data["account_name1"]},
+            "by-id/43.json": {"account_name2": account_data["account_name2"]},
+            "by-name/account_name1.json": {"account_name1": account_data["account_name1"]},
+            "by-name/account_name2.json": {"account_name2": account_data["account_name2"]},
+            "by-owner/me.json": account_data})
+
+    def test_index_keys_encode_slashes_spaces_and_other_characters(self):
+        account_data = {u"my account": {"id": "42", "email": "test.test@test.test", "owner": "team/x"},
+                        u"k\xe4se?#%": {"id": "43", "email": "test.test@test.test", "owner": "team x"}}
+
+        result = ac.get_index_objects(account_data)
+
+        self.assertEqual(sorted(result), [
+            "by-id/42.json", "by-id/43.json",
+            "by-name/k%C3%A4se%3F%23%25.json", "by-name/my%20account.json",
+            "by-owner/team%20x.json", "by-owner/team%2Fx.json"])
+
     @patch("ultimate_source_of_accounts.account_converter.json.dumps")
     def test_raise_exception_when_json_convert_failed(self, json_dump_mock):
         account_data = {"account_name1": {"id": 42, "email": "test.test@test.test"}}
@@ -43,4 +80,85 @@ class AccountConverterTest(TestCase):
 
         yaml_dump_mock.side_effect = Exception("Failed to convert")
 
-        self.assertRaises(Exception, ac.get_converted_aws_accounts, account_data)
\ No newline at end of file
+        self.assertRaises(Exception, ac.get_converted_aws_accounts, account_data)
+
+    def test_yaml_output_can_only_contain_plain_yaml(self):
+        account_data = {"account_name1": {"id": 42, "email": "test.test@test.test", "owner": object()}}
+
+        self.assertRaises(Exception, ac.get_converted_aws_accounts, account_data)
+
+    @skipUnless(yaml.__with_libyaml__, "libyaml is not available")
+    def test_yaml_output_is_identical_with_and_without_libyaml(self):
+        account_data = {
+            "account_name1": {"id": "42", "email": "test.test@test.test", "owner": u"M\xfcller " * 50,
+                              "automated": {"foo": True, "bar": False}},
+            "account_name2": {"id": "43", "email": "test.test@test.test", "owner": "multi\nline " * 20}}
+
+        with patch("ultimate_source_of_accounts.account_converter.SafeDumper", yaml.CSafeDumper):
+            with_libyaml = ac.get_converted_aws_accounts(account_data)["accounts.yaml"]
+        with patch("ultimate_source_of_accounts.account_converter.SafeDumper", yaml.SafeDumper):
+            without_libyaml = ac.get_converted_aws_accounts(account_data)["accounts.yaml"]
+
+        self.assertEqual(with_libyaml, without_libyaml)
+        self.assertEqual(yaml.safe_load(with_libyaml), account_data)
+
+    def test_fall_back_to_pure_python_dumper_without_libyaml(self):
+        c_safe_dumper = yaml.__dict__.pop("CSafeDumper", None)
+        try:
+            reload_module(ac)
+            self.assertIs(ac.SafeDumper, yaml.SafeDumper)
+            self.test_return_accounts_as_yaml_when_account_data_is_valid()
+        finally:
+            if c_safe_dumper is not None:
+                yaml.CSafeDumper = c_safe_dumper
+            reload_module(ac)
+
+    def test_streaming_conversion_is_identical_to_conversion_in_memory(self):
+        account_data = dict(("account_%04d" % number, {"id": str(number), "email": "test.test@test.test",
+                                                       "owner": "owner %d" % (number % 7),
+                                                       "automated": {"foo": number % 2 == 0}})
+                            for number in range(2000))
+
+        converted = ac.get_converted_aws_accounts(account_data)
+        streaming = ac.get_streaming_aws_accounts(account_data)
+
+        self.assertEqual(sorted(streaming), sorted(converted))
+        for key_name, chunks in streaming.items():
+            chunk_list = list(chunks())
+            self.assertGreater(len(chunk_list), 1)
+            self.assertEqual("".join(chunk_list), converted[key_name])
+            self.assertEqual("".join(chunks()), converted[key_name])
+
+    def test_streaming_conversion_keeps_yaml_aliases_of_shared_objects(self):
+        automated = {"foo": True}
+        account_data = {"account_name1": {"id": "42", "automated": automated},
+                        "account_name2": {"id": "43", "automated": automated}}
+
+        converted = ac.get_converted_aws_accounts(account_data)["accounts.yaml"]
+        streaming = "".join(ac.get_streaming_aws_accounts(account_data)["accounts.yaml"]())
+
+        self.assertIn("&id001", converted)
+        self.assertEqual(streaming, converted)
+
+    def test_accounts_are_converted_like_plain_dicts(self):
+        automated = {"foo": True}
+        account_data = {"account_name1": {"id": "42", "email": "a@b.c", "owner": "me", "automated": automated},
+                        "account_name2": {"id": "43", "email": "a@b.c", "owner": "me", "automated": automated,
+                                          "extra": ["field"]}}
+        accounts = dict((name, Account.from_dict(data)) for name, data in account_data.items())
+
+        expected = ac.get_converted_aws_accounts(account_data)
+        self.assertEqual(ac.get_converted_aws_accounts(accounts), expected)
+        for key_name, chunks in ac.get_streaming_aws_accounts(accounts).items():
+            self.assertEqual("".join(chunks()), expected[key_name])
+        self.assertEqual(ac.get_index_objects(accounts), ac.get_index_objects(account_data))
+
+    def test_streaming_conversion_of_empty_data(self):
+        for key_name, chunks in ac.get_streaming_aws_accounts({}).items():
+            self.assertEqual("".join(chunks()), ac.get_converted_aws_accounts({})[key_name])
+
+    def test_streaming_conversion_raises_exception_when_convert_failed(self):
+        account_data = {"account_name1": {"id": 42, "email": object()}}
+
+        for chunks in ac.get_streaming_aws_accounts(account_data).values():
+            self.assertRaisesRegex(Exception, "Failed to convert", list, chunks())
@@ -2,13 +2,16 @@
 
 from __future__ import print_function, absolute_import, division
 from mock import patch
-from unittest2 import TestCase
+from unittest2 import TestCase, skipUnless
+from six.moves import reload_module
 import tempfile
 import shutil
 import os
 import yaml
 
 import ultimate_source_of_accounts.account_importer as ai
+from ultimate_source_of_accounts.parse_cache import ParseCache
+from ultimate_source_of_accounts.account import Account
 
 
 class AccountImportTest(TestCase):
@@ -95,6 +98,274 @@ class AccountImportTest(TestCase):
         finally:
             shutil.rmtree(directory)
 
+    def test_load_directory_records_origin_of_each_account(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_one_name = os.path.join(directory, "file_one.yaml")
+            file_two_name = os.path.join(directory, "file_two.yaml")
+            with open(file_one_name, "w") as file_one:
+                yaml.dump({"account_foo": {"id": 42}}, file_one)
+            with open(file_two_name, "w") as file_two:
+                yaml.dump({"account_bar": {"id": 43}, "account_baz": {"id": 44}}, file_two)
+            with open(os.path.join(directory, "empty.yaml"), "w") as empty:
+                empty.write("")
+            with open(os.path.join(directory, "ignored.txt"), "w") as ignored:
+                yaml.dump({"account_foo": {"id": 42}}, ignored)
+
+            accounts, origins = ai.load_directory(directory)
+
+            self.assertEqual(accounts, {"account_foo": {"id": 42},
+                                        "account_bar": {"id": 43},
+                                        "account_baz": {"id": 44}})
+            self.assertEqual(origins, {"account_foo": file_one_name,
+                                       "account_bar": file_two_name,
+                                       "account_baz": file_two_name})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_duplicate_account_name_error_names_both_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for filename in ("file_one.yaml", "file_two.yaml"):
+                with open(os.path.join(directory, filename), "w") as yaml_file:
+                    yaml.dump({"account_bar": {"id": 42}}, yaml_file)
+
+            with self.assertRaisesRegex(Exception, "'account_bar'.*file_two.yaml.*file_one.yaml"):
+                ai.load_directory(directory)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_raise_exception_when_directory_contains_no_yaml_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertRaises(Exception, ai.load_directory, directory)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_raise_exception_when_file_is_no_mapping(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, "list.yaml"), "w") as yaml_file:
+                yaml.dump(["account_bar"], yaml_file)
+
+            self.assertRaises(Exception, ai.load_directory, directory)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_validate_directory_reports_broken_files_as_violations(self):
+        directory = tempfile.mkdtemp()
+        try:
+            files = {
+                "a.yaml": "one:\n  id: 1\n  email: one@host.invalid\n  owner: me\n",
+                "b.yaml": "one:\n  id: 2\n  email: two@host.invalid\n  owner: me\n",
+                "c.yaml": "- not a mapping\n",
+                "d.yaml": "broken: [\n",
+                "e.yaml": "two: 2\nthree:\n  id: 3\n  owner: me\n"}
+            for filename, content in files.items():
+                with open(os.path.join(directory, filename), "w") as yaml_file:
+                    yaml_file.write(content)
+
+            accounts, report = ai.validate_directory(directory)
+
+            self.assertEqual(sorted(accounts), ["one", "three"])
+            self.assertEqual(
+                [(violation.rule, violation.account, os.path.basename(violation.file))
+                 for violation in report.errors],
+                [("duplicate-name", "one", "b.yaml"), ("file-invalid", None, "c.yaml"),
+                 ("file-invalid", None, "d.yaml"), ("account-invalid", "two", "e.yaml"),
+                 ("email-missing", "three", "e.yaml")])
+            self.assertIn("YAML Error", report.errors[2].message)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parallel_parsing_returns_same_data_as_serial_parsing(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for number in range(10):
+                with open(os.path.join(directory, "file_%02d.yaml" % number), "w") as yaml_file:
+                    yaml.dump({"account_%d" % number: {"id": number}}, yaml_file)
+
+            self.assertEqual(ai.load_directory(directory, jobs=3), ai.load_directory(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parallel_parsing_raises_same_error_as_serial_parsing(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for number in range(6):
+                with open(os.path.join(directory, "file_%02d.yaml" % number), "w") as yaml_file:
+                    yaml.dump({"account_%d" % number: {"id": number}}, yaml_file)
+            with open(os.path.join(directory, "file_02.yaml"), "a") as yaml_file:
+                yaml.dump({"account_0": {"id": 0}}, yaml_file)
+            with open(os.path.join(directory, "file_04.yaml"), "w") as yaml_file:
+                yaml_file.write("account_4: [unbalanced")
+
+            with self.assertRaises(Exception) as serial:
+                ai.load_directory(directory)
+            with self.assertRaises(Exception) as parallel:
+                ai.load_directory(directory, jobs=4)
+
+            self.assertIn("Duplicate definition of account 'account_0'", str(serial.exception))
+            self.assertEqual(str(serial.exception), str(parallel.exception))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_yaml_is_loaded_safely(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, "unsafe.yaml"), "w") as yaml_file:
+                yaml_file.write("account_foo: !!python/object/apply:os.getcwd []")
+
+            self.assertRaises(Exception, ai.load_directory, directory)
+        finally:
+            shutil.rmtree(directory)
+
+    @skipUnless(yaml.__with_libyaml__, "libyaml is not available")
+    def test_loaded_data_is_identical_with_and_without_libyaml(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, "account.yaml"), "w") as yaml_file:
+                yaml_file.write("account_one:\n  id: 0001\n  email: one@s24.de\n  automated: {foo: yes}\n")
+
+            with patch("ultimate_source_of_accounts.account_importer.SafeLoader", yaml.CSafeLoader):
+                with_libyaml = ai.load_directory(directory)
+            with patch("ultimate_source_of_accounts.account_importer.SafeLoader", yaml.SafeLoader):
+                without_libyaml = ai.load_directory(directory)
+
+            self.assertEqual(with_libyaml, without_libyaml)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fall_back_to_pure_python_loader_without_libyaml(self):
+        c_safe_loader = yaml.__dict__.pop("CSafeLoader", None)
+        try:
+            reload_module(ai)
+            self.assertIs(ai.SafeLoader, yaml.SafeLoader)
+            self.test_loaded_data_is_returned_data()
+        finally:
+            if c_safe_loader is not None:
+                yaml.CSafeLoader = c_safe_loader
+            reload_module(ai)
+
+    def test_cached_data_is_used_for_unchanged_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ParseCache(os.path.join(directory, "cache"))
+            for number in range(4):
+                with open(os.path.join(directory, "file_%d.yaml" % number), "w") as yaml_file:
+                    yaml.dump({"account_%d" % number: {"id": number, "email": "a@b.c", "owner": "me"}}, yaml_file)
+            cold = ai.read_directory(directory, cache=cache)
+
+            for jobs in (1, 2):
+                with patch("ultimate_source_of_accounts.account_importer._load_yaml_file") as load_mock:
+                    self.assertEqual(ai.read_directory(directory, jobs=jobs, cache=cache), cold)
+                self.assertFalse(load_mock.called)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cached_run_raises_same_errors_as_cold_run(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ParseCache(os.path.join(directory, "cache"))
+            for number in range(4):
+                with open(os.path.join(directory, "file_%d.yaml" % number), "w") as yaml_file:
+                    yaml.dump({"account_%d" % number: {"id": 42, "email": "a@b.c", "owner": "me"}}, yaml_file)
+            with open(os.path.join(directory, "file_3.yaml"), "w") as yaml_file:
+                yaml_file.write("account_3: [unbalanced")
+
+            errors = []
+            for jobs, use_cache in ((1, False), (1, True), (1, True), (2, True)):
+                with self.assertRaises(Exception) as cm:
+                    ai.read_directory(directory, jobs=jobs, cache=cache if use_cache else None)
+                errors.append(str(cm.exception))
+
+            self.assertEqual(len(set(errors)), 1, errors)
+            self.assertIn("YAML Error in", errors[0])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cache_is_evicted_when_an_error_stops_parsing(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ParseCache(os.path.join(directory, "cache"))
+            with open(os.path.join(directory, "file_0.yaml"), "w") as yaml_file:
+                yaml.dump({"account_0": {"id": 42, "email": "a@b.c", "owner": "me"}}, yaml_file)
+            with open(os.path.join(directory, "file_1.yaml"), "w") as yaml_file:
+                yaml_file.write("account_1: [unbalanced")
+
+            with patch.object(cache, "evict") as evict_mock:
+                self.assertRaises(Exception, ai.read_directory, directory, cache=cache)
+
+            evict_mock.assert_called_once_with()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_incremental_reader_parses_and_checks_only_changed_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for number in range(3):
+                with open(os.path.join(directory, "file_%d.yaml" % number), "w") as yaml_file:
+                    yaml.dump({"account_%d" % number: {"id": number + 1, "email": "a@b.c", "owner": "me"}}, yaml_file)
+            reader = ai.IncrementalReader(directory)
+            self.assertEqual(reader.read(), ai.read_directory(directory))
+
+            changed_file = os.path.join(directory, "file_1.yaml")
+            with open(changed_file, "w") as yaml_file:
+                yaml.dump({"account_1": {"id": 2, "email": "a@b.c", "owner": "you"}}, yaml_file)
+            with patch("ultimate_source_of_accounts.account_importer._load_yaml_file",
+                       wraps=ai._load_yaml_file) as load_mock:
+                with patch("ultimate_source_of_accounts.account_importer._check_account_data") as check_mock:
+                    accounts = reader.update([changed_file])
+
+            load_mock.assert_called_once_with(changed_file)
+            check_mock.assert_called_once_with({"account_1": {"id": "2", "email": "a@b.c", "owner": "you"}})
+            self.assertEqual(accounts, ai.read_directory(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_incremental_reader_finds_duplicate_ids_in_changed_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for number in range(2):
+                with open(os.path.join(directory, "file_%d.yaml" % number), "w") as yaml_file:
+                    yaml.dump({"account_%d" % number: {"id": number + 1, "email": "a@b.c", "owner": "me"}}, yaml_file)
+            reader = ai.IncrementalReader(directory)
+            reader.read()
+
+            changed_file = os.path.join(directory, "file_1.yaml")
+            with open(changed_file, "w") as yaml_file:
+                yaml.dump({"account_1": {"id": 1, "email": "a@b.c", "owner": "me"}}, yaml_file)
+            self.assertRaisesRegex(Exception, "duplicated id 1 found", reader.update, [changed_file])
+            # Still unchecked, even if another file changes next time.
+            self.assertRaisesRegex(Exception, "duplicated id 1 found", reader.update, [])
+
+            os.remove(changed_file)
+            self.assertEqual(list(reader.update([changed_file])), ["account_0"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_accounts_are_returned_as_account_objects(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, "account.yaml"), "w") as yaml_file:
+                yaml_file.write("account_one:\n  id: 1\n  email: one@s24.de\n  owner: me\n  cost_center: 7\n")
+            accounts = ai.read_directory(directory)
+
+            self.assertIsInstance(accounts["account_one"], Account)
+            self.assertEqual(accounts["account_one"].to_json_obj(),
+                             {"id": "1", "email": "one@s24.de", "owner": "me", "cost_center": 7})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_raise_exception_when_account_data_is_no_mapping(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, "account.yaml"), "w") as yaml_file:
+                yaml_file.write("account_one: 42\n")
+            self.assertRaisesRegex(Exception, "account_one is not a mapping", ai.read_directory, directory)
+        finally:
+            shutil.rmtree(directory)
+
     @patch("ultimate_source_of_accounts.account_importer._check_account_data")
     def test_loaded_data_is_checked(self, mock_check_account):
         directory = tempfile.mkdtemp()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+
+from ultimate_source_of_accounts.account import Account, MISSING, json_default
+
+
+class AccountTest(TestCase):
+    def setUp(self):
+        self.data = {"id": 42, "email": "me@host.invalid", "owner": "me", "automated": {"foo": True}, "note": "x"}
+        self.account = Account.from_dict(self.data)
+
+    def test_id_is_converted_to_string(self):
+        self.assertEqual(self.account.id, "42")
+
+    def test_unknown_fields_are_kept(self):
+        self.assertEqual(self.account.extra, {"note": "x"})
+        self.assertEqual(self.account.to_json_obj(), dict(self.data, id="42"))
+        self.assertEqual(self.account.to_yaml_obj(), dict(self.data, id="42"))
+
+    def test_missing_fields_are_not_written(self):
+        account = Account.from_dict({"id": None, "email": "me@host.invalid"})
+
+        self.assertIs(account.owner, MISSING)
+        self.assertIsNone(account.extra)
+        self.assertEqual(account.to_json_obj(), {"id": None, "email": "me@host.invalid"})
+
+    def test_account_can_be_read_like_a_dict(self):
+        self.assertEqual(self.account["id"], "42")
+        self.assertEqual(self.account["note"], "x")
+        self.assertEqual(self.account.get("missing", "default"), "default")
+        self.assertRaises(KeyError, lambda: Account()["owner"])
+        self.assertIn("owner", self.account)
+        self.assertNotIn("owner", Account())
+        self.assertEqual(sorted(self.account), sorted(self.data))
+        self.assertEqual(len(self.account), 5)
+
+    def test_account_is_equal_to_its_dict(self):
+        self.assertEqual(self.account, dict(self.data, id="42"))
+        self.assertEqual(dict(self.data, id="42"), self.account)
+        self.assertNotEqual(self.account, self.data)
+        self.assertEqual(self.account, Account.from_dict(self.data))
+        self.assertNotEqual(self.account, Account.from_dict(dict(self.data, owner="you")))
+
+    def test_account_does_not_use_a_dict_for_its_fields(self):
+        self.assertFalse(hasattr(self.account, "__dict__"))
+
+    def test_json_default_only_converts_accounts(self):
+        self.assertEqual(json_default(self.account), self.account.to_json_obj())
+        self.assertRaises(TypeError, json_default, object())
@@ -2,11 +2,172 @@
 
 from __future__ import print_function, absolute_import, division
 from unittest2 import TestCase
+from moto import mock_s3
+import boto3
+import gzip
+import io
+import json
+import os
+import zipfile
+from mock import patch
 
 import ultimate_source_of_accounts.billing_data as bd
 
+BUCKET_REGION = "us-west-2"
+
+# Else we run into problems with mocking
+os.environ['http_proxy'] = ''
+os.environ['https_proxy'] = ''
+os.environ['no_proxy'] = ''
+
+XML_REPORT = b"""<?xml version="1.0"?>
+<Report xmlns="http://example.invalid/billing">
+  <LineItem><LinkedAccountId>123456789012</LinkedAccountId><Cost>1.0</Cost></LineItem>
+  <LineItem><LinkedAccountId>210987654321</LinkedAccountId><Cost>2.0</Cost></LineItem>
+  <LineItem><LinkedAccountId>123456789012</LinkedAccountId><Cost>3.0</Cost></LineItem>
+  <LineItem><LinkedAccountId></LinkedAccountId><Cost>6.0</Cost></LineItem>
+</Report>
+"""
+CSV_REPORT = (b'"InvoiceID","PayerAccountId","LinkedAccountId","ItemDescription"\n'
+              b'"1","999999999999","123456789012","foo"\n'
+              b'"1","999999999999","210987654321","multi\nline"\n'
+              b'"1","999999999999","","total"\n')
+CUR_REPORT = (b'identity/LineItemId,bill/PayerAccountId,lineItem/UsageAccountId\n'
+              b'a,999999999999,123456789012\n'
+              b'b,999999999999,210987654321\n')
+
+
+def gzipped(data):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as compressed:
+        compressed.write(data)
+    return buffer.getvalue()
+
+
+def zipped(*members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def chunked(data, size=7):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
 
 class BillingDataTest(TestCase):
 
     def test_read_xml_and_return_account_ids(self):
-        result = bd.read_xml_and_return_account_ids("foo")
+        result = bd.read_xml_and_return_account_ids(io.BytesIO(XML_REPORT))
+
+        self.assertEqual(result, set(["123456789012", "210987654321"]))
+
+    def test_read_csv_and_return_account_ids(self):
+        result = bd.read_csv_and_return_account_ids(io.StringIO(CSV_REPORT.decode("utf-8"), newline=""))
+
+        self.assertEqual(result, set(["123456789012", "210987654321"]))
+
+    def test_read_csv_without_account_column_raises_exception(self):
+        self.assertRaises(Exception, bd.read_csv_and_return_account_ids, io.StringIO(u"foo,bar\n1,2\n"))
+
+    def test_read_report_in_chunks(self):
+        for name, data in (("report.xml", XML_REPORT), ("report.csv", CSV_REPORT), ("cur.csv", CUR_REPORT),
+                           ("report.xml.gz", gzipped(XML_REPORT)), ("cur.csv.gz", gzipped(CUR_REPORT)),
+                           ("report.csv.zip", zipped(("report.csv", CSV_REPORT))),
+                           ("cur.csv.zip", zipped(("cur.csv", CUR_REPORT)))):
+            result = bd.read_report_and_return_account_ids(name, chunked(data))
+
+            self.assertEqual(result, set(["123456789012", "210987654321"]), name)
+
+    def test_read_gzip_report_with_several_members(self):
+        split = CUR_REPORT.index(b"\n", CUR_REPORT.index(b"\n") + 1) + 1
+        members = [gzipped(CUR_REPORT[:split]), gzipped(CUR_REPORT[split:])]
+        for chunks in (chunked(b"".join(members)), members, [b"".join(members)]):
+            result = bd.read_report_and_return_account_ids("cur.csv.gz", chunks)
+
+            self.assertEqual(result, set(["123456789012", "210987654321"]))
+
+    def test_read_report_of_unknown_format_raises_exception(self):
+        self.assertRaises(Exception, bd.read_report_and_return_account_ids, "report.json", [b""])
+
+    def test_read_zip_report_with_several_files_raises_exception(self):
+        data = zipped(("one.csv", CSV_REPORT), ("two.csv", CUR_REPORT))
+
+        self.assertRaisesRegex(Exception, "contains 2 files", bd.read_report_and_return_account_ids,
+                               "report.csv.zip", chunked(data))
+
+    def test_read_large_zip_report_spools_to_file(self):
+        data = zipped(("cur.csv", CUR_REPORT + b"c,999999999999,123456789012\n" * 100000))
+
+        with patch.object(bd, "ZIP_SPOOL_MAX_SIZE", 1024):
+            result = bd.read_report_and_return_account_ids("cur.csv.zip", chunked(data, 4096))
+
+        self.assertEqual(result, set(["123456789012", "210987654321"]))
+
+    def test_compare_account_ids(self):
+        accounts = {"known": {"id": "123456789012"}, "unbilled": {"id": 111111111111}}
+
+        result = bd.compare_account_ids(set(["123456789012", "210987654321"]), accounts)
+
+        self.assertEqual(result, {'unknown': ["210987654321"], 'missing': ["unbilled"]})
+
+    @mock_s3
+    def test_read_billing_account_ids_reads_latest_report(self):
+        client = boto3.client('s3', region_name=BUCKET_REGION)
+        client.create_bucket(Bucket="billing", CreateBucketConfiguration={'LocationConstraint': BUCKET_REGION})
+        client.put_object(Bucket="billing", Key="2024-01-report.csv", Body=b"LinkedAccountId\n111111111111\n")
+        client.put_object(Bucket="billing", Key="2024-02-report.csv.gz", Body=gzipped(CUR_REPORT))
+        client.put_object(Bucket="billing", Key="not-a-report.txt", Body=b"foo")
+
+        result = bd.read_billing_account_ids(client, "billing")
+
+        self.assertEqual(result, set(["123456789012", "210987654321"]))
+
+    @mock_s3
+    def test_read_billing_account_ids_reads_zip_report(self):
+        client = boto3.client('s3', region_name=BUCKET_REGION)
+        client.create_bucket(Bucket="billing", CreateBucketConfiguration={'LocationConstraint': BUCKET_REGION})
+        client.put_object(Bucket="billing", Key="123-aws-billing-detailed-line-items-2024-02.csv.zip",
+                          Body=zipped(("123-aws-billing-detailed-line-items-2024-02.csv", CSV_REPORT)))
+
+        result = bd.read_billing_account_ids(client, "billing")
+
+        self.assertEqual(result, set(["123456789012", "210987654321"]))
+
+    @mock_s3
+    def test_read_billing_account_ids_from_empty_bucket_raises_exception(self):
+        client = boto3.client('s3', region_name=BUCKET_REGION)
+        client.create_bucket(Bucket="billing", CreateBucketConfiguration={'LocationConstraint': BUCKET_REGION})
+
+        self.assertRaises(Exception, bd.read_billing_account_ids, client, "billing")
+
+    @mock_s3
+    def test_read_billing_account_ids_reads_all_parts_of_latest_manifest(self):
+        client = boto3.client('s3', region_name=BUCKET_REGION)
+        client.create_bucket(Bucket="billing", CreateBucketConfiguration={'LocationConstraint': BUCKET_REGION})
+        part_one = CUR_REPORT
+        part_two = b'identity/LineItemId,lineItem/UsageAccountId\n' + b''.join(
+            b'x,%012d\n' % number for number in range(1000))
+        report_keys = ["cur/report/20240101-20240201/assembly/report-1.csv.gz",
+                       "cur/report/20240101-20240201/assembly/report-2.csv.gz"]
+        client.put_object(Bucket="billing", Key=report_keys[0], Body=gzipped(part_one))
+        client.put_object(Bucket="billing", Key=report_keys[1], Body=gzipped(part_two))
+        client.put_object(Bucket="billing", Key="cur/report/20240101-20240201/report-Manifest.json",
+                          Body=json.dumps({"bucket": "billing", "reportKeys": report_keys}))
+
+        with patch("ultimate_source_of_accounts.billing_data.RANGE_SIZE", 100):
+            with patch.object(client, "get_object", wraps=client.get_object) as get_object:
+                result = bd.read_billing_account_ids(client, "billing")
+
+        self.assertEqual(result, set(["123456789012", "210987654321"]) | set("%012d" % n for n in range(1000)))
+        ranges = [kwargs.get('Range') for _, kwargs in get_object.call_args_list if kwargs.get('Range')]
+        self.assertGreater(len(ranges), len(report_keys))
+
+    @mock_s3
+    def test_read_billing_account_ids_with_empty_manifest_raises_exception(self):
+        client = boto3.client('s3', region_name=BUCKET_REGION)
+        client.create_bucket(Bucket="billing", CreateBucketConfiguration={'LocationConstraint': BUCKET_REGION})
+        client.put_object(Bucket="billing", Key="report-Manifest.json", Body=json.dumps({"reportKeys": []}))
+
+        self.assertRaises(Exception, bd.read_billing_account_ids, client, "billing")
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+import json
+
+from mock import patch
+
+from ultimate_source_of_accounts.account import Account
+from ultimate_source_of_accounts import change_events
+
+OLD_ACCOUNTS = {
+    "one": {"id": "1", "email": "one@host.invalid", "owner": "me"},
+    "two": {"id": "2", "email": "two@host.invalid", "owner": "me"},
+    "three": {"id": "3", "email": "three@host.invalid", "owner": "me"},
+}
+
+
+class AccountChangesTest(TestCase):
+    def test_added_removed_and_modified_accounts(self):
+        new_accounts = {
+            "one": OLD_ACCOUNTS["one"],
+            "two": {"id": "2", "email": "two@host.invalid", "owner": "you"},
+            "four": {"id": "4", "email": "four@host.invalid", "owner": "you"},
+        }
+
+        events = change_events.account_changes(OLD_ACCOUNTS, new_accounts, version="abc")
+
+        self.assertEqual(events, [
+            {'event': 'added', 'account': 'four', 'id': '4', 'owner': 'you', 'data': new_accounts["four"],
+             'version': 'abc'},
+            {'event': 'removed', 'account': 'three', 'id': '3', 'owner': 'me', 'version': 'abc'},
+            {'event': 'modified', 'account': 'two', 'id': '2', 'owner': 'you', 'previous_owner': 'me',
+             'patch': [{'op': 'replace', 'path': '/owner', 'value': 'you'}], 'version': 'abc'}])
+
+    def test_accounts_compare_equal_to_published_dicts(self):
+        new_accounts = dict((name, Account.from_dict(data)) for name, data in OLD_ACCOUNTS.items())
+
+        self.assertEqual(change_events.account_changes(OLD_ACCOUNTS, new_accounts), [])
+
+    @patch("ultimate_source_of_accounts.change_events.MAX_CHANGE_EVENTS", 1)
+    def test_many_changes_become_one_bulk_event(self):
+        events = change_events.account_changes(OLD_ACCOUNTS, {"one": OLD_ACCOUNTS["one"]}, version="abc")
+
+        self.assertEqual(events, [{'event': 'bulk', 'added': 0, 'removed': 2, 'modified': 0, 'version': 'abc'}])
+
+
+class BatchEntriesTest(TestCase):
+    def test_message_attributes_only_have_set_fields(self):
+        attributes = change_events.message_attributes({'event': 'removed', 'account': 'three', 'id': '3',
+                                                       'owner': None})
+
+        self.assertEqual(attributes, {
+            'event': {'DataType': 'String', 'StringValue': 'removed'},
+            'account': {'DataType': 'String', 'StringValue': 'three'},
+            'id': {'DataType': 'String', 'StringValue': '3'}})
+
+    def test_batches_have_at_most_ten_entries(self):
+        events = [{'event': 'removed', 'account': str(number)} for number in range(25)]
+
+        batches = change_events.batch_entries(events)
+
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual([entry['Id'] for entry in batches[2]], ['0', '1', '2', '3', '4'])
+        self.assertEqual(json.loads(batches[2][0]['Message']), events[20])
+
+    @patch("ultimate_source_of_accounts.change_events.BATCH_MAX_BYTES", 300)
+    def test_batches_stay_below_size_limit(self):
+        events = [{'event': 'added', 'account': str(number), 'data': {'note': 'x' * 50}} for number in range(4)]
+
+        batches = change_events.batch_entries(events)
+
+        self.assertEqual([len(batch) for batch in batches], [2, 2])
@@ -2,24 +2,54 @@
 
 from __future__ import print_function, absolute_import, division
 
+import json
 import os
 import shutil
 import tempfile
 import logging
 
+import boto3
 import moto
-from mock import patch, Mock
+import six
+from botocore.config import Config
+from mock import patch, Mock, ANY
 from unittest2 import TestCase
 
+import ultimate_source_of_accounts.account_exporter as ae
 import ultimate_source_of_accounts.cli as cli
+from ultimate_source_of_accounts.parse_cache import ParseCache
+
+
+# botocore >= 1.36 sends uploads as aws-chunked bodies with a checksum
+# trailer, moto < 5 stores that framing as part of the object. The tests
+# only ask for checksums where S3 requires them, like older botocore did.
+MOTO_CONFIG = Config(**dict((option, 'when_required')
+                            for option in ('request_checksum_calculation', 'response_checksum_validation')
+                            if option in Config.OPTION_DEFAULTS))
+CLIENT_CONFIG = ae.CLIENT_CONFIG
+
+
+def setUpModule():
+    ae.CLIENT_CONFIG = CLIENT_CONFIG.merge(MOTO_CONFIG)
+
+
+def tearDownModule():
+    ae.CLIENT_CONFIG = CLIENT_CONFIG
+
+
+def uploaded_content(upload_mock):
+    """Return key -> bytes of the spooled upload data of the only call of upload_mock"""
+    upload_mock.assert_called_once_with(ANY)
+    return dict((key, content.open().read()) for key, content in upload_mock.call_args[0][0].items())
+
 
 class UploadTest(TestCase):
     """Test the upload() function that is used for --import=...."""
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
-        self.arguments = {'<destination-bucket-name>': "bucketname42",
+        self.arguments = {'<destination-bucket-name>': ["bucketname42"],
             '--allowed-ip': ["123", "345"],
-            '--import': self.tempdir,
+            '--import': self.tempdir, '--no-cache': True,
             '--check-billing': None}
 
         with open(os.path.join(self.tempdir, "foo.yaml"), "w") as config:
@@ -29,8 +59,8 @@ class UploadTest(TestCase):
         shutil.rmtree(self.tempdir)
 
 
-    @patch("ultimate_source_of_accounts.cli.get_converted_aws_accounts")
-    @patch("ultimate_source_of_accounts.cli.S3Uploader")
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
     def test_upload_loads_data_from_specified_directory(self, mock_exporter_class, mock_converter):
         mock_converter.return_value = {"foo": "bar"}
 
@@ -39,8 +69,8 @@ class UploadTest(TestCase):
         mock_converter.assert_called_once_with(
             {'my_account': {'id': '42', 'email': 'me@host.invalid', 'owner': 'me'}})
 
-    @patch("ultimate_source_of_accounts.cli.get_converted_aws_accounts")
-    @patch("ultimate_source_of_accounts.cli.S3Uploader")
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
     def test_upload_calls_all_upload_tasks(self, mock_exporter_class, mock_converter):
         """Mock away S3 Uploader, see if all necessary methods were called"""
         mock_converter.return_value = {"foo": "bar"}
@@ -54,23 +84,257 @@ class UploadTest(TestCase):
                 "bucketname42",
                 allowed_ips=["123", "345"],
                 allowed_aws_account_ids=['42'],
-                allowed_organization_ids=None)
+                allowed_organization_ids=None,
+                region_name=None,
+                compress=False,
+                session=ANY)
 
         mock_exporter_instance.setup_infrastructure.assert_called_once_with()
-        mock_exporter_instance.upload_to_S3.assert_called_once_with({'foo': 'bar'})
+        self.assertEqual(uploaded_content(mock_exporter_instance.upload_to_S3), {'foo': b'bar'})
+        self.assertFalse(mock_exporter_instance.publish_snapshot.called)
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_interrupted_upload_is_not_reported_as_success(self, mock_exporter_class, mock_converter):
+        mock_converter.side_effect = KeyboardInterrupt
+
+        self.assertRaises(KeyboardInterrupt, cli._main, self.arguments)
+        self.assertFalse(mock_exporter_class.return_value.upload_to_S3.called)
+
+    @patch("ultimate_source_of_accounts.cli.watch")
+    def test_interrupted_watch_stops_quietly(self, mock_watch):
+        mock_watch.side_effect = KeyboardInterrupt
+        self.arguments['--watch'] = True
+
+        cli._main(self.arguments)
 
-    @patch("ultimate_source_of_accounts.cli.get_converted_aws_accounts")
-    @patch("ultimate_source_of_accounts.cli.S3Uploader.upload_to_S3")
-    @patch("ultimate_source_of_accounts.cli.S3Uploader.setup_infrastructure")
+        mock_watch.assert_called_once_with(self.tempdir, ["bucketname42"], metrics=ANY, snapshots=False,
+                                           change_events=False, allowed_ips=["123", "345"],
+                                           allowed_organization_ids=None, jobs=1, compress=False, indexes=False,
+                                           use_cache=False)
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_upload_with_snapshots_publishes_a_version(self, mock_exporter_class, mock_converter):
+        mock_converter.return_value = {"foo": "bar"}
+        mock_exporter_class.return_value.upload_to_S3.return_value = {'uploaded': [], 'skipped': []}
+        self.arguments['--snapshots'] = True
+
+        cli._main(self.arguments)
+
+        mock_exporter_class.return_value.publish_snapshot.assert_called_once_with(
+            {'my_account': {'id': '42', 'email': 'me@host.invalid', 'owner': 'me'}})
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_upload_with_change_events_compares_with_published_accounts(self, mock_exporter_class, mock_converter):
+        mock_converter.return_value = {"foo": "bar"}
+        mock_exporter_instance = mock_exporter_class.return_value
+        mock_exporter_instance.upload_to_S3.return_value = {'uploaded': [], 'skipped': []}
+        mock_exporter_instance.get_published_accounts.return_value = {'old_account': {'id': '41'}}
+        self.arguments['--change-events'] = True
+
+        cli._main(self.arguments)
+
+        mock_exporter_instance.publish_change_events.assert_called_once_with(
+            {'old_account': {'id': '41'}},
+            {'my_account': {'id': '42', 'email': 'me@host.invalid', 'owner': 'me'}},
+            None)
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader.upload_to_S3")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader.setup_infrastructure")
     @moto.mock_s3
     def test_upload_uses_S3Uploader_correctly(self, _, mock_upload, mock_converter):
         """Check if the 'necessary methods' used above actually exist on S3Uploader"""
-        upload_data = {"foo": "bar"}
-        mock_converter.return_value = upload_data
+        mock_converter.return_value = {"foo": "bar"}
+        cli._main(self.arguments)
+        self.assertEqual(uploaded_content(mock_upload), {'foo': b'bar'})
+
+    @patch("ultimate_source_of_accounts.account_converter._yaml_chunks",
+           side_effect=lambda accounts: iter(["my_account: {}\n"]))
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader.setup_infrastructure")
+    @moto.mock_s3
+    def test_upload_converts_once_for_all_destinations(self, _, yaml_chunks_mock):
+        client = boto3.client('s3', region_name="us-east-1")
+        client.create_bucket(Bucket="bucket1")
+        client.create_bucket(Bucket="bucket2")
+        client.create_bucket(Bucket="bucket3")
+        destinations = ["bucket1@us-east-1", "bucket2@us-east-1", "bucket3@us-east-1"]
+
+        results = cli.upload(self.tempdir, destinations, compress=True)
+        unchanged_results = cli.upload(self.tempdir, destinations, compress=True)
+
+        self.assertEqual(yaml_chunks_mock.call_count, 2)
+        self.assertEqual([len(result['uploaded']) for result in results.values()], [3, 3, 3])
+        self.assertEqual([len(result['skipped']) for result in unchanged_results.values()], [3, 3, 3])
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    @patch("ultimate_source_of_accounts.account_importer.read_directory")
+    def test_upload_passes_jobs_to_read_directory(self, read_directory_mock, mock_exporter_class, mock_converter):
+        read_directory_mock.return_value = {'my_account': {'id': '42'}}
+        self.arguments['--jobs'] = "4"
+
+        cli._main(self.arguments)
+
+        read_directory_mock.assert_called_once_with(self.tempdir, jobs=4, cache=None)
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    @patch("ultimate_source_of_accounts.account_importer.read_directory")
+    def test_upload_uses_parse_cache_by_default(self, read_directory_mock, mock_exporter_class, mock_converter):
+        read_directory_mock.return_value = {'my_account': {'id': '42'}}
+        del self.arguments['--no-cache']
+
+        cli._main(self.arguments)
+
+        _, kwargs = read_directory_mock.call_args
+        self.assertIsInstance(kwargs['cache'], ParseCache)
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_upload_publishes_to_all_destinations(self, mock_exporter_class, mock_converter):
+        mock_converter.return_value = {"foo": "bar"}
+        self.arguments['<destination-bucket-name>'] = ["bucket1", "bucket2@us-east-1"]
+
+        cli._main(self.arguments)
+
+        mock_converter.assert_called_once_with(
+            {'my_account': {'id': '42', 'email': 'me@host.invalid', 'owner': 'me'}})
+        regions = dict((args[0], kwargs['region_name']) for args, kwargs in mock_exporter_class.call_args_list)
+        self.assertEqual(regions, {"bucket1": None, "bucket2": "us-east-1"})
+        self.assertEqual(mock_exporter_class.return_value.upload_to_S3.call_count, 2)
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_upload_reports_each_failed_destination(self, mock_exporter_class, mock_converter):
+        mock_converter.return_value = {"foo": "bar"}
+        uploaders = {}
+
+        def make_uploader(bucket_name, **kwargs):
+            uploaders[bucket_name] = Mock()
+            if bucket_name == "broken":
+                uploaders[bucket_name].setup_infrastructure.side_effect = Exception("access denied")
+            return uploaders[bucket_name]
+        mock_exporter_class.side_effect = make_uploader
+
+        with self.assertRaisesRegex(Exception, r"1 of 2 destinations: broken@us-east-1 \(access denied\)"):
+            cli.upload(self.tempdir, ["broken@us-east-1", "working"])
+
+        self.assertEqual(uploaded_content(uploaders["working"].upload_to_S3), {'foo': b'bar'})
+        self.assertFalse(uploaders["broken"].upload_to_S3.called)
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_upload_publishes_index_objects_when_requested(self, mock_exporter_class, mock_converter):
+        mock_converter.return_value = {"foo": "bar"}
+        self.arguments['--indexes'] = True
+
         cli._main(self.arguments)
-        mock_upload.assert_called_once_with(upload_data)
 
-    @patch("ultimate_source_of_accounts.cli.read_directory")
+        mock_exporter_class.return_value.upload_index_objects.assert_called_once_with({
+            "by-id/42.json": ANY, "by-name/my_account.json": ANY, "by-owner/me.json": ANY})
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_watch_republishes_only_changed_accounts(self, mock_exporter_class, mock_converter):
+        mock_converter.return_value = {"foo": "bar"}
+        uploader = mock_exporter_class.return_value
+        yaml_file = os.path.join(self.tempdir, "foo.yaml")
+
+        def changes():
+            with open(yaml_file, "w") as config:
+                config.write("# only a comment\nmy_account:\n  id: 42\n  email: me@host.invalid\n  owner: me")
+            yield set([yaml_file])
+            with open(yaml_file, "w") as config:
+                config.write("my_account:\n  id: 42\n  email: me@host.invalid\n  owner: you")
+            yield set([yaml_file])
+            with open(yaml_file, "w") as config:
+                config.write("my_account:\n  id: 43\n  email: me@host.invalid\n  owner: you")
+            yield set([yaml_file])
+
+        cli.watch(self.tempdir, "bucketname42", changes=changes())
+
+        mock_exporter_class.assert_called_once_with(
+            "bucketname42", allowed_ips=[], allowed_aws_account_ids=['42'], allowed_organization_ids=None,
+            region_name=None, compress=False, session=ANY)
+        self.assertEqual([args[0]['my_account'] for args, _ in mock_converter.call_args_list], [
+            {'id': '42', 'email': 'me@host.invalid', 'owner': 'me'},
+            {'id': '42', 'email': 'me@host.invalid', 'owner': 'you'},
+            {'id': '43', 'email': 'me@host.invalid', 'owner': 'you'}])
+        self.assertEqual(uploader.upload_to_S3.call_count, 3)
+        # The infrastructure only depends on the account ids.
+        self.assertEqual(uploader.setup_infrastructure.call_count, 2)
+        self.assertEqual(uploader.allowed_aws_account_ids, ['43'])
+
+    @patch("ultimate_source_of_accounts.account_converter.get_streaming_aws_accounts")
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_watch_does_not_publish_invalid_data(self, mock_exporter_class, mock_converter):
+        mock_converter.return_value = {"foo": "bar"}
+        yaml_file = os.path.join(self.tempdir, "bar.yaml")
+
+        def changes():
+            with open(yaml_file, "w") as config:
+                config.write("other_account:\n  id: 42\n  email: me@host.invalid\n  owner: me")
+            yield set([yaml_file])
+
+        with self.assertLogs(level=logging.ERROR) as cm:
+            cli.watch(self.tempdir, "bucketname42", changes=changes())
+
+        self.assertIn("duplicated id 42", "\n".join(cm.output))
+        self.assertEqual(mock_exporter_class.return_value.upload_to_S3.call_count, 1)
+
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_plan_is_written_and_applied(self, mock_exporter_class):
+        uploader = mock_exporter_class.return_value
+        uploader.plan.return_value = {'changes': [{'resource': 'S3_bucket', 'action': 'create'}]}
+        plan_file = os.path.join(self.tempdir, "plan.json")
+        self.arguments['--plan'] = plan_file
+
+        cli._main(self.arguments)
+
+        with open(plan_file) as source:
+            self.assertEqual(json.load(source), {'version': cli.PLAN_VERSION, 'indexes': False, 'destinations': {
+                'bucketname42': {'changes': [{'resource': 'S3_bucket', 'action': 'create'}]}}})
+        self.assertFalse(uploader.setup_infrastructure.called)
+        self.assertFalse(uploader.upload_to_S3.called)
+
+        del self.arguments['--plan']
+        self.arguments['--apply'] = plan_file
+        cli._main(self.arguments)
+
+        (plan, upload_data, index_data), _ = uploader.apply.call_args
+        self.assertEqual(plan, {'changes': [{'resource': 'S3_bucket', 'action': 'create'}]})
+        self.assertEqual(sorted(upload_data), ["accounts.json", "accounts.min.json", "accounts.yaml"])
+        self.assertIsNone(index_data)
+        self.assertFalse(uploader.setup_infrastructure.called)
+
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_apply_refuses_plan_for_other_destinations(self, mock_exporter_class):
+        mock_exporter_class.return_value.plan.return_value = {'changes': []}
+        plan_file = os.path.join(self.tempdir, "plan.json")
+        cli.plan(self.tempdir, ["bucket1"], plan_file=plan_file)
+
+        self.assertRaisesRegex(Exception, "made for bucket1, not for bucket1, bucket2",
+                               cli.apply, self.tempdir, ["bucket1", "bucket2"], plan_file)
+        self.assertRaisesRegex(Exception, "made for bucket1, not for bucket1 with --indexes",
+                               cli.apply, self.tempdir, ["bucket1"], plan_file, indexes=True)
+        self.assertFalse(mock_exporter_class.return_value.apply.called)
+
+    def test_parse_destination(self):
+        self.assertEqual(cli.parse_destination("bucket"), ("bucket", None))
+        self.assertEqual(cli.parse_destination("bucket@us-west-2"), ("bucket", "us-west-2"))
+        self.assertRaises(Exception, cli.parse_destination, "@us-west-2")
+
+    def test_jobs_must_be_a_positive_integer(self):
+        for value in ("abc", "0", "-2"):
+            self.arguments['--jobs'] = value
+            self.assertRaisesRegex(SystemExit, "--jobs must be a positive integer", cli._main, self.arguments)
+        self.assertEqual(cli._jobs({'--jobs': "4"}), 4)
+        self.assertEqual(cli._jobs({}), 1)
+
+    @patch("ultimate_source_of_accounts.account_importer.read_directory")
     def test_main_logs_invalid_data(self, read_directory_mock):
         message = "This must be logged"
         read_directory_mock.side_effect = Exception(message)
@@ -81,7 +345,88 @@ class UploadTest(TestCase):
         self.assertRegex(logged_output, ".*" + self.tempdir + ".*" + message + ".*")
 
 
+class ValidateTest(TestCase):
+    """Test the validate() function that is used for --validate-only"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, content):
+        with open(os.path.join(self.tempdir, "accounts.yaml"), "w") as config:
+            config.write(content)
+
+    def test_validate_prints_all_violations_and_exits_with_1(self):
+        self.write("one:\n  id: 1\n  email: foo\n  owner: me\ntwo:\n  id: 1\n  email: bar@host.invalid\n")
+
+        with patch("sys.stdout", new_callable=six.StringIO) as stdout:
+            self.assertRaises(SystemExit, cli._main, {
+                '--check-billing': None, '--validate-only': True, '--import': self.tempdir, '--no-cache': True})
+
+        self.assertIn("error: Account data one without @ in email. [email-invalid]", stdout.getvalue())
+        self.assertIn("error: duplicated id 1 found [duplicate-id]", stdout.getvalue())
+        self.assertIn("error: Account two has no 'owner' field [owner-missing]", stdout.getvalue())
+        self.assertIn("2 accounts, 3 errors, 0 warnings.", stdout.getvalue())
+
+    def test_validate_prints_report_as_json(self):
+        self.write("one:\n  id: 1\n  email: foo\n  owner: me\n")
+
+        with patch("sys.stdout", new_callable=six.StringIO) as stdout:
+            self.assertRaises(SystemExit, cli._main, {
+                '--check-billing': None, '--validate-only': True, '--import': self.tempdir, '--no-cache': True,
+                '--json': True})
+
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report['errors'], 1)
+        self.assertEqual(report['violations'], [{
+            'account': "one", 'rule': "email-invalid", 'message': "Account data one without @ in email.",
+            'severity': "error", 'file': os.path.join(self.tempdir, "accounts.yaml")}])
+
+    def test_validate_accepts_warnings(self):
+        self.write("one:\n  id: 1\n  email: me@host.invalid\n  owner: me\n"
+                   "two:\n  id: 2\n  email: me@host.invalid\n  owner: me\n")
+
+        with patch("sys.stdout", new_callable=six.StringIO):
+            report = cli.validate(self.tempdir)
+
+        self.assertEqual([violation.rule for violation in report.warnings], ["duplicate-email"])
+
+
 class CheckTest(TestCase):
     """Test the check_billing() function that is used for --check_billing"""
-    def test_check_billing_not_yet_implemented(self):
-        self.assertRaises(SystemExit, cli.check_billing, "foo", "bar")
+    def setUp(self):
+        self.mock = moto.mock_s3()
+        self.mock.start()
+        self.client = boto3.client('s3', region_name='us-east-1')
+        for bucket_name in ("billing", "destination"):
+            self.client.create_bucket(Bucket=bucket_name)
+        self.client.put_object(Bucket="destination", Key="accounts.json", Body=json.dumps({
+            "billed": {"id": "123456789012"}, "not_billed": {"id": "111111111111"}}))
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_check_billing_reports_unknown_and_missing_accounts(self):
+        self.client.put_object(Bucket="billing", Key="report.csv",
+                               Body=b"LinkedAccountId\n123456789012\n210987654321\n")
+
+        with patch("sys.stdout", new_callable=six.StringIO) as stdout:
+            self.assertRaises(SystemExit, cli.check_billing, "billing", "destination@us-east-1")
+
+        self.assertIn("Account 210987654321 is billed, but not in the account list.", stdout.getvalue())
+        self.assertIn("Account not_billed (111111111111) is in the account list, but not billed.",
+                      stdout.getvalue())
+
+    def test_check_billing_returns_report_when_all_billed_accounts_are_known(self):
+        self.client.put_object(Bucket="billing", Key="report.csv", Body=b"LinkedAccountId\n123456789012\n")
+
+        with patch("sys.stdout", new_callable=six.StringIO):
+            report = cli.check_billing("billing", "destination@us-east-1")
+
+        self.assertEqual(report, {'unknown': [], 'missing': ['not_billed']})
+
+    def test_check_billing_without_published_accounts_raises_exception(self):
+        self.client.delete_object(Bucket="destination", Key="accounts.json")
+
+        self.assertRaises(Exception, cli.check_billing, "billing", "destination@us-east-1")
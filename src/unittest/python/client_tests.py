@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+
+from mock import patch
+from six.moves.urllib.request import urlopen
+
+from ultimate_source_of_accounts.client import AccountsClient
+from ultimate_source_of_accounts.server import AccountServer
+
+ACCOUNTS = {
+    "one": {"id": "1", "email": "one@host.invalid", "owner": "me", "automated": {"backup": True}},
+    "two": {"id": "2", "email": "two@host.invalid", "owner": "me", "automated": {"backup": False}},
+    "three": {"id": "3", "email": "three@host.invalid", "owner": "you"},
+}
+
+
+def notification(key_name, event_name="ObjectCreated:Put"):
+    event = {"Records": [{"eventName": event_name, "s3": {"bucket": {"name": "bucketname42"},
+                                                          "object": {"key": key_name}}}]}
+    return json.dumps({"Type": "Notification", "Message": json.dumps(event)})
+
+
+class AccountsClientTest(TestCase):
+    def setUp(self):
+        self.cache_directory = tempfile.mkdtemp()
+        self.server = AccountServer("127.0.0.1:0", ACCOUNTS)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.base_url = "http://{0}:{1}".format(*self.server.server_address[:2])
+        urlopen_patcher = patch("ultimate_source_of_accounts.client.urlopen", side_effect=urlopen)
+        self.urlopen_mock = urlopen_patcher.start()
+        self.addCleanup(urlopen_patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.cache_directory)
+
+    def client(self, **kwargs):
+        kwargs.setdefault('cache_directory', self.cache_directory)
+        return AccountsClient(self.base_url, **kwargs)
+
+    def test_accounts_are_fetched_through_website_routing(self):
+        client = self.client(format='yaml')
+
+        self.assertEqual(client.accounts(), ACCOUNTS)
+        self.assertEqual(self.urlopen_mock.call_args[0][0].get_full_url(), self.base_url + "/yaml")
+
+    def test_lookups(self):
+        client = self.client()
+
+        self.assertEqual(client.get_by_id(1), ("one", ACCOUNTS["one"]))
+        self.assertIsNone(client.get_by_id(4))
+        self.assertEqual(client.get_by_name("three"), ACCOUNTS["three"])
+        self.assertEqual(sorted(client.get_by_owner("me")), ["one", "two"])
+        self.assertEqual(client.get_by_owner("nobody"), {})
+        self.assertEqual(list(client.get_by_automated("backup")), ["one"])
+
+    def test_accounts_are_not_fetched_again_within_ttl(self):
+        client = self.client()
+        client.accounts()
+
+        client.get_by_id(1)
+        client.get_by_name("one")
+
+        self.assertEqual(self.urlopen_mock.call_count, 1)
+
+    def test_unchanged_accounts_are_revalidated_and_kept_after_ttl(self):
+        client = self.client(ttl=0)
+        accounts = client.accounts()
+
+        self.assertIs(client.accounts(), accounts)
+        self.assertEqual(self.urlopen_mock.call_count, 2)
+        self.assertEqual(self.urlopen_mock.call_args[0][0].get_header('If-none-match'),
+                         self.server.index.get("/accounts.json")[1])
+
+    def test_changed_accounts_are_fetched_after_ttl(self):
+        client = self.client(ttl=0)
+        client.accounts()
+
+        self.server.update({"four": {"id": "4", "email": "four@host.invalid", "owner": "me"}})
+
+        self.assertEqual(list(client.accounts()), ["four"])
+        self.assertEqual(client.get_by_id(4)[0], "four")
+
+    def test_new_client_uses_accounts_cached_on_disk(self):
+        self.client().accounts()
+
+        self.assertEqual(self.client().accounts(), ACCOUNTS)
+        self.assertEqual(self.urlopen_mock.call_count, 1)
+
+    def test_invalid_cache_file_is_ignored(self):
+        cache_file = self.client().cache_file
+        for entry in ({"etag": "\"1\"", "checked": time.time()}, [], {"etag": None, "checked": "now", "accounts": {}},
+                      {"etag": None, "checked": time.time(), "accounts": {"one": "not a mapping"}}):
+            with open(cache_file, "w") as target:
+                json.dump(entry, target)
+
+            self.assertEqual(self.client().accounts(), ACCOUNTS)
+
+        self.assertEqual(self.urlopen_mock.call_count, 4)
+
+    def test_memory_only_client_does_not_write_to_disk(self):
+        self.client(cache_directory=None).accounts()
+
+        self.assertEqual(self.client().accounts(), ACCOUNTS)
+        self.assertEqual(self.urlopen_mock.call_count, 2)
+
+    def test_stale_accounts_are_used_if_server_is_unreachable(self):
+        client = self.client(ttl=0)
+        client.accounts()
+        self.server.server_close()
+        self.urlopen_mock.side_effect = IOError("connection refused")
+
+        with self.assertLogs(level=logging.WARNING) as cm:
+            self.assertEqual(client.accounts(), ACCOUNTS)
+        self.assertIn("connection refused", "\n".join(cm.output))
+
+    def test_unreachable_server_without_accounts_is_an_error(self):
+        self.urlopen_mock.side_effect = IOError("connection refused")
+
+        self.assertRaises(Exception, self.client().accounts)
+
+    def test_notification_for_read_object_invalidates(self):
+        client = self.client()
+        client.accounts()
+        self.server.update({"four": {"id": "4", "email": "four@host.invalid", "owner": "me"}})
+
+        self.assertTrue(client.handle_notification(notification("accounts.json")))
+
+        self.assertEqual(list(client.accounts()), ["four"])
+
+    def test_notification_for_other_object_is_ignored(self):
+        client = self.client()
+        client.accounts()
+
+        self.assertFalse(client.handle_notification(notification("accounts.yaml")))
+        self.assertFalse(client.handle_notification(notification("accounts.json", "ObjectRemoved:Delete")))
+
+        client.accounts()
+        self.assertEqual(self.urlopen_mock.call_count, 1)
+
+    def test_unknown_format_is_an_error(self):
+        self.assertRaises(Exception, AccountsClient, self.base_url, format='xml')
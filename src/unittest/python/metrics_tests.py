@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+import json
+import os
+import shutil
+import socket
+import tempfile
+
+import boto3
+from mock import patch
+from moto import mock_s3
+
+import ultimate_source_of_accounts.cli as cli
+from ultimate_source_of_accounts.metrics import Metrics, METRICS, instrument_client, statsd_lines
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_nothing_is_collected_while_disabled(self):
+        with self.metrics.span('stage') as tags:
+            tags['bytes'] = 1
+        self.metrics.timing('other', 0.5)
+        self.metrics.count('things')
+
+        self.assertEqual(self.metrics.records(), [])
+
+    def test_span_records_timing_with_tags_added_in_the_body(self):
+        self.metrics.enabled = True
+
+        with self.metrics.span('stage', key='accounts.json') as tags:
+            tags['bytes'] = 42
+
+        records = self.metrics.records()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['type'], 'timing')
+        self.assertEqual(records[0]['name'], 'stage')
+        self.assertEqual(records[0]['unit'], 'ms')
+        self.assertEqual(records[0]['tags'], {'key': 'accounts.json', 'bytes': 42})
+
+    def test_span_records_timing_if_body_fails(self):
+        self.metrics.enabled = True
+
+        def fail():
+            with self.metrics.span('stage'):
+                raise Exception("broken")
+        self.assertRaises(Exception, fail)
+
+        self.assertEqual([record['name'] for record in self.metrics.records()], ['stage'])
+
+    def test_counters_are_summed_per_name_and_tags(self):
+        self.metrics.enabled = True
+
+        self.metrics.count('requests', operation='PutObject')
+        self.metrics.count('requests', 2, operation='PutObject')
+        self.metrics.count('requests', operation='HeadObject')
+
+        counts = dict((record['tags']['operation'], record['value']) for record in self.metrics.records())
+        self.assertEqual(counts, {'PutObject': 3, 'HeadObject': 1})
+
+    def test_records_forgets_reported_records(self):
+        self.metrics.enabled = True
+        self.metrics.count('requests')
+
+        self.metrics.records()
+
+        self.assertEqual(self.metrics.records(), [])
+
+    def test_report_appends_json_lines_to_file(self):
+        self.metrics.enabled = True
+        target = os.path.join(self.tempdir, "metrics.jsonl")
+
+        self.metrics.timing('stage', 0.25)
+        self.metrics.report(target)
+        self.metrics.count('requests')
+        self.metrics.report(target)
+
+        with open(target) as source:
+            records = [json.loads(line) for line in source]
+        self.assertEqual([(record['name'], record['value']) for record in records],
+                         [('stage', 250.0), ('requests', 1)])
+
+    def test_report_sends_statsd_datagrams(self):
+        self.metrics.enabled = True
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            self.metrics.count('requests', service='s3')
+            self.metrics.report("statsd://127.0.0.1:{0}".format(server.getsockname()[1]))
+
+            datagram = server.recv(4096).decode('utf-8')
+        finally:
+            server.close()
+        self.assertEqual(datagram, "ultimate_source_of_accounts.requests:1|c|#service:s3")
+
+    def test_report_logs_unusable_target(self):
+        self.metrics.enabled = True
+        self.metrics.count('requests')
+
+        with patch("logging.warning") as warning_mock:
+            self.metrics.report(os.path.join(self.tempdir, "missing", "metrics.jsonl"))
+
+        self.assertTrue(warning_mock.called)
+
+    def test_statsd_lines_formats_timings_and_counters(self):
+        records = [{'type': 'timing', 'name': 'stage', 'value': 1.5, 'tags': {'key': 'a', 'bytes': 3}},
+                   {'type': 'count', 'name': 'requests', 'value': 2, 'tags': {}}]
+
+        self.assertEqual(list(statsd_lines(records)), [
+            "ultimate_source_of_accounts.stage:1.5|ms|#bytes:3,key:a",
+            "ultimate_source_of_accounts.requests:2|c"])
+
+
+class InstrumentClientTest(TestCase):
+    def setUp(self):
+        METRICS.enabled = True
+        METRICS.records()
+
+    def tearDown(self):
+        METRICS.enabled = False
+        METRICS.records()
+
+    @mock_s3
+    def test_requests_are_counted_per_operation_and_status(self):
+        client = instrument_client(boto3.client('s3', region_name='us-east-1'))
+
+        client.create_bucket(Bucket='bucketname42')
+        client.list_objects_v2(Bucket='bucketname42')
+        client.list_objects_v2(Bucket='bucketname42')
+
+        counts = dict((record['tags']['operation'], record['value']) for record in METRICS.records()
+                      if record['name'] == 'aws.requests')
+        self.assertEqual(counts, {'CreateBucket': 1, 'ListObjectsV2': 2})
+
+
+class CliMetricsTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tempdir, "foo.yaml"), "w") as config:
+            config.write("my_account:\n  id: 42\n  email: me@host.invalid\n  owner: me")
+        self.target = os.path.join(self.tempdir, "metrics.jsonl")
+
+    def tearDown(self):
+        METRICS.enabled = False
+        METRICS.records()
+        shutil.rmtree(self.tempdir)
+
+    @patch("ultimate_source_of_accounts.account_exporter.S3Uploader")
+    def test_metrics_are_written_at_the_end_of_the_run(self, mock_exporter_class):
+        cli._main({'<destination-bucket-name>': ["bucketname42"],
+                   '--allowed-ip': [],
+                   '--import': self.tempdir,
+                   '--no-cache': True,
+                   '--check-billing': None,
+                   '--metrics': self.target})
+
+        with open(self.target) as source:
+            names = set(json.loads(line)['name'] for line in source)
+        self.assertIn('read.parse', names)
+        self.assertIn('read.duplicate_check', names)
+        self.assertIn('validate', names)
+
+    def test_no_metrics_are_collected_without_option(self):
+        cli._main({'--import': self.tempdir, '--validate-only': True, '--no-cache': True, '--check-billing': None})
+
+        self.assertFalse(METRICS.enabled)
+        self.assertEqual(METRICS.records(), [])
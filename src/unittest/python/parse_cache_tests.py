@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from ultimate_source_of_accounts.parse_cache import ParseCache
+
+
+class ParseCacheTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = ParseCache(os.path.join(self.tempdir, "cache"))
+        self.file_name = os.path.join(self.tempdir, "accounts.yaml")
+        self.write("account: {id: 1}")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, content, mtime=None):
+        with open(self.file_name, "w") as yaml_file:
+            yaml_file.write(content)
+        if mtime is not None:
+            os.utime(self.file_name, (mtime, mtime))
+
+    def test_unknown_file_is_not_found(self):
+        found, key = self.cache.get(self.file_name)
+
+        self.assertFalse(found)
+        self.assertEqual(key.path, os.path.abspath(self.file_name))
+
+    def test_stored_data_is_found(self):
+        _, key = self.cache.get(self.file_name)
+        self.cache.put(key, {"account": {"id": 1}})
+
+        self.assertEqual(self.cache.get(self.file_name), (True, {"account": {"id": 1}}))
+
+    def test_changed_file_is_not_found(self):
+        _, key = self.cache.get(self.file_name)
+        self.cache.put(key, {"account": {"id": 1}})
+        self.write("account: {id: 2}", mtime=1000000000)
+
+        found, _ = self.cache.get(self.file_name)
+
+        self.assertFalse(found)
+
+    def test_touched_file_with_same_content_is_found(self):
+        _, key = self.cache.get(self.file_name)
+        self.cache.put(key, {"account": {"id": 1}})
+        self.write("account: {id: 1}", mtime=1000000000)
+
+        self.assertEqual(self.cache.get(self.file_name), (True, {"account": {"id": 1}}))
+
+    def test_file_changed_in_the_same_clock_tick_is_not_found(self):
+        now = int(time.time())
+        self.write("account: {id: 1}", mtime=now)
+        _, key = self.cache.get(self.file_name)
+        self.cache.put(key, {"account": {"id": 1}})
+        self.write("account: {id: 2}", mtime=now)
+
+        found, _ = self.cache.get(self.file_name)
+
+        self.assertFalse(found)
+
+    def test_data_that_cannot_be_marshalled_is_not_stored(self):
+        _, key = self.cache.get(self.file_name)
+        self.cache.put(key, {"account": {"created": datetime.date(2020, 1, 1)}})
+
+        found, _ = self.cache.get(self.file_name)
+
+        self.assertFalse(found)
+
+    def test_corrupt_entry_is_ignored(self):
+        _, key = self.cache.get(self.file_name)
+        self.cache.put(key, {"account": {"id": 1}})
+        with open(self.cache._entry_name(key.path), "wb") as entry:
+            entry.write(b"garbage")
+
+        found, _ = self.cache.get(self.file_name)
+
+        self.assertFalse(found)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        keys = []
+        for number in range(3):
+            file_name = os.path.join(self.tempdir, "file_%d.yaml" % number)
+            with open(file_name, "w") as yaml_file:
+                yaml_file.write("x")
+            _, key = self.cache.get(file_name)
+            self.cache.put(key, {"data": "x" * 1000})
+            os.utime(self.cache._entry_name(key.path), (number, number))
+            keys.append(file_name)
+        self.cache.max_size = 2500
+
+        self.cache.evict()
+
+        self.assertEqual([self.cache.get(file_name)[0] for file_name in keys], [False, True, True])
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from mock import patch, Mock, ANY
+from moto import mock_s3
+from six.moves import http_client
+
+import ultimate_source_of_accounts.cli as cli
+from ultimate_source_of_accounts.account_converter import get_converted_aws_accounts
+from ultimate_source_of_accounts.account_exporter import S3Uploader
+from ultimate_source_of_accounts import server
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+ACCOUNTS = {
+    "one": {"id": "1", "email": "one@host.invalid", "owner": "me", "automated": {"backup": True, "patching": False}},
+    "two": {"id": "2", "email": "two@host.invalid", "owner": "me", "automated": {"backup": True}},
+    "three": {"id": "3", "email": "three@host.invalid", "owner": "you"},
+}
+
+
+class AccountIndexTest(TestCase):
+    def test_published_objects_are_served_unchanged(self):
+        index = server.AccountIndex(ACCOUNTS)
+
+        body, _, content_type = index.get("/accounts.json")
+
+        self.assertEqual(body.decode('utf-8'), get_converted_aws_accounts(ACCOUNTS)["accounts.json"])
+        self.assertEqual(content_type, "application/json")
+        self.assertEqual(index.get("/accounts.yaml")[2], "application/yaml")
+
+    def test_lookups_by_id_name_and_owner(self):
+        index = server.AccountIndex(ACCOUNTS)
+
+        self.assertEqual(json.loads(index.get("/by-id/1.json")[0].decode('utf-8')), {"one": ACCOUNTS["one"]})
+        self.assertEqual(json.loads(index.get("/by-name/three.json")[0].decode('utf-8')), {"three": ACCOUNTS["three"]})
+        self.assertEqual(sorted(json.loads(index.get("/by-owner/me.json")[0].decode('utf-8'))), ["one", "two"])
+        self.assertIsNone(index.get("/by-id/4.json"))
+
+    def test_lookup_by_automated_flag_only_has_accounts_with_the_flag_set(self):
+        index = server.AccountIndex(ACCOUNTS)
+
+        self.assertEqual(sorted(json.loads(index.get("/by-automated/backup.json")[0].decode('utf-8'))),
+                         ["one", "two"])
+        self.assertIsNone(index.get("/by-automated/patching.json"))
+
+    def test_etag_only_changes_with_the_response(self):
+        changed_accounts = dict(ACCOUNTS, three=dict(ACCOUNTS["three"], owner="them"))
+
+        old_index, new_index = server.AccountIndex(ACCOUNTS), server.AccountIndex(changed_accounts)
+
+        self.assertEqual(old_index.get("/by-id/1.json")[1], new_index.get("/by-id/1.json")[1])
+        self.assertNotEqual(old_index.get("/by-id/3.json")[1], new_index.get("/by-id/3.json")[1])
+
+    def test_parse_address(self):
+        self.assertEqual(server.parse_address("8080"), ("127.0.0.1", 8080))
+        self.assertEqual(server.parse_address("0.0.0.0:80"), ("0.0.0.0", 80))
+        self.assertRaises(Exception, server.parse_address, "localhost")
+
+
+class AccountServerTest(TestCase):
+    def setUp(self):
+        self.server = server.AccountServer("127.0.0.1:0", ACCOUNTS)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.connection = http_client.HTTPConnection(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def request(self, path, method="GET", headers=None):
+        self.connection.request(method, path, headers=headers or {})
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_get_returns_body_with_etag(self):
+        response, body = self.request("/by-id/1.json")
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8')), {"one": ACCOUNTS["one"]})
+        self.assertEqual(response.getheader("Content-Type"), "application/json")
+        self.assertEqual(response.getheader("ETag"), self.server.index.get("/by-id/1.json")[1])
+
+    def test_matching_if_none_match_returns_not_modified(self):
+        response, _ = self.request("/by-id/1.json")
+
+        response, body = self.request("/by-id/1.json", headers={"If-None-Match": response.getheader("ETag")})
+
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, b"")
+
+    def test_outdated_if_none_match_returns_content(self):
+        response, body = self.request("/by-id/1.json", headers={"If-None-Match": '"outdated"'})
+
+        self.assertEqual(response.status, 200)
+        self.assertTrue(body)
+
+    def test_head_returns_no_body(self):
+        response, body = self.request("/accounts.json", method="HEAD")
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, b"")
+        self.assertEqual(int(response.getheader("Content-Length")), len(self.server.index.get("/accounts.json")[0]))
+
+    def test_index_keys_with_encoded_characters_are_found(self):
+        self.server.update({"my account": {"id": "5", "email": "five@host.invalid", "owner": "team/x"}})
+
+        response, body = self.request("/by-owner/team%252Fx.json")
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(list(json.loads(body.decode('utf-8'))), ["my account"])
+        self.assertEqual(self.request("/by-name/my%2520account.json")[0].status, 200)
+        self.assertEqual(self.request("/by-owner/team/x.json")[0].status, 404)
+
+    def test_unknown_path_returns_not_found(self):
+        response, _ = self.request("/by-id/4.json")
+
+        self.assertEqual(response.status, 404)
+
+    def test_update_replaces_served_accounts(self):
+        self.server.update({"four": {"id": "4", "email": "four@host.invalid", "owner": "me"}})
+
+        self.assertEqual(self.request("/by-id/4.json")[0].status, 200)
+        self.assertEqual(self.request("/by-id/1.json")[0].status, 404)
+
+
+class ReloadTest(TestCase):
+    def setUp(self):
+        self.server = Mock()
+
+    def test_watch_directory_keeps_accounts_if_data_is_invalid(self):
+        reader = Mock()
+        reader.update.side_effect = [Exception("invalid"), ACCOUNTS]
+
+        server.watch_directory(self.server, reader, [set(["a.yaml"]), set(["a.yaml"])])
+
+        self.server.update.assert_called_once_with(ACCOUNTS)
+
+    @mock_s3
+    def test_poll_published_only_reloads_changed_accounts(self):
+        uploader = S3Uploader("bucketname42", region_name="us-east-1")
+        uploader.create_S3_bucket()
+        uploader.upload_to_S3({"accounts.json": json.dumps(ACCOUNTS)})
+        accounts, etag = uploader.fetch_published_accounts()
+        self.assertEqual(accounts, ACCOUNTS)
+
+        server.poll_published(self.server, uploader, etag, ticks=range(2))
+        self.assertFalse(self.server.update.called)
+
+        uploader.upload_to_S3({"accounts.json": json.dumps({"one": ACCOUNTS["one"]})})
+        server.poll_published(self.server, uploader, etag, ticks=range(2))
+        self.server.update.assert_called_once_with({"one": ACCOUNTS["one"]})
+
+    @mock_s3
+    def test_fetch_published_accounts_without_accounts(self):
+        uploader = S3Uploader("bucketname42", region_name="us-east-1")
+        uploader.create_S3_bucket()
+
+        self.assertEqual(uploader.fetch_published_accounts(), (None, None))
+
+
+class ServeTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tempdir, "foo.yaml"), "w") as config:
+            config.write("my_account:\n  id: 42\n  email: me@host.invalid\n  owner: me")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @patch("ultimate_source_of_accounts.server.watch_directory")
+    @patch("ultimate_source_of_accounts.server.AccountServer")
+    def test_serve_subcommand_serves_data_directory(self, server_class, watch_directory_mock):
+        server_class.return_value.server_address = ("127.0.0.1", 8080)
+
+        cli._main({'serve': True, '--import': self.tempdir, '<destination-bucket-name>': [], '--no-cache': True,
+                   '--check-billing': None, '--listen': "127.0.0.1:8080"})
+
+        server_class.assert_called_once_with(
+            "127.0.0.1:8080", {'my_account': {'id': '42', 'email': 'me@host.invalid', 'owner': 'me'}})
+        server_class.return_value.serve_forever.assert_called_once_with()
+        watch_directory_mock.assert_called_once_with(server_class.return_value, reader=ANY, changes=ANY)
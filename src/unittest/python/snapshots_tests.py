@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+
+from ultimate_source_of_accounts.account import Account
+from ultimate_source_of_accounts import snapshots
+
+
+class PatchTest(TestCase):
+    def test_patch_adds_removes_and_replaces_accounts_and_fields(self):
+        old = {"one": {"id": "1", "owner": "me", "automated": {"backup": True}}, "two": {"id": "2"}}
+        new = {"one": {"id": "1", "owner": "you", "automated": {"backup": False, "patching": True}},
+               "three": {"id": "3"}}
+
+        patch = snapshots.make_patch(old, new)
+
+        self.assertEqual(patch, [
+            {'op': 'replace', 'path': '/one/automated/backup', 'value': False},
+            {'op': 'add', 'path': '/one/automated/patching', 'value': True},
+            {'op': 'replace', 'path': '/one/owner', 'value': 'you'},
+            {'op': 'add', 'path': '/three', 'value': {"id": "3"}},
+            {'op': 'remove', 'path': '/two'}])
+        self.assertEqual(snapshots.apply_patch(old, patch), new)
+
+    def test_patch_of_equal_documents_is_empty(self):
+        self.assertEqual(snapshots.make_patch({"one": {"id": "1"}}, {"one": {"id": "1"}}), [])
+
+    def test_keys_are_escaped_as_json_pointers(self):
+        old = {"a/b": {"x~y": 1}}
+        new = {"a/b": {"x~y": 2}}
+
+        patch = snapshots.make_patch(old, new)
+
+        self.assertEqual(patch[0]['path'], '/a~1b/x~0y')
+        self.assertEqual(snapshots.apply_patch(old, patch), new)
+
+    def test_apply_patch_does_not_modify_document(self):
+        old = {"one": {"id": "1"}}
+
+        snapshots.apply_patch(old, [{'op': 'remove', 'path': '/one/id'}])
+
+        self.assertEqual(old, {"one": {"id": "1"}})
+
+    def test_unsupported_operation_is_an_error(self):
+        self.assertRaises(Exception, snapshots.apply_patch, {}, [{'op': 'move', 'from': '/a', 'path': '/b'}])
+
+
+class VersionTest(TestCase):
+    def test_version_only_depends_on_content(self):
+        accounts = {"one": Account.from_dict({"id": 1, "owner": "me"}), "two": {"id": "2"}}
+
+        body = snapshots.snapshot_body(accounts)
+
+        self.assertEqual(body, '{"one":{"id":"1","owner":"me"},"two":{"id":"2"}}')
+        self.assertEqual(snapshots.version_of(body), snapshots.version_of(snapshots.snapshot_body(
+            {"two": {"id": "2"}, "one": {"owner": "me", "id": "1"}})))
+
+    def test_pointer_names_snapshot_and_delta(self):
+        self.assertEqual(snapshots.snapshot_pointer("new", "old"), {
+            'version': "new", 'snapshot': "snapshots/new.json", 'previous': "old", 'delta': "deltas/old.json"})
+        self.assertIsNone(snapshots.snapshot_pointer("new")['delta'])
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase, skipUnless
+import json
+import os
+import sys
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "benchmarks")
+if BENCHMARK_DIR not in sys.path:
+    sys.path.insert(0, BENCHMARK_DIR)
+
+from startup_benchmark import BUDGET_FILE, import_times  # noqa: E402
+
+
+@skipUnless(sys.version_info >= (3, 7), "python -X importtime needs Python 3.7")
+class StartupBudgetTest(TestCase):
+    """Enforce the budget of benchmarks/startup_budget.json"""
+    def setUp(self):
+        with open(BUDGET_FILE) as budget_file:
+            self.budget = json.load(budget_file)
+
+    def import_times(self):
+        return import_times(self.budget["arguments"])
+
+    def test_heavy_modules_are_not_imported(self):
+        imported = set(self.import_times())
+
+        self.assertIn(self.budget["module"], imported)
+        self.assertEqual(sorted(imported & set(self.budget["forbidden_modules"])), [])
+
+    def test_import_time_is_within_budget(self):
+        # The best of three runs, to ignore a busy machine.
+        import_time_ms = min(self.import_times()[self.budget["module"]] for _ in range(3)) / 1000
+
+        self.assertLessEqual(import_time_ms, self.budget["max_import_time_ms"])
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+from collections import OrderedDict
+
+from ultimate_source_of_accounts.validation import validate_accounts, Violation, ERROR, WARNING
+
+
+class ValidateAccountsTest(TestCase):
+    def test_valid_accounts_have_no_violations(self):
+        report = validate_accounts({
+            "one": {"id": "1", "email": "one@host.invalid", "owner": "me", "automated": {"foo": True}},
+            "two": {"id": "2", "email": "two@host.invalid", "owner": "you"}})
+
+        self.assertEqual(report.violations, [])
+        self.assertEqual(report.owners, set(["me", "you"]))
+
+    def test_empty_account_data_is_an_error(self):
+        self.assertEqual(validate_accounts({}).errors, [Violation(None, 'empty', "Account data is empty.", ERROR)])
+
+    def test_all_violations_are_reported_in_order(self):
+        accounts = OrderedDict([
+            ("one", {"id": "1", "email": "one@host.invalid", "owner": "me"}),
+            ("two", {"id": "1", "email": "no-at-sign", "owner": ""}),
+            ("three", {"id": "3", "email": "one@host.invalid", "automated": {"foo": "yes"}}),
+            ("four", {"id": "1"})])
+
+        report = validate_accounts(accounts)
+
+        self.assertEqual([(violation.account, violation.rule) for violation in report.violations], [
+            ("two", "duplicate-id"),
+            ("two", "email-invalid"),
+            ("two", "owner-invalid"),
+            ("three", "duplicate-email"),
+            ("three", "owner-missing"),
+            ("three", "automated-invalid"),
+            ("four", "duplicate-id"),
+            ("four", "email-missing"),
+            ("four", "owner-missing")])
+        self.assertEqual(report.warnings, [Violation(
+            "three", "duplicate-email", "Account three has the same email as one.", WARNING)])
+        self.assertEqual(report.to_dict()["errors"], 8)
+
+    def test_automated_must_be_a_dict_of_booleans(self):
+        report = validate_accounts({
+            "one": {"id": "1", "email": "one@host.invalid", "owner": "me", "automated": {1: True, "bar": 3}},
+            "two": {"id": "2", "email": "two@host.invalid", "owner": "me", "automated": ["foo"]}})
+
+        messages = sorted(violation.message for violation in report.errors)
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[0], "'automated' field of account two is not a dict.")
+        self.assertIn("one.automated may only contain strings, but the key '1' is of type", messages[1])
+        self.assertIn("one.automated.bar must be boolean, but '3' is a", messages[2])
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+from unittest2 import TestCase
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from ultimate_source_of_accounts import watcher
+
+
+class DirectoryWatcherTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.write("a.yaml", "a: 1")
+        self.write("b.yaml", "b: 1")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.tempdir, name), "w") as yaml_file:
+            yaml_file.write(content)
+
+    def test_changed_files_between_reports_added_removed_and_modified_files(self):
+        old_state = {"a": (1, 1, 1), "b": (1, 1, 1), "c": (1, 1, 1)}
+        new_state = {"a": (1, 1, 1), "b": (2, 1, 1), "d": (1, 1, 1)}
+
+        self.assertEqual(watcher.changed_files_between(old_state, new_state), set(["b", "c", "d"]))
+
+    @patch("ultimate_source_of_accounts.watcher._clock")
+    @patch("ultimate_source_of_accounts.watcher.time.sleep")
+    def test_burst_of_changes_is_reported_once(self, sleep_mock, clock_mock):
+        directory_watcher = watcher.DirectoryWatcher(self.tempdir, interval=1, debounce=2)
+        # Polls: a changed, b changed, a removed, then quiet until the debounce delay passed.
+        actions = iter([
+            lambda: self.write("a.yaml", "a: 22"),
+            lambda: self.write("b.yaml", "b: 22"),
+            lambda: os.remove(os.path.join(self.tempdir, "a.yaml")),
+            lambda: None, lambda: None, lambda: None])
+        sleep_mock.side_effect = lambda _: next(actions)()
+        clock_mock.side_effect = [1, 2, 3, 4, 5, 6]
+
+        changed_files = directory_watcher.wait_for_changes()
+
+        self.assertEqual(changed_files, set(os.path.join(self.tempdir, name) for name in ("a.yaml", "b.yaml")))
+        self.assertEqual(sleep_mock.call_count, 5)